@@ -1,24 +1,36 @@
 # -*- coding: utf-8 -*-
 import dash
+import dash.exceptions
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 import plotly.graph_objs as go
 from dash.dependencies import Input, Output
 import numpy as np
-import pandas as pd
 import os
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.feature_extraction.text import CountVectorizer
 import re
 import au_census_analysis_functions as cnss_func
 import table_funcs as tbl_func
-
-all_categories = tbl_func.return_categories()
-available_tables = tbl_func.return_tables()
+import app_funcs
+import app_data
+import job_queue
+import model_registry
+
+all_categories = app_funcs.all_categories
+available_tables = app_funcs.available_tables
+# load the metadata lookups once up front so the dropdown callbacks don't read them from disk
+tbl_func.preload_metadata()
+# answer the common dropdown selections from the precompiled lookup (built by running app_funcs.py) where it is current
+app_funcs.load_lookup_artifact()
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
+# the WSGI server for gunicorn
+server = app.server
+# gunicorn workers don't run main(), so each process loads the shared DataPack store on its first request
+server.before_request(app_data.ensure_preloaded)
 
 app.layout = html.Div([
     
@@ -74,7 +86,9 @@ app.layout = html.Div([
                 id='y-measure-dropdown',
                 optionHeight=64
             )
-        ], style={'width': '66%', 'display': 'inline-block'})
+        ], style={'width': '66%', 'display': 'inline-block'}),
+
+        html.P(id='y-measure-summary', style={'margin-top': '1em'})
     ], style={
         'backgroundColor': 'rgb(250, 250, 250)',
         'padding': '10px 5px'
@@ -139,6 +153,17 @@ app.layout = html.Div([
         'padding-bottom': '2em'
     }),
 
+    # model training runs in the background job queue, with the status polled until the job finishes
+    html.Div([
+        html.Button('Train model', id='train-button', n_clicks=0),
+        html.Button('Cancel', id='cancel-button', n_clicks=0, style={'margin-left': '1em'}),
+        html.P(id='train-status', style={'margin-top': '1em'}),
+        dcc.Store(id='train-job-id'),
+        dcc.Interval(id='train-poll', interval=2000, disabled=True)
+    ], style={
+        'padding': '10px 5px'
+    }),
+
     html.Div([
         dcc.Graph(
             id='crossfilter-indicator-scatter',
@@ -152,7 +177,7 @@ app.layout = html.Div([
     dash.dependencies.Output('x-table-dropdown', 'options'),
     [dash.dependencies.Input('x-category-dropdown', 'value')])
 def update_x_table_dropdown(x_measures):
-    return update_table_dropdown(x_measures)
+    return app_funcs.table_options(x_measures)
 
 
 @app.callback(
@@ -160,35 +185,12 @@ def update_x_table_dropdown(x_measures):
     [dash.dependencies.Input('y-category-dropdown', 'value'),
     dash.dependencies.Input('y-category-field-dropdown', 'value')])
 def update_y_table_dropdown(y_category, y_cat_field):
-    if y_category is None and y_cat_field is None: return update_table_dropdown(None)
-    if y_category is None: return update_table_dropdown(None, y_cat_field)
-    if y_cat_field is None: return update_table_dropdown(y_category, cat_intersection = True)
+    if y_category is None and y_cat_field is None: return app_funcs.table_options(None)
+    if y_category is None: return app_funcs.table_options(None, y_cat_field)
+    if y_cat_field is None: return app_funcs.table_options(y_category, cat_intersection = True)
     # if category selection has fields selected, use the catergory intersection filter
-    if y_cat_field is None: return update_table_dropdown(y_category, y_cat_field, cat_intersection = True)
-
-def update_table_dropdown(chosen_categories, cat_field = [], cat_intersection = False):
-    # Return list of tables which include any of the selected measures in the dropdown
-    if chosen_categories is None or len(chosen_categories) == 0:
-        # Note: weird behaviour where the input intialises as None but reverts to an empty list if item/s selected then all selections are removed
-        options_df = tbl_func.return_relevant_tables(categories_list = all_categories, category_field_list = cat_field, category_intersection = cat_intersection)
-    else:    
-        options_df = tbl_func.return_relevant_tables(categories_list = chosen_categories, category_field_list = cat_field, category_intersection = cat_intersection)
-
-    # Remove duplicates in the list where there are tables with multiple files (e.g. G09A, G09B, etc.)
-    temp_df = pd.DataFrame(options_df['Table name'].value_counts()).reset_index()
-    temp_df.columns = ['Table name','Count']
-    options_df = options_df.reset_index().merge(temp_df, on='Table name')    
-    
-    # Only change the reference table name where there is >1 instance of the table, 
-    # e.g. if filtering has resulted in returning "G09B", but not any other "G09" table, do not trim it
-    options_df.loc[options_df.Count > 1, 'DataPack file'] = options_df['DataPack file'].str[:3]
-    options_df = options_df.drop('Count', axis=1)
-    options_df = options_df.drop_duplicates(subset='Table name')
-
-    options_df = options_df.set_index('DataPack file')
-    options_df.sort_index(inplace=True)
+    return app_funcs.table_options(y_category, y_cat_field, cat_intersection = True)
 
-    return [{'label': '{} - {}'.format(val, index), 'value': index} for index, val in options_df['Table name'].iteritems()]
 
 @app.callback(
     [dash.dependencies.Output('y-measure-dropdown', 'options'),
@@ -197,10 +199,27 @@ def update_table_dropdown(chosen_categories, cat_field = [], cat_intersection =
     dash.dependencies.Output('y-measure-dropdown', 'disabled')],
     [dash.dependencies.Input('y-category-dropdown', 'value'),
     dash.dependencies.Input('y-table-dropdown', 'value'),
-    dash.dependencies.Input('y-category-field-dropdown', 'value')]
+    dash.dependencies.Input('y-category-field-dropdown', 'value'),
+    dash.dependencies.Input('y-measure-dropdown', 'search_value')],
+    [dash.dependencies.State('y-measure-dropdown', 'value')]
 )
-def update_y_measure_dropdown(y_category, y_table, y_cat_field):
-    return update_measure_dropdown(y_category, [y_table], y_cat_field, True) # predicted feature you want to narrow down so list should only be intersection of specified categories
+def update_y_measure_dropdown(y_category, y_table, y_cat_field, y_search, y_measure):
+    # only a page of the measures is sent to the browser, the search value returns the best matches from the server
+    return app_funcs.measure_options(y_category, [y_table], y_cat_field, True, y_search, y_measure) # predicted feature you want to narrow down so list should only be intersection of specified categories
+
+
+@app.callback(
+    dash.dependencies.Output('y-measure-summary', 'children'),
+    [dash.dependencies.Input('y-measure-dropdown', 'value'),
+    dash.dependencies.Input('y-table-dropdown', 'value')])
+def update_y_measure_summary(y_measure, y_table):
+    if y_measure is None:
+        return ''
+    datapack_file, measure = tbl_func.resolve_measure(y_measure, y_table)
+    # read just the selected column from the preloaded store rather than loading the DataPack file
+    values = app_data.select_columns([(datapack_file, measure)], app_data.preload_area_levels[0])[measure]
+    return '{} across {:,} regions: median {:,.0f}, total {:,.0f}'.format(measure, len(values), values.median(),
+                                                                        values.sum())
 
 
 @app.callback(
@@ -210,57 +229,12 @@ def update_y_measure_dropdown(y_category, y_table, y_cat_field):
     dash.dependencies.Output('x-measure-dropdown', 'disabled')],
     [dash.dependencies.Input('x-category-dropdown', 'value'),
     dash.dependencies.Input('x-table-dropdown', 'value'),
-    dash.dependencies.Input('x-category-field-dropdown', 'value')]
+    dash.dependencies.Input('x-category-field-dropdown', 'value'),
+    dash.dependencies.Input('x-measure-dropdown', 'search_value')],
+    [dash.dependencies.State('x-measure-dropdown', 'value')]
 )
-def update_x_measure_dropdown(x_category, x_table, x_cat_field):
-    return update_measure_dropdown(x_category, x_table, x_cat_field, False) # want to have a wide search space for variable selection so should be a union of specified categories
-
-
-def update_measure_dropdown(category_list, table_list, cat_field_list, category_intersection):
-    # address annoying behaviour of passing empty values when selections haven't been made yet
-    cat_empty = False
-    table_list_empty = False
-    disable_dropdown = False
-    placeholder_text = 'Select the measure you want to predict...'
-    #print('{}; {}; {}'.format(category_list, table_list, cat_field_list))
-
-    if cat_field_list is None: cat_field_list = []
-    
-    if category_list is None or len(category_list) == 0: cat_empty = True
-
-    if table_list is None or len(table_list) == 0: 
-        table_list_empty = True
-        categories_output = [{'label': i, 'value': i} for i in all_categories]
-    elif table_list[0] is None:
-        table_list_empty = True
-        categories_output = [{'label': i, 'value': i} for i in all_categories]
-    else:
-        categories_output = [{'label': i, 'value': i} for i in tbl_func.return_relevant_categories(table_list)] 
-    
-    #print('{}; {}'.format(cat_empty, table_list_empty))
-
-    if cat_empty & table_list_empty: 
-        features_df = tbl_func.return_relevant_features(['Measure'], available_tables, cat_field_list, category_intersection)
-    elif cat_empty & (not table_list_empty):
-        features_df = tbl_func.return_relevant_features(all_categories, table_list, cat_field_list, category_intersection)
-    elif (not cat_empty) & table_list_empty: 
-        features_df = tbl_func.return_relevant_features(category_list, available_tables, cat_field_list, category_intersection)
-    else:
-        features_df = tbl_func.return_relevant_features(category_list, table_list, cat_field_list, category_intersection)
-
-    features_df = features_df.drop_duplicates(subset='Measures')
-    features_df = features_df.set_index('Measures')
-
-    #print(len(features_df))
-
-    if len(features_df['Measure Desc'])>1000:
-        # disable measure selection to prevent ridiculously slow loading
-        placeholder_text = 'Please filter further to select the measure you want to predict...'
-        disable_dropdown = True
-
-    measures_output = [{'label': val, 'value': index} for index, val in features_df['Measure Desc'].iteritems()]
-
-    return measures_output, categories_output, placeholder_text, disable_dropdown
+def update_x_measure_dropdown(x_category, x_table, x_cat_field, x_search, x_measure):
+    return app_funcs.measure_options(x_category, x_table, x_cat_field, False, x_search, x_measure) # want to have a wide search space for variable selection so should be a union of specified categories
 
 
 @app.callback(
@@ -269,9 +243,9 @@ def update_measure_dropdown(category_list, table_list, cat_field_list, category_
     dash.dependencies.Input('y-category-dropdown', 'options'),
     dash.dependencies.Input('y-table-dropdown', 'value')])
 def update_y_cat_field_dropdown(y_cat_input, y_cat_options, y_tbl_input):
-    if y_tbl_input is None: return update_cat_field_dropdown(y_cat_input, y_cat_options, y_tbl_input)
+    if y_tbl_input is None: return app_funcs.cat_field_options(y_cat_input, y_cat_options, y_tbl_input)
     # if not empty, then convert the table selection to list for use in the return_features_subsets function
-    return update_cat_field_dropdown(y_cat_input, y_cat_options, [y_tbl_input])
+    return app_funcs.cat_field_options(y_cat_input, y_cat_options, [y_tbl_input])
 
 
 @app.callback(
@@ -280,29 +254,54 @@ def update_y_cat_field_dropdown(y_cat_input, y_cat_options, y_tbl_input):
     dash.dependencies.Input('x-category-dropdown', 'options'),
     dash.dependencies.Input('x-table-dropdown', 'value')])
 def update_x_cat_field_dropdown(x_cat_input, x_cat_options, x_tbl_input):
-    return update_cat_field_dropdown(x_cat_input, x_cat_options, x_tbl_input)
+    return app_funcs.cat_field_options(x_cat_input, x_cat_options, x_tbl_input)
 
 
-def update_cat_field_dropdown(cat_input, cat_options, tbl_input):
-    if cat_input is None: 
-        if cat_options is None:
-            categories_list = all_categories
-        else:
-            # convert "options" output (list of dictionaries in format {'key':x, 'value':x}) to a simple list
-            categories_list = [x['value'] for x in cat_options]
-    else:
-        categories_list = cat_input
+@app.callback(
+    dash.dependencies.Output('train-job-id', 'data'),
+    [dash.dependencies.Input('train-button', 'n_clicks')],
+    [dash.dependencies.State('y-measure-dropdown', 'value'),
+    dash.dependencies.State('y-table-dropdown', 'value'),
+    dash.dependencies.State('x-table-dropdown', 'value'),
+    dash.dependencies.State('x-category-dropdown', 'value')])
+def submit_training(n_clicks, y_measure, y_table, x_tables, x_categories):
+    if not n_clicks or y_measure is None or not x_tables or not x_categories:
+        raise dash.exceptions.PreventUpdate
+    # identical requests from several users share one job
+    return job_queue.submit_training_job(y_measure, y_table, x_tables, x_categories)
 
-    # if tbl_input is not selected [empty] then use the defaults embedded in the function
-    if tbl_input is None:
-        feature_subset_df = tbl_func.return_features_subsets(categories_list = categories_list, category_intersection = False)
-    else:        
-        feature_subset_df = tbl_func.return_features_subsets(categories_list = categories_list, tables_list = tbl_input, category_intersection = False)
 
-    return [{'label': index, 'value': val} for index, val in feature_subset_df['Measure|Category'].iteritems()]
+@app.callback(
+    [dash.dependencies.Output('train-status', 'children'),
+    dash.dependencies.Output('train-poll', 'disabled')],
+    [dash.dependencies.Input('train-job-id', 'data'),
+    dash.dependencies.Input('train-poll', 'n_intervals'),
+    dash.dependencies.Input('cancel-button', 'n_clicks')])
+def update_training_status(job_id, n_intervals, cancel_clicks):
+    # returns the status text and whether to stop polling
+    if job_id is None:
+        return 'Select a measure to predict and the tables and categories to use as inputs, then train a model', True
+    if dash.callback_context.triggered[0]['prop_id'] == 'cancel-button.n_clicks':
+        job_queue.cancel_job(job_id)
+
+    status = job_queue.job_status(job_id)
+    if status is None:
+        # the job's record is gone, e.g. the job database was cleared
+        return 'Training job not found, train the model again', True
+    if status['status'] == 'done':
+        entry = model_registry.model_entry(status['model_name'])
+        return 'Model trained, with an R2 score of {:.3f} on the test regions'.format(entry['metrics']['r2']), True
+    if status['status'] == 'failed':
+        return 'Training failed: {}'.format(status['error']), True
+    if status['status'] == 'cancelled':
+        return 'Training cancelled', True
+    return '{} ({:.0%})'.format(status['message'], status['progress']), False
+
 
-    
 def main():
+    # map the DataPacks into the shared read-only store, and have the data loaders (including training jobs) read
+    # the mapped columns rather than each loading their own copy
+    app_data.ensure_preloaded()
     app.run_server(debug=True, port=8000, host='127.0.0.1',)
 
 
@@ -0,0 +1,236 @@
+import numpy as np
+import pandas as pd
+import os
+import threading
+import table_funcs as tbl_func
+import cache_funcs
+
+# Statistical area levels the dashboard loads at startup
+preload_area_levels = ['SA3']
+
+# Loaded DataPack stores, in the format {(data path, statistical area level): store}
+_stores = {}
+_stores_lock = threading.Lock()
+
+# Whether this process has run its startup preload, see ensure_preloaded
+_preloaded = False
+_preload_lock = threading.Lock()
+
+
+'''Shared DataPack store'''
+
+def area_level_tables(statistical_area_code='SA3', data_path=None):
+    '''Returns the DataPack files available at a statistical area level, e.g. ['G01', 'G02', ...]'''
+    statistical_area_code = statistical_area_code.upper()
+    source_dir = '{}\\Data\\{}\\AUST'.format(data_path or tbl_func.env_path, statistical_area_code)
+    prefix, suffix = '2016Census_', '_AUS_{}.csv'.format(statistical_area_code)
+    return sorted(x[len(prefix):-len(suffix)] for x in os.listdir(source_dir)
+                  if x.startswith(prefix) and x.endswith(suffix))
+
+
+def _open_store(statistical_area_code, data_path):
+    tables = {}
+    columns = {}
+    for table in area_level_tables(statistical_area_code, data_path):
+        arrays = cache_funcs.read_mmap_columns(table, statistical_area_code, data_path=data_path)
+        index_column = next(iter(arrays))
+        tables[table] = {
+            'index_column': index_column,
+            'regions': pd.Index(arrays[index_column]),
+            'arrays': arrays,
+            }
+        for column in arrays:
+            if column != index_column:
+                # measures found in more than one file (e.g. totals) resolve to the first file unless one is given
+                columns.setdefault(column, table)
+
+    if not tables:
+        raise ValueError('No DataPack files found for {}'.format(statistical_area_code))
+
+    # every file at a level normally lists the same regions in the same order, in which case rows can be taken
+    # from any file by position without aligning them first
+    first = next(iter(tables.values()))
+    aligned = all(x['regions'].equals(first['regions']) for x in tables.values())
+
+    return {
+        'statistical_area_code': statistical_area_code,
+        'index_column': first['index_column'],
+        'regions': first['regions'],
+        'aligned': aligned,
+        'tables': tables,
+        'columns': columns,
+        }
+
+
+def load_store(statistical_area_code='SA3', data_path=None, refresh=False):
+    '''
+    Loads every DataPack file at a statistical area level into a read-only store, on first use. The files are
+    opened from the memory-mapped column store (see cache_funcs.build_mmap_store, which builds them on first use),
+    so "loading" maps the columns rather than reading them: each process keeps its own handles, but all the
+    processes serving the app (e.g. gunicorn workers) share a single copy of the data in the OS page cache.
+    Loading a store doesn't change how table_funcs reads files, see preload's route_readers.
+
+    INPUTS
+    statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
+    data_path: STRING - the root folder containing the "Data" folder
+    refresh: BOOLEAN - reopen the store, e.g. after the DataPack files have been replaced
+
+    OUTPUTS
+    DICTIONARY - the store, holding the region codes, the memory-mapped columns of each file and a lookup from
+    measure to the file it is read from
+    '''
+    statistical_area_code = statistical_area_code.upper()
+    data_path = data_path or tbl_func.env_path
+    key = (data_path, statistical_area_code)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None or refresh:
+            store = _stores[key] = _open_store(statistical_area_code, data_path)
+    return store
+
+
+def preload(area_levels=None, data_path=None, warm=False, route_readers=False):
+    '''
+    Loads the stores for the dashboard's statistical area levels at startup.
+
+    INPUTS
+    area_levels: LIST of STRING objects - optional, the levels to load. Defaults to preload_area_levels.
+    data_path: STRING - the root folder containing the "Data" folder
+    warm: BOOLEAN - read through every column once, so the first callbacks don't wait on the disk
+    route_readers: BOOLEAN - also add the levels to cache_funcs.mmap_area_levels, so the table_funcs readers (and
+        the training jobs queued by this process, see job_queue) read them from the same memory-mapped columns
+    '''
+    for statistical_area_code in area_levels or preload_area_levels:
+        store = load_store(statistical_area_code, data_path)
+        if route_readers and store['statistical_area_code'] not in cache_funcs.mmap_area_levels:
+            cache_funcs.mmap_area_levels.append(store['statistical_area_code'])
+        if warm:
+            for table in store['tables'].values():
+                for values in table['arrays'].values():
+                    if values.dtype.kind in 'biuf':
+                        values.sum()
+
+
+def ensure_preloaded():
+    '''
+    Runs the dashboard's startup preload (routing the table_funcs readers through the stores) once per process.
+    The app calls this before each request, as gunicorn workers import the app without running its main().
+    '''
+    global _preloaded
+    if not _preloaded:
+        with _preload_lock:
+            if not _preloaded:
+                preload(route_readers=True)
+                _preloaded = True
+
+
+def unload_stores():
+    '''Releases all loaded stores'''
+    with _stores_lock:
+        _stores.clear()
+
+
+def store_info(statistical_area_code='SA3', data_path=None):
+    '''Returns a dataframe summarising the files in a loaded store: their region and measure counts and size on disk'''
+    store = load_store(statistical_area_code, data_path)
+    return pd.DataFrame([{'Table': table,
+                          'Regions': len(info['regions']),
+                          'Measures': len(info['arrays']) - 1,
+                          'Bytes': sum(x.nbytes for x in info['arrays'].values())}
+                         for table, info in store['tables'].items()]).set_index('Table')
+
+
+'''Column selection and region filtering'''
+
+def region_codes(statistical_area_code='SA3', data_path=None):
+    '''Returns the region codes at a statistical area level, as a pandas Index'''
+    return load_store(statistical_area_code, data_path)['regions']
+
+
+def _match_regions(regions, table_regions):
+    # region codes are stored as text or numbers depending on the level, so match them in the store's type
+    regions = pd.Index(regions)
+    return regions.astype(str) if table_regions.dtype == object else regions.astype(table_regions.dtype)
+
+
+def _region_positions(regions, table_regions):
+    '''Returns the row positions of the requested regions in a file, dropping regions the file doesn't have'''
+    if regions is None:
+        return None
+    positions = table_regions.get_indexer(_match_regions(regions, table_regions))
+    return positions[positions >= 0]
+
+
+def select_columns(columns, statistical_area_code='SA3', regions=None, table=None, data_path=None):
+    '''
+    Selects measures for a set of regions from the loaded store, copying only the requested rows and columns.
+
+    INPUTS
+    columns: LIST of STRING objects - the measures to select (Short names, e.g. 'Tot_P_P'), or (file, measure)
+        tuples where a measure appears in more than one file. Measures not found are ignored.
+    statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
+    regions: LIST of region codes, or a boolean mask over region_codes() - optional, the regions to select.
+        Regions not found are ignored. Defaults to all regions.
+    table: STRING - optional, the DataPack file to read unqualified measures from
+    data_path: STRING - the root folder containing the "Data" folder
+
+    OUTPUTS
+    A pandas dataframe indexed by region code, with the measures in the order requested
+    '''
+    store = load_store(statistical_area_code, data_path)
+    if regions is not None and getattr(regions, 'dtype', None) == bool:
+        regions = store['regions'][np.asarray(regions)]
+
+    # find the file each requested measure is read from, keeping the first request for a repeated measure name
+    sources = {}
+    for column in columns:
+        source, measure = column if isinstance(column, tuple) else (table or store['columns'].get(column), column)
+        if source in store['tables'] and measure in store['tables'][source]['arrays']:
+            sources.setdefault(measure, source)
+
+    if store['aligned'] or not sources:
+        positions = _region_positions(regions, store['regions'])
+        index = store['regions'] if positions is None else store['regions'][positions]
+        data = {}
+        for measure, source in sources.items():
+            values = store['tables'][source]['arrays'][measure]
+            data[measure] = values if positions is None else values[positions]
+        df = pd.DataFrame(data, index=index, copy=True)
+    else:
+        frames = []
+        for source in dict.fromkeys(sources.values()):
+            info = store['tables'][source]
+            positions = _region_positions(regions, info['regions'])
+            index = info['regions'] if positions is None else info['regions'][positions]
+            frames.append(pd.DataFrame({x: info['arrays'][x] if positions is None else info['arrays'][x][positions]
+                                        for x, y in sources.items() if y == source}, index=index, copy=True))
+        df = pd.concat(frames, axis=1)[list(sources)]
+        if regions is not None:
+            regions = _match_regions(regions, df.index)
+            df = df.loc[regions[regions.isin(df.index)]]
+
+    df.index.name = store['index_column']
+    return df
+
+
+def select_table(table, statistical_area_code='SA3', columns=None, regions=None, data_path=None):
+    '''
+    Selects a DataPack file (or some of its measures) for a set of regions from the loaded store.
+
+    INPUTS
+    table: STRING - the ABS Census Datapack file to select from (e.g. G01, G09A)
+    statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
+    columns: LIST of STRING objects - optional, the measures to select. Defaults to all measures in the file.
+    regions: LIST of region codes, or a boolean mask over region_codes() - optional, the regions to select
+    data_path: STRING - the root folder containing the "Data" folder
+
+    OUTPUTS
+    A pandas dataframe indexed by region code
+    '''
+    store = load_store(statistical_area_code, data_path)
+    if table not in store['tables']:
+        raise ValueError('{} is not a DataPack file at {}'.format(table, statistical_area_code))
+    info = store['tables'][table]
+    if columns is None:
+        columns = [x for x in info['arrays'] if x != info['index_column']]
+    return select_columns([(table, x) for x in columns], statistical_area_code, regions, data_path=data_path)
@@ -0,0 +1,424 @@
+import numpy as np
+import pandas as pd
+import os
+import sys
+import re
+import pickle
+import threading
+import heapq
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import reduce
+import table_funcs as tbl_func
+
+all_categories = tbl_func.return_categories()
+available_tables = tbl_func.return_tables()
+
+# Maximum number of dropdown option lists kept in the option cache
+option_cache_size = 1024
+
+# Option lists built for each selection state, in the format {(builder name, selection...): options}
+_option_cache = OrderedDict()
+_option_cache_lock = threading.Lock()
+option_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'lookups': 0}
+
+# Option lists precomputed by build_lookup_artifact, in the same format as the option cache
+_lookup_options = {}
+
+# Metadata files the dropdown options are derived from, used to check a lookup artifact is current
+lookup_source_files = ['category_values', 'category_measure', 'table_reference']
+
+# Maximum number of measure options sent to the browser, the rest are reached by typing in the dropdown
+measure_page_size = 100
+
+
+'''Dropdown option cache'''
+
+def normalise_selection(value):
+    '''
+    Normalises a dropdown value for use in a cache key: None, empty lists and lists holding only None (e.g. an empty
+    single-select dropdown wrapped in a list) all become None, and lists become tuples in selection order.
+    '''
+    if isinstance(value, (list, tuple)):
+        value = tuple(x for x in value if x is not None)
+        return value if len(value) > 0 else None
+    return value
+
+
+def _cached_options(builder, *selection):
+    '''Returns the options built by builder for a normalised selection state, building and caching them on a miss'''
+    key = (builder.__name__,) + selection
+    options = _lookup_options.get(key)
+    if options is not None:
+        option_cache_stats['lookups'] += 1
+        return options
+
+    with _option_cache_lock:
+        if key in _option_cache:
+            _option_cache.move_to_end(key)
+            option_cache_stats['hits'] += 1
+            return _option_cache[key]
+        option_cache_stats['misses'] += 1
+
+    # build outside the lock so slow metadata queries don't hold up other users' cache hits
+    options = builder(*selection)
+
+    with _option_cache_lock:
+        _option_cache[key] = options
+        _option_cache.move_to_end(key)
+        while len(_option_cache) > option_cache_size:
+            _option_cache.popitem(last=False)
+            option_cache_stats['evictions'] += 1
+    return options
+
+
+def option_cache_info():
+    '''Returns the option cache's hit, miss and eviction counts along with its current size and hit rate'''
+    with _option_cache_lock:
+        info = dict(option_cache_stats, size=len(_option_cache), max_size=option_cache_size)
+    lookups = info['hits'] + info['misses'] + info['lookups']
+    info['hit_rate'] = (info['hits'] + info['lookups']) / lookups if lookups else 0.0
+    info['lookup_size'] = len(_lookup_options)
+    return info
+
+
+def clear_option_cache():
+    '''Empties the option cache and resets its statistics, e.g. after the metadata files are reloaded'''
+    with _option_cache_lock:
+        _option_cache.clear()
+        for key in option_cache_stats:
+            option_cache_stats[key] = 0
+
+
+'''Dropdown option builders'''
+
+def _build_table_options(chosen_categories, cat_field, cat_intersection):
+    # Return list of tables which include any of the selected measures in the dropdown
+    if chosen_categories is None:
+        # Note: the input intialises as None but reverts to an empty list if item/s selected then all selections are removed
+        chosen_categories = all_categories
+    options_df = tbl_func.return_relevant_tables(categories_list = list(chosen_categories),
+                                                 category_field_list = list(cat_field or []),
+                                                 category_intersection = cat_intersection)
+
+    # Remove duplicates in the list where there are tables with multiple files (e.g. G09A, G09B, etc.)
+    temp_df = pd.DataFrame(options_df['Table name'].value_counts()).reset_index()
+    temp_df.columns = ['Table name','Count']
+    options_df = options_df.reset_index().merge(temp_df, on='Table name')
+
+    # Only change the reference table name where there is >1 instance of the table,
+    # e.g. if filtering has resulted in returning "G09B", but not any other "G09" table, do not trim it
+    options_df.loc[options_df.Count > 1, 'DataPack file'] = options_df['DataPack file'].str[:3]
+    options_df = options_df.drop('Count', axis=1)
+    options_df = options_df.drop_duplicates(subset='Table name')
+
+    options_df = options_df.set_index('DataPack file')
+    options_df.sort_index(inplace=True)
+
+    return [{'label': '{} - {}'.format(val, index), 'value': index} for index, val in options_df['Table name'].items()]
+
+
+def table_options(chosen_categories, cat_field = None, cat_intersection = False):
+    '''
+    Returns the table dropdown options for the tables which include the chosen categories.
+
+    INPUTS
+    chosen_categories: LIST of STRING objects - selected categories, None or empty for all categories
+    cat_field: LIST of STRING objects - selected category fields to filter by, None or empty for no filter
+    cat_intersection: BOOLEAN - whether to filter the selections based on an intersection (and) or union (or) of selected terms
+
+    OUTPUTS
+    LIST of dropdown option dictionaries
+    '''
+    return _cached_options(_build_table_options, normalise_selection(chosen_categories),
+                           normalise_selection(cat_field), cat_intersection)
+
+
+def _build_measure_options(category_list, table_list, cat_field_list, category_intersection):
+    cat_field_list = list(cat_field_list or [])
+
+    if table_list is None:
+        categories_output = [{'label': i, 'value': i} for i in all_categories]
+    else:
+        categories_output = [{'label': i, 'value': i} for i in tbl_func.return_relevant_categories(list(table_list))]
+
+    if category_list is None and table_list is None:
+        features_df = tbl_func.return_relevant_features(['Measure'], available_tables, cat_field_list, category_intersection)
+    elif category_list is None:
+        features_df = tbl_func.return_relevant_features(all_categories, list(table_list), cat_field_list, category_intersection)
+    elif table_list is None:
+        features_df = tbl_func.return_relevant_features(list(category_list), available_tables, cat_field_list, category_intersection)
+    else:
+        features_df = tbl_func.return_relevant_features(list(category_list), list(table_list), cat_field_list, category_intersection)
+
+    features_df = features_df.drop_duplicates(subset='Measures')
+    features_df = features_df.set_index('Measures')
+
+    measures_output = [{'label': val, 'value': index} for index, val in features_df['Measure Desc'].items()]
+
+    return measures_output, categories_output
+
+
+def _build_measure_search_index(*selection):
+    return build_search_index(_cached_options(_build_measure_options, *selection)[0])
+
+
+def measure_options(category_list, table_list, cat_field_list, category_intersection, search_value = None,
+                    selected = None, page_size = None):
+    '''
+    Returns a page of the measure dropdown options for the selected categories, tables and category fields, along
+    with the category dropdown options for the selected tables and the measure dropdown's placeholder text and
+    disabled state. Rather than sending every measure to the browser, only the first page_size measures (or the
+    best page_size matches for the text typed into the dropdown) are returned.
+
+    INPUTS
+    category_list: LIST of STRING objects - selected categories, None or empty for all categories
+    table_list: LIST of STRING objects - selected tables, None or empty for all tables
+    cat_field_list: LIST of STRING objects - selected category fields to filter by, None or empty for no filter
+    category_intersection: BOOLEAN - whether to filter the selections based on an intersection (and) or union (or) of selected terms
+    search_value: STRING - the text typed into the measure dropdown
+    selected: STRING - the currently selected measure, which is always kept in the options so it isn't cleared
+    page_size: INT - maximum number of measure options to return, defaults to measure_page_size
+
+    OUTPUTS
+    TUPLE of (measure options, category options, placeholder text, disabled)
+    '''
+    page_size = page_size or measure_page_size
+    selection = (normalise_selection(category_list), normalise_selection(table_list),
+                 normalise_selection(cat_field_list), category_intersection)
+    measures_output, categories_output = _cached_options(_build_measure_options, *selection)
+
+    if len(measures_output) <= page_size:
+        return measures_output, categories_output, 'Select the measure you want to predict...', False
+
+    index = _cached_options(_build_measure_search_index, *selection)
+    if search_value:
+        options = search_options(index, search_value, page_size)
+    else:
+        options = measures_output[:page_size]
+    if selected in index['by_value'] and all(x['value'] != selected for x in options):
+        options = options + [index['by_value'][selected]]
+
+    placeholder_text = 'Type to search the {:,} measures you can predict...'.format(len(measures_output))
+    return options, categories_output, placeholder_text, False
+
+
+def _build_cat_field_options(categories_list, tbl_input):
+    # if tbl_input is not selected [empty] then use the defaults embedded in the function
+    if tbl_input is None:
+        feature_subset_df = tbl_func.return_features_subsets(categories_list = list(categories_list), category_intersection = False)
+    else:
+        feature_subset_df = tbl_func.return_features_subsets(categories_list = list(categories_list), tables_list = list(tbl_input), category_intersection = False)
+
+    return [{'label': index, 'value': val} for index, val in feature_subset_df['Measure|Category'].items()]
+
+
+def cat_field_options(cat_input, cat_options, tbl_input):
+    '''
+    Returns the category field dropdown options for the selected categories (or every category in the category
+    dropdown's options where none are selected) and tables.
+
+    INPUTS
+    cat_input: LIST of STRING objects - selected categories
+    cat_options: LIST of dropdown option dictionaries - the category dropdown's options
+    tbl_input: LIST of STRING objects - selected tables, None or empty for all tables
+
+    OUTPUTS
+    LIST of dropdown option dictionaries
+    '''
+    categories_list = normalise_selection(cat_input)
+    if categories_list is None:
+        if cat_options is None:
+            categories_list = tuple(all_categories)
+        else:
+            # convert "options" output (list of dictionaries in format {'key':x, 'value':x}) to a simple list
+            categories_list = tuple(x['value'] for x in cat_options)
+
+    return _cached_options(_build_cat_field_options, categories_list, normalise_selection(tbl_input))
+
+
+'''Precompiled option lookups'''
+
+def lookup_artifact_path(data_path=None):
+    '''Returns the path of the precompiled dropdown option lookup artifact'''
+    return os.path.join(data_path or tbl_func.env_path, 'Data', 'Cache', 'dropdown_lookup.pickle')
+
+
+def _lookup_source_mtimes():
+    return {name: os.path.getmtime(tbl_func._metadata_path(name)) for name in lookup_source_files}
+
+
+def _intern_strings(obj):
+    '''Interns the strings in nested option lists so repeated labels and values are stored once when pickled'''
+    if isinstance(obj, str):
+        return sys.intern(obj)
+    if isinstance(obj, list):
+        return [_intern_strings(x) for x in obj]
+    if isinstance(obj, tuple):
+        return tuple(_intern_strings(x) for x in obj)
+    if isinstance(obj, dict):
+        return {_intern_strings(k): _intern_strings(v) for k, v in obj.items()}
+    return obj
+
+
+def build_lookup_artifact(path=None):
+    '''
+    Precomputes the dropdown options for the common selection states (nothing selected, a single category or a
+    single table selected) and saves them to one pickle, along with the modified times of the metadata files they
+    were derived from. Run this as a build step whenever the metadata files change.
+
+    INPUTS
+    path: STRING - where to save the artifact, defaults to lookup_artifact_path()
+
+    OUTPUTS
+    INT - the number of selection states saved
+    '''
+    path = path or lookup_artifact_path()
+    table_values = [x['value'] for x in _build_table_options(None, None, False)]
+
+    options = {}
+    def add(builder, *selection):
+        options[(builder.__name__,) + selection] = builder(*selection)
+        return options[(builder.__name__,) + selection]
+
+    for intersection in [False, True]:
+        add(_build_table_options, None, None, intersection)
+        for category in all_categories:
+            add(_build_table_options, (category,), None, intersection)
+
+        add(_build_measure_options, None, None, None, intersection)
+        for category in all_categories:
+            add(_build_measure_options, (category,), None, None, intersection)
+        for table in table_values:
+            categories_output = add(_build_measure_options, None, (table,), None, intersection)[1]
+            # the category field dropdown is driven by the table's category options until a category is picked
+            options.setdefault((_build_cat_field_options.__name__, tuple(x['value'] for x in categories_output), (table,)),
+                               _build_cat_field_options(tuple(x['value'] for x in categories_output), (table,)))
+
+    add(_build_cat_field_options, tuple(all_categories), None)
+    for category in all_categories:
+        add(_build_cat_field_options, (category,), None)
+
+    artifact = {'source_mtimes': _lookup_source_mtimes(), 'options': _intern_strings(options)}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+    return len(options)
+
+
+def load_lookup_artifact(path=None):
+    '''
+    Loads a precompiled dropdown option lookup artifact so its selection states are answered by direct lookup.
+    The artifact is ignored if it is missing or older than the metadata files, leaving the dynamic option builders.
+
+    INPUTS
+    path: STRING - the artifact to load, defaults to lookup_artifact_path()
+
+    OUTPUTS
+    BOOLEAN - whether the artifact was loaded
+    '''
+    try:
+        with open(path or lookup_artifact_path(), 'rb') as f:
+            artifact = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return False
+    if artifact['source_mtimes'] != _lookup_source_mtimes():
+        return False
+
+    _lookup_options.clear()
+    _lookup_options.update(artifact['options'])
+    return True
+
+
+'''Option search'''
+
+def _search_terms(text):
+    return [x for x in re.split(r'[^a-z0-9]+', str(text).lower()) if x]
+
+
+def build_search_index(options):
+    '''
+    Builds a search index over the labels of a list of dropdown options: a trigram index for substring matches of
+    longer search terms and a sorted word list for prefix matches of one or two character terms.
+
+    INPUTS
+    options: LIST of dropdown option dictionaries
+
+    OUTPUTS
+    DICTIONARY of the options, lower case labels, trigram postings, sorted words with the option each came from, and
+    an option lookup by value
+    '''
+    labels = [str(x['label']).lower() for x in options]
+
+    trigrams = {}
+    for i, label in enumerate(labels):
+        for trigram in set(label[j:j + 3] for j in range(len(label) - 2)):
+            trigrams.setdefault(trigram, []).append(i)
+
+    words = sorted((word, i) for i, label in enumerate(labels) for word in set(_search_terms(label)))
+
+    return {
+        'options': options,
+        'labels': labels,
+        'trigrams': {k: np.array(v, dtype=np.int64) for k, v in trigrams.items()},
+        'words': [x[0] for x in words],
+        'word_options': np.array([x[1] for x in words], dtype=np.int64),
+        'by_value': {x['value']: x for x in options},
+        }
+
+
+def _term_matches(index, term):
+    '''Returns the sorted positions of the options whose label contains a search term'''
+    if len(term) < 3:
+        # match the start of words for very short terms, which have too many substring matches to be useful
+        words = index['words']
+        start, end = bisect_left(words, term), bisect_left(words, term + '\uffff')
+        return np.unique(index['word_options'][start:end])
+
+    postings = [index['trigrams'].get(term[j:j + 3]) for j in range(len(term) - 2)]
+    if any(x is None for x in postings):
+        return np.array([], dtype=np.int64)
+    candidates = reduce(lambda a, b: np.intersect1d(a, b, assume_unique=True), postings)
+    # every trigram matching doesn't guarantee the term matches, so check the candidates
+    return np.array([i for i in candidates if term in index['labels'][i]], dtype=np.int64)
+
+
+def search_options(index, search_value, top_k):
+    '''
+    Returns the top_k options whose label contains the search text, ranked by labels starting with the search, then
+    the earliest match of the first term and then the shortest label. The terms of the search narrow down the
+    candidates through the index, and the whole search must then appear in the label: the dropdown filters the
+    returned options by the typed text in the browser as well, so options matching only some words of a multi-word
+    search would never be shown.
+
+    INPUTS
+    index: DICTIONARY - a search index from build_search_index
+    search_value: STRING - the text to search for
+    top_k: INT - the maximum number of options to return
+
+    OUTPUTS
+    LIST of dropdown option dictionaries
+    '''
+    query = str(search_value).lower().strip()
+    terms = _search_terms(query)
+    if not terms:
+        return index['options'][:top_k]
+
+    matches = None
+    for term in terms:
+        term_matches = _term_matches(index, term)
+        matches = term_matches if matches is None else np.intersect1d(matches, term_matches, assume_unique=True)
+        if len(matches) == 0:
+            return []
+
+    labels = index['labels']
+    matches = [i for i in matches.tolist() if query in labels[i]]
+    ranked = heapq.nsmallest(top_k, matches,
+                             key=lambda i: (not labels[i].startswith(query), labels[i].find(terms[0]), len(labels[i]), i))
+    return [index['options'][i] for i in ranked]
+
+
+if __name__ == '__main__':
+    print('Saved {} dropdown selection states to {}'.format(build_lookup_artifact(), lookup_artifact_path()))
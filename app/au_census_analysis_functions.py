@@ -3,280 +3,297 @@
 import numpy as np
 import pandas as pd
 import os
+import time
+import json
 import matplotlib.pyplot as plt
-import operator
 from textwrap import wrap
-from sklearn.model_selection import train_test_split, GridSearchCV
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.model_selection import train_test_split, GridSearchCV, HalvingGridSearchCV, RandomizedSearchCV, \
+    ParameterGrid, ParameterSampler, KFold
 from sklearn.metrics import make_scorer, r2_score
 from sklearn.impute import SimpleImputer
 from sklearn.pipeline import Pipeline
 from sklearn.ensemble import RandomForestRegressor
+from sklearn.inspection import partial_dependence
+from joblib import Parallel, delayed, effective_n_jobs
+from scipy import sparse
+import cache_funcs
+import model_registry
+
+try:
+    # exact TreeSHAP contributions where shap is installed, otherwise Saabas path contributions are used
+    import shap
+except ImportError:
+    shap = None
+# The DataPack loaders are shared with the dashboard so that all table loads go through the same columnar cache
+from table_funcs import WFH_create_Xy, create_Xy, create_multi_Xy, target_row_mask
 
 # Set a variable for current notebook's path for various loading/saving mechanisms
 nb_path = os.getcwd()
 
 '''Data import functions'''
 
-def load_census_csv(table_list, statistical_area_code='SA3'):
-    '''
-    Navigates the file structure to import the relevant files for specified data tables at a defined statistical area level
-    
-    INPUTS
-    table_list: LIST of STRING objects - the ABS Census Datapack table to draw information from (G01-G59)
-    statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
-    
-    OUTPUTS
-    A pandas dataframe
-    '''
-    statistical_area_code = statistical_area_code.upper()
-    
-    df_csv_load = pd.DataFrame()
-    for index, table in enumerate(table_list):
-        
-        if index==0:
-            df_csv_load = pd.read_csv('{}\\Data\\{}\\AUST\\2016Census_{}_AUS_{}.csv'.format(nb_path,
-                                                                                statistical_area_code,
-                                                                                table,
-                                                                                statistical_area_code
-                                                                               ),
-                                       engine='python')
-        else:
-            temp_df = pd.read_csv('{}\\Data\\{}\\AUST\\2016Census_{}_AUS_{}.csv'.format(nb_path,
-                                                                                statistical_area_code,
-                                                                                table,
-                                                                                statistical_area_code
-                                                                               ),
-                                       engine='python')
-            merge_col = df_csv_load.columns[0]
-            df_csv_load = pd.merge(df_csv_load, temp_df, on=merge_col)
-    
-    return df_csv_load
-
-
+# specify parameters for grid search
+search_parameters = {'clf__n_estimators':[20,40], # this used to start at 10 and go to 80 but was a huge timesuck and not improving performance
+                     'clf__max_depth':[16,32,64], # this used to go to 128 but had no impact on performance
+                     #'clf__min_samples_leaf':[1,2,4] This wasn't really having an impact on performance
+                    }
 
-def refine_measure_name(table_namer, string_item, category_item, category_list):
-    '''Simple function for generating measure names based on custom metadata information on ABS measures'''
-    position_list = []
-    for i, j in enumerate(category_item.split("|")):
-        if j in category_list:
-            position_list.append(i)
-    return table_namer + '|' + '_'.join([string_item.split("|")[i] for i in position_list])
+# the original wider grid, affordable with parallel, halving or time budgeted searches
+wide_search_parameters = {'clf__n_estimators':[10,20,40,80],
+                          'clf__max_depth':[16,32,64,128],
+                          'clf__min_samples_leaf':[1,2,4]
+                         }
 
 
-def load_table_refined(table_ref, category_list, statistical_area_code='SA3', drop_zero_area=True):
-    '''
-    Function for loading ABS census data tables, and refining/aggregating by a set of defined categories
-    (e.g. age, sex, occupation, English proficiency, etc.) where available.
-    
-    INPUTS
-    table_ref: STRING - the ABS Census Datapack table to draw information from (G01-G59)
-    category_list: LIST of STRING objects - Cetegorical information to slice/aggregate information from (e.g. Age)
-    statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
-    drop_zero_area: BOOLEAN - an option to remove "non-geographical" area data points such as "no fixed address" or "migratory"
-    '''
-    df_meta = pd.read_csv('{}\\Data\\Metadata\\Metadata_2016_refined.csv'.format(os.getcwd()))
-    index_reference = 'Area_index'
-    
-    # slice meta based on table
-    meta_df_select = df_meta[df_meta['Profile table'].str.contains(table_ref)].copy()
-    
-    # for category in filter_cats, slice based on category >0
-    for cat in category_list:
-        # First, check if there *are* any instances of the given category
-        try:
-            if meta_df_select[cat].sum() > 0:
-                # If so, apply the filter
-                meta_df_select = meta_df_select[meta_df_select[cat]>0]
-            else:
-                pass # If not, don't apply (otherwise you will end up with no selections)
-        except:
-            pass
-        
-    # select rows with lowest value in "Number of Classes Excl Total" field
-    min_fields = meta_df_select['Number of Classes Excl Total'].min()
-    meta_df_select = meta_df_select[meta_df_select['Number of Classes Excl Total'] == min_fields]
-    
-    # Select the table file(s) to import
-    import_table_list = meta_df_select['DataPack file'].unique()
-    
-    # Import the SA data tables
-    df_data = load_census_csv(import_table_list, statistical_area_code.upper())
-    
-    # Select only columns included in the meta-sliced table above
-    df_data.set_index(df_data.columns[0], inplace=True)
-    refined_columns = meta_df_select.Short.tolist()
-    df_data = df_data[refined_columns]
-    
-    # aggregate data by:
-    # transposing the dataframe
-    df_data_t = df_data.T.reset_index()
-    df_data_t.rename(columns={ df_data_t.columns[0]: 'Short' }, inplace = True)
-    # merging with the refined meta_df to give table name, "Measures" and "Categories" fields
-    meta_merge_ref = meta_df_select[['Short','Table name','Measures','Categories']]
-    df_data_t = df_data_t.merge(meta_merge_ref, on='Short')
-    
-    # from the "Categories" field, split an individual entry by the "|" character
-    # to give the index of the measure you are interested in grouping by.
-    # Create a new column based on splitting the "Measure" field and selecting the value of this index/indices.
-    # Merge above with the table name to form "[Table_Name]|[groupby_value]" to have a good naming convention
-    # e.g. "Method_of_Travel_to_Work_by_Sex|Three_methods_Females".
-    df_data_t[index_reference] = df_data_t.apply(lambda x: refine_measure_name(x['Table name'], 
-                                                                               x['Measures'], 
-                                                                               x['Categories'], 
-                                                                               category_list), axis=1)
-    
-    # then groupby this new column 
-    # then transpose again and either create the base data_df for future merges or merge with the already existing data_df
-    df_data_t = df_data_t.drop(['Short','Table name','Measures','Categories'], axis=1)
-    df_data_t = df_data_t.groupby([index_reference]).sum()
-    df_data_t = df_data_t.T
-    
-    if drop_zero_area:
-        df_zero_area = pd.read_csv('{}\\Data\\Metadata\\Zero_Area_Territories.csv'.format(os.getcwd()))
-        zero_indicies = set(df_zero_area['AGSS_Code_2016'].tolist())
-        zero_indicies_drop = set(df_data_t.index.values).intersection(zero_indicies)
-        df_data_t = df_data_t.drop(zero_indicies_drop, axis=0)
-    
-    return df_data_t
-
-
-def load_tables_specify_cats(table_list, category_list, statistical_area_code='SA3'):
-    '''
-    Function for loading ABS census data tables, and refining/aggregating by a set of defined categories
-    (e.g. age, sex, occupation, English proficiency, etc.) where available.
-    
-    INPUTS
-    table_list: LIST of STRING objects - list of the ABS Census Datapack tables to draw information from (G01-G59)
-    category_list: LIST of STRING objects - Cetegorical information to slice/aggregate information from (e.g. Age)
-    statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
-    
-    OUTPUTS
-    A pandas dataframe
-    '''
-    for index, table in enumerate(table_list):
-        if index==0:
-            df = load_table_refined(table, category_list, statistical_area_code)
-            df.reset_index(inplace=True)
-        else:
-            temp_df = load_table_refined(table, category_list, statistical_area_code)
-            temp_df.reset_index(inplace=True)
-            merge_col = df.columns[0]
-            df = pd.merge(df, temp_df, on=merge_col)
-    
-    df.set_index(df.columns[0], inplace=True)
-    
-    return df
-
-
-
-def build_model(verbosity = 3):
+def build_model(verbosity = 3, search = 'grid', n_jobs = None, memory = None, wide_grid = False, n_iter = 10):
     ''' 
     Builds a Gridsearch object for use in supervised learning modelling.
     Imputes for missing values and build a model to complete a quick Gridsearch over RandomForestRegressor key parameters.
     
     INPUTS
-    None
+    verbosity - Int. Verbosity of the search object
+    search - String. 'grid' for an exhaustive search, 'halving' for a successive halving search (candidates are first 
+                scored on a small sample of regions, with only the best scored on more) or 'random' for a 
+                randomized search of n_iter candidates
+    n_jobs - Int. Number of parallel jobs used to fit the folds and parameter sets (-1 for all cores)
+    memory - String or joblib.Memory. Optional cache location for the pipeline, so the imputation of each fold
+                is fitted once rather than once per parameter set
+    wide_grid - Boolean. Search the wider wide_search_parameters grid rather than search_parameters
+    n_iter - Int. Number of candidates sampled by the 'random' search
     
     OUTPUTS
-    cv - An SKLearn Gridsearch object for a pipeline that includes Median imputation and RandomForestRegressor model.
+    cv - An SKLearn search object for a pipeline that includes Median imputation and RandomForestRegressor model.
     '''
     pipeline_model = Pipeline([
         ('impute', SimpleImputer(missing_values=np.nan, strategy='median')),
         ('clf', RandomForestRegressor(n_estimators=100, random_state=42, max_depth=100))
-    ])
-    # specify parameters for grid search
-    parameters = {'clf__n_estimators':[20,40], # this used to start at 10 and go to 80 but was a huge timesuck and not improving performance
-              'clf__max_depth':[16,32,64], # this used to go to 128 but had no impact on performance
-              #'clf__min_samples_leaf':[1,2,4] This wasn't really having an impact on performance
-             }
+    ], memory=memory)
+    parameters = wide_search_parameters if wide_grid else search_parameters
 
     # create grid search object
     scorer = make_scorer(r2_score)
-    cv = GridSearchCV(pipeline_model, param_grid=parameters, scoring=scorer, verbose = verbosity, cv=3)
+    if search == 'grid':
+        cv = GridSearchCV(pipeline_model, param_grid=parameters, scoring=scorer, verbose = verbosity, cv=3, 
+                          n_jobs=n_jobs)
+    elif search == 'halving':
+        cv = HalvingGridSearchCV(pipeline_model, param_grid=parameters, scoring=scorer, verbose = verbosity, cv=3, 
+                                 n_jobs=n_jobs, factor=3, random_state=42)
+    elif search == 'random':
+        cv = RandomizedSearchCV(pipeline_model, param_distributions=parameters, 
+                                n_iter=min(n_iter, len(ParameterGrid(parameters))), scoring=scorer, 
+                                verbose = verbosity, cv=3, n_jobs=n_jobs, random_state=42)
+    else:
+        raise ValueError('Unknown search {}, expected grid, halving or random'.format(search))
 
     return cv
 
-def WFH_create_Xy(stat_a_level, load_tables, load_features):
+
+def budgeted_search(X, y, time_budget, search = 'random', n_jobs = None, memory = None, wide_grid = True, 
+                    n_iter = None, patience = 2, verbosity = 0):
     '''
-    A function which compiles a set of background information from defined ABS census tables and 
-    creates input and output vectors to allow model training for the  "Work from home participation 
-    rate" in a given region. Cleans the data for outliers (defined as >3 standard deviations from the mean) in the
-    WFH participation rate, and scales all data by dividing by the "Total Population" feature for each region.
+    Fits a grid or randomized search within a time budget. Candidates are scored in batches of n_jobs; the search
+    stops early when the next batch is not expected to finish within the budget, or when the best score has not 
+    improved for patience batches. At least one batch is always fitted.
     
     INPUTS
-    stat_a_level - String. The statistical area level of information the data should be drawn from (SA1-3)
-    load_tables - List of Strings. A list of ABS census datapack tables to draw data from (G01-59)
-    load_features - List of Strings. A list of population characteristics to use in analysis (Age, Sex, labor force status, etc.)
+    X - Pandas dataframe. The features to train on.
+    y - Pandas series. The response vector.
+    time_budget - Float. Wall clock time budget for the search, in seconds.
+    search - String. 'grid' to score candidates in grid order or 'random' to score them in a random order
+    n_jobs, memory, wide_grid - see build_model
+    n_iter - Int. Optional maximum number of candidates for the 'random' search, defaults to the whole grid
+    patience - Int. Number of batches without improvement before stopping, None to only stop on the budget
+    verbosity - Int. Verbosity of the search objects
     
     OUTPUTS
-    X - pandas DataFrame - a dataframe of features from the census datapacks tables, normalised by dividing each feature by 
-                            the population attributable to the region
-    y - pandas series - the Work from Home Participation Rate by region
-    
+    The fitted SKLearn GridSearchCV object for the batch holding the best candidate
     '''
-    # Load table 59 (the one with commute mechanism) and have a quick look at the distribution of WFH by sex
-    response_vector = 'WFH_Participation'
-    df_travel = load_table_refined('G59', ['Number of Commuting Methods'], statistical_area_code=stat_a_level)
-    cols_to_delete = [x for x in df_travel.columns if 'Worked_at_home' not in x]
-    df_travel.drop(cols_to_delete,axis=1, inplace=True)
+    parameters = wide_search_parameters if wide_grid else search_parameters
+    if search == 'grid':
+        candidates = list(ParameterGrid(parameters))
+    elif search == 'random':
+        n_candidates = len(ParameterGrid(parameters))
+        candidates = list(ParameterSampler(parameters, min(n_iter or n_candidates, n_candidates), random_state=42))
+    else:
+        raise ValueError('A time budget is only supported for grid and random searches')
+    
+    batch_size = effective_n_jobs(n_jobs)
+    start = time.perf_counter()
+    best_fit, best_score, batch_time, stale = None, -np.inf, 0, 0
+    for i in range(0, len(candidates), batch_size):
+        if best_fit is not None and time.perf_counter() - start + batch_time > time_budget:
+            break
+        batch_start = time.perf_counter()
+        grid_obj = build_model(verbosity, 'grid', n_jobs, memory)
+        grid_obj.set_params(param_grid=[{k: [v] for k, v in x.items()} for x in candidates[i:i + batch_size]])
+        grid_fit = grid_obj.fit(X, y)
+        batch_time = time.perf_counter() - batch_start
+        
+        if grid_fit.best_score_ > best_score:
+            best_fit, best_score, stale = grid_fit, grid_fit.best_score_, 0
+        else:
+            stale += 1
+            if patience is not None and stale >= patience:
+                break
+    
+    return best_fit
 
-    df_pop = load_census_csv(['G01'], statistical_area_code=stat_a_level)
-    df_pop.set_index(df_pop.columns[0], inplace=True)
-    df_pop = df_pop.drop([x for x in df_pop.columns if 'Tot_P_P' not in x], axis=1)
-    df_travel = df_travel.merge(df_pop, left_index=True, right_index=True)
+
+def _grow_forest_curve(X_train, y_train, X_val, y_val, params, n_estimators_list, oob):
+    '''
+    Grows a single RandomForestRegressor through each tree count in n_estimators_list using warm_start, returning
+    the out-of-bag score (oob=True) or the R2 score on the validation fold at each count.
+    '''
+    imputer = SimpleImputer(missing_values=np.nan, strategy='median').fit(X_train)
+    X_train = imputer.transform(X_train)
+    if not oob:
+        X_val = imputer.transform(X_val)
+    
+    forest = RandomForestRegressor(random_state=42, warm_start=True, oob_score=oob, **params)
+    scores = []
+    for n_estimators in n_estimators_list:
+        # only the additional trees are fitted at each checkpoint
+        forest.set_params(n_estimators=n_estimators).fit(X_train, y_train)
+        scores.append(forest.oob_score_ if oob else r2_score(y_val, forest.predict(X_val)))
+    return scores
+
+
+def warm_start_search(X, y, n_estimators_list = None, wide_grid = False, scoring = 'cv', cv = 3, n_jobs = None, 
+                      curve_path = None):
+    '''
+    Searches the build_model parameters, growing one forest per parameter set (and fold) with warm_start rather 
+    than refitting from scratch for each n_estimators value. The score at every tree count checkpoint is recorded, 
+    giving the whole n_estimators curve for about the cost of fitting the largest forest.
     
-    # Create new "Work From Home Participation Rate" vector to ensure consistency across regions
-    # Base this off population who worked from home divided by total population in the region
-    df_travel[response_vector] = (df_travel['Method of Travel to Work by Sex|Worked_at_home']/
-                                  df_travel['Tot_P_P'])
-    # Drop the original absolute values column
-    df_travel = df_travel.drop(['Method of Travel to Work by Sex|Worked_at_home'], axis=1)
+    INPUTS
+    X - Pandas dataframe. The features to train on.
+    y - Pandas series. The response vector.
+    n_estimators_list - List of Ints. Optional tree count checkpoints, defaults to the n_estimators of the grid
+    wide_grid - Boolean. Search the wider wide_search_parameters grid rather than search_parameters
+    scoring - String. 'cv' to score R2 on each of cv validation folds or 'oob' for the out-of-bag R2 score of a 
+                forest grown on all of X (no folds, so cheaper again)
+    cv - Int. Number of cross validation folds for the 'cv' scoring
+    n_jobs - Int. Number of parallel jobs, one per parameter set and fold (-1 for all cores)
+    curve_path - String. Optional path of a csv file to write the n_estimators curve to
     
-    # load input vectors
-    input_vectors = load_tables_specify_cats(load_tables, load_features, statistical_area_code=stat_a_level)
+    OUTPUTS
+    model - SKLearn Pipeline object with the best scoring parameters, fitted to all of X
+    curve - Pandas dataframe of the score for each parameter set, fold and n_estimators checkpoint
+    '''
+    parameters = wide_search_parameters if wide_grid else search_parameters
+    n_estimators_list = sorted(n_estimators_list or parameters['clf__n_estimators'])
+    parameter_sets = list(ParameterGrid({k.replace('clf__', ''): v for k, v in parameters.items() 
+                                         if k != 'clf__n_estimators'}))
+    
+    X_values, y_values = np.asarray(X, dtype=np.float64), np.asarray(y)
+    if scoring == 'oob':
+        splits = [(np.arange(len(y_values)), None)]
+    elif scoring == 'cv':
+        splits = list(KFold(n_splits=cv).split(X_values))
+    else:
+        raise ValueError('Unknown scoring {}, expected cv or oob'.format(scoring))
+    
+    tasks = [(params, fold, train, test) for params in parameter_sets for fold, (train, test) in enumerate(splits)]
+    scores = Parallel(n_jobs=n_jobs)(
+        delayed(_grow_forest_curve)(X_values[train], y_values[train], 
+                                    None if test is None else X_values[test], None if test is None else y_values[test],
+                                    params, n_estimators_list, scoring == 'oob') 
+        for params, fold, train, test in tasks)
+    
+    curve = pd.DataFrame([dict(params, fold=fold, n_estimators=n_estimators, score=score) 
+                          for (params, fold, _, _), task_scores in zip(tasks, scores) 
+                          for n_estimators, score in zip(n_estimators_list, task_scores)])
+    
+    # pick the best parameters on the mean score across folds and refit on all the data
+    keys = list(parameter_sets[0].keys()) + ['n_estimators']
+    mean_scores = curve.groupby(keys)['score'].mean()
+    best_params = dict(zip(keys, np.atleast_1d(mean_scores.idxmax()).tolist()))
+    model = build_model().estimator.set_params(**{'clf__' + k: v for k, v in best_params.items()})
+    model.fit(X, y)
+    
+    if curve_path is not None:
+        curve.to_csv(curve_path, index=False)
+    
+    return model, curve
+
+
+def fit_model(X, y, search = 'grid', n_jobs = None, memory = None, wide_grid = False, time_budget = None, 
+              curve_path = None, verbosity = 3):
+    '''
+    Splits a feature set and response vector into training and testing sets and trains a Random Forest Regression 
+    model (including gridsearch functions) on the training set.
     
-    # Remove duplicate column values
-    input_vectors = input_vectors.T.drop_duplicates().T
+    INPUTS
+    X - Pandas dataframe. The features to train on.
+    y - Pandas series. The response vector.
+    search, n_jobs, memory, wide_grid - Optional, see build_model. search may also be 'warm_start', see warm_start_search
+    time_budget - Float. Optional wall clock time budget for the search in seconds, see budgeted_search
+    curve_path - String. Optional path of a csv file to write the score by n_estimators curve to, for the 
+                    'warm_start' search only
+    verbosity - Int. Verbosity of the search object, see build_model
+    
+    OUTPUTS
+    grid_fit.best_estimator_ - SKLearn Pipeline object. The best grid-fit model in training the data.
+    X_train, X_test, y_train, y_test - the training and testing splits of the data
+    '''
+    # Split the 'features' and 'response' vectors into training and testing sets
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size = 0.2, random_state = 42)
 
-    # Bring in total population field and scale all the values by this item
-    input_vectors = input_vectors.merge(df_pop, left_index=True, right_index=True)
+    if search == 'warm_start':
+        model, curve = warm_start_search(X_train, y_train, wide_grid = wide_grid, n_jobs = n_jobs, 
+                                         curve_path = curve_path)
+        return model, X_train, X_test, y_train, y_test
 
-    # convert input features to numeric
-    cols = input_vectors.columns
-    input_vectors[cols] = input_vectors[cols].apply(pd.to_numeric, errors='coerce')
+    if time_budget is not None:
+        grid_fit = budgeted_search(X_train, y_train, time_budget, search, n_jobs, memory, wide_grid, 
+                                   verbosity = verbosity)
+        return grid_fit.best_estimator_, X_train, X_test, y_train, y_test
 
-    # Drop rows with zero population
-    input_vectors = input_vectors.dropna(subset=['Tot_P_P'])
-    input_vectors = input_vectors[input_vectors['Tot_P_P'] > 0]
+    # build a model using all the above inputs
+    grid_obj = build_model(verbosity = verbosity, search = search, n_jobs = n_jobs, memory = memory, wide_grid = wide_grid)
 
-    # Scale all factors by total region population
-    for cols in input_vectors.columns:
-        if 'Tot_P_P' not in cols:
-            input_vectors[cols] = input_vectors[cols]/input_vectors['Tot_P_P']
+    # TODO: Fit the grid search object to the training data and find the optimal parameters using fit()
+    grid_fit = grid_obj.fit(X_train, y_train)
 
-    # merge and drop na values from the response vector
-    df_travel = df_travel.merge(input_vectors, how='left', left_index=True, right_index=True)
-    df_travel = df_travel.dropna(subset=[response_vector])
+    # Get the estimator
+    return grid_fit.best_estimator_, X_train, X_test, y_train, y_test
 
-    df_travel = df_travel.drop([x for x in df_travel.columns if 'Tot_P_P' in x], axis=1)
 
-    # drop outliers based on the WFHPR column
-    # only use an upper bound for outlier detection in this case, based on 3-sigma variation 
-    # had previously chosen to remove columns based on IQR formula, but given the skew in the data this was not effective
-    #drop_cutoff = (((df_travel[response_vector].quantile(0.75)-df_travel[response_vector].quantile(0.25))*1.5)
-    #               +df_travel[response_vector].quantile(0.75))
-    drop_cutoff = df_travel[response_vector].mean() + (3* df_travel[response_vector].std())
-    df_travel = df_travel[df_travel[response_vector] <= drop_cutoff]
+def model_target(target_measure, denominator, stat_a_level, load_tables, load_features, response_name=None, 
+                 model_name=None, search='grid', curve_path=None):
+    '''
+    A function which compiles a set of background information from defined ABS census tables and trains a 
+    Random Forest Regression model (including cleaning and gridsearch functions) to predict any census measure
+    as a proportion of a denominator (e.g. total population) in a given region.
     
-    # Remove duplicate column values
-    df_travel = df_travel.T.drop_duplicates().T
-
-    # Create X & y
-    X = df_travel.drop(response_vector, axis=1)
-    y = df_travel[response_vector]
-
-    # Get the estimator
-    return X, y
+    INPUTS
+    target_measure - the measure to predict, see table_funcs.create_Xy for the accepted forms
+    denominator - Tuple of (DataPack file, Short column name) or a key of table_funcs.denominators (e.g. 'persons')
+    stat_a_level - String. The statistical area level of information the data should be drawn from (SA1-3)
+    load_tables - List of Strings. A list of ABS census datapack tables to draw data from (G01-59)
+    load_features - List of Strings. A list of population characteristics to use in analysis (Age, Sex, labor force status, etc.)
+    response_name - String. Optional name for the response vector
+    model_name - String. Optional name to save the fitted model to the model registry under, with its test set R2 
+                    score and fit time
+    search - String. The hyperparameter search to use, see fit_model
+    curve_path - String. Optional path to write the n_estimators curve of a 'warm_start' search to, see fit_model
+    
+    OUTPUTS
+    grid_fit.best_estimator_ - SKLearn Pipeline object. The best grid-fit model in training the data.
+    X_train, X_test, y_train, y_test - the training and testing splits of the data
+    '''
+    X, y = create_Xy(target_measure, denominator, load_tables, load_features, stat_a_level, response_name=response_name)
+    start = time.perf_counter()
+    model, X_train, X_test, y_train, y_test = fit_model(X, y, search=search, curve_path=curve_path)
+    
+    if model_name is not None:
+        model_registry.register_model(model_name, model, X_train, y_train, stat_a_level, 
+                                      metrics={'r2': r2_score(y_test, model.predict(X_test))}, 
+                                      fit_time=time.perf_counter() - start, tables=load_tables, 
+                                      categories=load_features, target=target_measure, denominator=denominator)
+    
+    return model, X_train, X_test, y_train, y_test
 
 
 def model_WFH(stat_a_level, load_tables, load_features):
@@ -303,18 +320,82 @@ def model_WFH(stat_a_level, load_tables, load_features):
     
     # Create X & y
     X, y = WFH_create_Xy(stat_a_level, load_tables, load_features)
+    return fit_model(X, y)
 
-    # Split the 'features' and 'response' vectors into training and testing sets
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size = 0.2, random_state = 42)
 
-    # build a model using all the above inputs
-    grid_obj = build_model()
-
-    # TODO: Fit the grid search object to the training data and find the optimal parameters using fit()
-    grid_fit = grid_obj.fit(X_train, y_train)
-
-    # Get the estimator
-    return grid_fit.best_estimator_, X_train, X_test, y_train, y_test
+def _fit_target(X, y, rows, feature_names, n_top_features):
+    '''
+    Fits a model to the given rows of a (possibly memory mapped) feature array for model_targets, 
+    returning the fitted model and a summary of its performance.
+    '''
+    start = time.perf_counter()
+    X_train, X_test, y_train, y_test = train_test_split(X[rows], y[rows], test_size = 0.2, random_state = 42)
+    grid_fit = build_model(verbosity = 0).fit(X_train, y_train)
+    model = grid_fit.best_estimator_
+    fit_time = time.perf_counter() - start
+    
+    # the imputer drops features with no values, so match the importances to the remaining feature names
+    kept = ~np.isnan(model.named_steps['impute'].statistics_)
+    importances = pd.Series(model.named_steps['clf'].feature_importances_, index=np.asarray(feature_names)[kept])
+    
+    return {'model': model,
+            'n_samples': len(rows),
+            'r2': r2_score(y_test, model.predict(X_test), multioutput='raw_values'),
+            'best_params': grid_fit.best_params_,
+            'fit_time': fit_time,
+            'top_features': importances.nlargest(n_top_features).index.tolist()}
+
+
+def model_targets(target_measures, denominator, stat_a_level, load_tables, load_features, multi_output=False, 
+                  n_jobs=-1, n_top_features=10, outlier_sigma=3, results_path=None):
+    '''
+    Trains a Random Forest Regression model (including cleaning and gridsearch functions) for each of several census
+    measures against the same feature set. The features are loaded and scaled once, and the per-target fits run in
+    parallel worker processes which share the feature array through a read-only memory map rather than a copy each.
+    
+    INPUTS
+    target_measures - List of target measures to predict, see table_funcs.create_Xy for the accepted forms
+    denominator - Tuple of (DataPack file, Short column name) or a key of table_funcs.denominators (e.g. 'persons')
+    stat_a_level - String. The statistical area level of information the data should be drawn from (SA1-3)
+    load_tables - List of Strings. A list of ABS census datapack tables to draw data from (G01-59)
+    load_features - List of Strings. A list of population characteristics to use in analysis (Age, Sex, labor force status, etc.)
+    multi_output - Boolean. Fit a single multi-output RandomForest to all targets, using the regions which are valid 
+                    (and not outliers) for every target. Suited to related targets, e.g. the categories of one table.
+    n_jobs - Int. Number of parallel worker processes for the per-target fits (-1 for all cores)
+    n_top_features - Int. Number of most important features to report for each target
+    outlier_sigma - Float. Responses more than this many standard deviations above the mean are dropped, None to keep all
+    results_path - String. Optional path of a csv file to write the results table to
+    
+    OUTPUTS
+    results - Pandas dataframe indexed by target with the number of regions modelled, test set R2 score, best 
+                gridsearch parameters, fit time (seconds) and top features for each target.
+    models - Dictionary of target: fitted SKLearn Pipeline object. With multi_output the same model is returned 
+                for every target, predicting the targets in the order of the results index.
+    '''
+    X, Y = create_multi_Xy(target_measures, denominator, load_tables, load_features, stat_a_level)
+    feature_names = X.columns.tolist()
+    X_values = np.ascontiguousarray(X.values)
+    masks = [target_row_mask(Y[col], outlier_sigma).values for col in Y.columns]
+    
+    if multi_output:
+        rows = np.flatnonzero(np.logical_and.reduce(masks))
+        fit = _fit_target(X_values, Y.values, rows, feature_names, n_top_features)
+        fits = [dict(fit, r2=fit['r2'][i]) for i in range(Y.shape[1])]
+    else:
+        # joblib memory maps arrays above max_nbytes so each worker reads the one copy of the features
+        fits = Parallel(n_jobs=n_jobs, max_nbytes='1M', mmap_mode='r')(
+            delayed(_fit_target)(X_values, Y[col].values, np.flatnonzero(mask), feature_names, n_top_features)
+            for col, mask in zip(Y.columns, masks))
+        fits = [dict(fit, r2=fit['r2'][0]) for fit in fits]
+    
+    models = {col: fit.pop('model') for col, fit in zip(Y.columns, fits)}
+    results = pd.DataFrame(fits, index=Y.columns)
+    results.index.name = 'Target'
+    
+    if results_path is not None:
+        results.to_csv(results_path)
+    
+    return results, models
 
 
 def sort_series_abs(S):
@@ -327,7 +408,7 @@ def sort_series_abs(S):
 
 '''Plotting functions'''
 
-def feature_plot_h(model, X_train, n_features):
+def feature_plot_h(model, X_train, n_features, attributions=None, measure='Permutation', pipeline=None):
     '''
     Takes a trained model and outputs a horizontal bar chart showing the "importance" of the
     most impactful n features.
@@ -336,8 +417,13 @@ def feature_plot_h(model, X_train, n_features):
     model = Trained model in sklearn with  variable ".feature_importances_". Trained supervised learning model.
     X_train = Pandas Dataframe object. Feature set the training was completed using.
     n_features = Int. Top n features you would like to plot.
+    attributions = Optional Pandas Dataframe. A feature attribution summary (see compute_attributions) to plot 
+                    instead of the impurity based importances.
+    measure = String. The attribution summary column to plot.
+    pipeline = Optional, sklearn pipeline object the model was trained in, to match its importances to X_train's 
+                columns where the pipeline drops features.
     '''
-    importances = model.feature_importances_
+    importances = model_importances(model, X_train, attributions, measure, pipeline)
     # Identify the n most important features
     indices = np.argsort(importances)[::-1]
     columns = X_train.columns.values[indices[:n_features]]
@@ -362,76 +448,228 @@ def feature_plot_h(model, X_train, n_features):
     plt.show()  
 
     
-def feature_impact_plot(model, X_train, n_features, y_label, pipeline=None, consistent_X=False, share_y = True):
+def predict_feature_grid(predict, X_values, col_index, values, shift=False, max_batch_cells=2**24, columns=None):
     '''
-    Takes a trained model and training dataset and synthesises the impacts of the top n features
-    to show their relationship to the response vector (i.e. how a change in the feature changes
-    the prediction). Returns n plots showing the variance for min, max, median, 1Q and 3Q.
+    Predicts every row of X_values with one feature set to (or shifted by) each of a list of values, stacking the 
+    copies of X_values into batched predict calls.
+    
+    INPUTS
+    predict = Function. The predict method of a trained model or pipeline.
+    X_values = Numpy array of the rows to predict.
+    col_index = Int. Position of the feature to change.
+    values = Numpy array of the values to set the feature to.
+    shift = Boolean. Add the values to the feature rather than replacing it.
+    max_batch_cells = Int. Maximum size (rows x features) of each stacked predict call, to bound memory use.
+    columns = Optional list of column names, to predict on dataframes for models fitted with feature names.
+    
+    OUTPUT
+    Numpy array of predictions with one row per value and one column per row of X_values.
+    '''
+    n_rows = X_values.shape[0]
+    batch_copies = max(1, max_batch_cells // X_values.size)
+    
+    predictions = []
+    for i in range(0, len(values), batch_copies):
+        batch_values = np.repeat(values[i:i + batch_copies], n_rows)
+        stacked = np.tile(X_values, (len(batch_values) // n_rows, 1))
+        if shift:
+            stacked[:, col_index] += batch_values
+        else:
+            stacked[:, col_index] = batch_values
+        if columns is not None:
+            stacked = pd.DataFrame(stacked, columns=columns)
+        predictions.append(predict(stacked).reshape(-1, n_rows))
+    return np.vstack(predictions)
+
+
+def feature_sensitivity(model, X_train, n_features, pipeline=None, consistent_X=False, sample_size=1000, 
+                        max_batch_cells=2**24):
+    '''
+    Takes a trained model and training dataset and simulates the impacts of the top n features on the response
+    vector: each feature is shifted by about 100 offsets across +/- 1.5 standard deviations and the change in
+    the min, 1Q, median, 3Q and max of the predictions is recorded. All shifted copies of the sample for a feature 
+    are stacked into batched predict calls.
     
     INPUTS
     model = Trained model in sklearn with  variable ".feature_importances_". Trained supervised learning model.
     X_train = Pandas Dataframe object. Feature set the training was completed using.
-    n_features = Int. Top n features you would like to plot.
-    y_label = String. Description of response variable for axis labelling.
+    n_features = Int. Top n features you would like to simulate.
     pipeline = Optional, sklearn pipeline object. If the sklearn model was compiled using a pipeline, 
                 this object needs to be specified separately.
-    consistent_X = Optional Boolean. Input True to specify if the range of simulated feature ranges should be consistent.
-                        this makes the impact charts easier to compare between features where they have consistent 
-                        units of meaure (e.g. share of population).
-    share_y = Optional Boolean. Have a shared y-axis for all sub plots. Very good for comparing impacts of changes to 
-                individual features, but can make distinguishing the impacts of a feature difficult if there is 
-                significant variance in other plots.
+    consistent_X = Optional Boolean. Input True to use the same range of simulated values for every feature.
+    sample_size = Int. Number of training rows to sample for the simulation.
+    max_batch_cells = Int. Maximum size (rows x features) of each stacked predict call, to bound memory use.
     
     OUTPUT
-    Plot with n subplots showing the variance for min, max, median, 1Q and 3Q as a result of simulated outcomes.
+    Pandas dataframe with columns 'Value' (the simulated change to the feature), 'Feature' and the proportional
+    change of the 0, 25, 50, 75 and 100th percentiles of the predictions from the base predictions.
     '''
-    # Display the n most important features
-    indices = np.argsort(model.feature_importances_)[::-1]
+    # Display the n most important features, aligning the importances to X_train's columns as the pipeline may have
+    # dropped some before the model
+    indices = np.argsort(model_importances(model, X_train, pipeline=pipeline))[::-1]
     columns = X_train.columns.values[indices[:n_features]]
     
-    sim_var = [[]]
-    
-    if pipeline == None:
-        pipeline=model
+    if pipeline is None:
+        pipeline = model
     
     # get statistical descriptors
     X_descriptor = X_train[columns].describe()
     
     # Shorten the simulated outcomes for efficiency
-    sample_length = min(X_train.shape[0], 1000)
-    
+    sample_length = min(X_train.shape[0], sample_size)
     X_train = X_train.sample(sample_length, random_state=42)
+    X_values = X_train.values.astype(np.float64)
+    
+    percentile_steps = list(range(0,101,25))
+    base_pred = pipeline.predict(X_train)
+    # Add percentiles of base predictions for use in reporting
+    base_percentiles = np.percentile(base_pred, percentile_steps)
     
     if consistent_X:
         value_dispersion = X_descriptor.loc['std',:].max()
     
+    frames = []
     for col in columns:
-        base_pred = pipeline.predict(X_train)
-        # Add percentiles of base predictions to a df for use in reporting
-        base_percentiles = [np.percentile(base_pred, pc) for pc in range(0,101,25)]
-
-        # Create new predictions based on tweaking the parameter
-        # copy X, resetting values to align to the base information through different iterations
-        df_copy = X_train.copy() 
-        
         if consistent_X != True:
             value_dispersion = X_descriptor.loc['std',col] * 1.5
+        offsets = np.arange(-value_dispersion, value_dispersion, value_dispersion/50)
+        
+        # Create new predictions for each offset to the feature, stacking the copies of the sample
+        predictions = predict_feature_grid(pipeline.predict, X_values, X_train.columns.get_loc(col), offsets, 
+                                           shift=True, max_batch_cells=max_batch_cells, columns=X_train.columns)
+        
+        # percentiles of each offset's predictions, as variances from the base predictions
+        percentiles = np.percentile(predictions, percentile_steps, axis=1).T
+        percentiles = (percentiles - base_percentiles) / base_percentiles
+        
+        df_feature = pd.DataFrame(percentiles, columns=percentile_steps)
+        df_feature.insert(0, 'Feature', col)
+        df_feature.insert(0, 'Value', offsets)
+        frames.append(df_feature)
+    
+    return pd.concat(frames, ignore_index=True)
 
-        for val in np.arange(-value_dispersion, value_dispersion, value_dispersion/50):
-            df_copy[col] = X_train[col] + val
-            # Add new predictions based on changed database
-            predictions = pipeline.predict(df_copy)
-            
-            # Add percentiles of these predictions to a df for use in reporting
-            percentiles = [np.percentile(predictions, pc) for pc in range(0,101,25)]
-            
-            # Add variances between percentiles of these predictions and the base prediction to a df for use in reporting
-            percentiles = list(map(operator.sub, percentiles, base_percentiles))
-            percentiles = list(map(operator.truediv, percentiles, base_percentiles))
-            sim_var.append([val, col] + percentiles)
 
-    # Create a dataframe based off the arrays created above
-    df_predictions = pd.DataFrame(sim_var,columns = ['Value','Feature']+[0,25,50,75,100])
+def is_tree_model(model):
+    '''Returns True for fitted sklearn decision trees and ensembles of decision trees (e.g. RandomForestRegressor)'''
+    trees = np.ravel(getattr(model, 'estimators_', [model]))
+    return len(trees) > 0 and all(hasattr(tree, 'tree_') for tree in trees)
+
+
+def tree_split_points(model, col_index):
+    '''Returns the distinct thresholds a fitted tree model splits a feature on, in ascending order'''
+    trees = np.ravel(getattr(model, 'estimators_', [model]))
+    return np.unique(np.concatenate([tree.tree_.threshold[tree.tree_.feature == col_index] for tree in trees]))
+
+
+def partial_dependence_curves(model, X_train, features, pipeline=None, kind='average', sample_size=1000, 
+                              max_points=None, grid_resolution=100):
+    '''
+    Computes partial dependence (the average prediction) or individual conditional expectation (ICE, the prediction 
+    for each row) curves for features of a trained model, for serving or plotting.
+    
+    For decision tree models (e.g. RandomForestRegressor) the predictions can only change where the trees split on
+    the feature, so the curve is evaluated once between each pair of consecutive split thresholds (and at the 
+    ends of the feature's range), which gives the exact step curve. The pipeline's earlier steps (e.g. imputation) 
+    are applied once and the trees are evaluated on the transformed rows directly. 'average' curves are computed 
+    by walking the trees (sklearn's partial_dependence with method='recursion'), which averages over the training
+    rows held in each tree's nodes without predicting any rows; 'individual' curves predict each sampled row.
+    Other models fall back to batched predictions at grid_resolution points between the 5th and 95th percentiles.
+    
+    INPUTS
+    model = Trained model in sklearn. Trained supervised learning model.
+    X_train = Pandas Dataframe object. Feature set the training was completed using.
+    features = List of Strings. The features to compute curves for.
+    pipeline = Optional, sklearn pipeline object. If the sklearn model was compiled using a pipeline, 
+                this object needs to be specified separately.
+    kind = String. 'average' for partial dependence or 'individual' for ICE curves.
+    sample_size = Int. Number of training rows to sample for the curves (and the feature's range for tree models).
+    max_points = Optional Int. Maximum number of points per curve for tree models, spread evenly over the split 
+                    points. Defaults to every step of the curve.
+    grid_resolution = Int. Number of points per curve for other models.
+    
+    OUTPUT
+    Pandas dataframe with columns 'Feature', 'Value' and 'Prediction', and a 'Row' column holding the region for
+    'individual' curves.
+    '''
+    if kind not in ('average', 'individual'):
+        raise ValueError('Unknown kind {}, expected average or individual'.format(kind))
+    if pipeline is None:
+        pipeline = model
+    
+    sample_length = min(X_train.shape[0], sample_size)
+    X_train = X_train.sample(sample_length, random_state=42)
+    
+    tree_model = is_tree_model(model)
+    if tree_model:
+        if pipeline is model:
+            X_model, model_columns = X_train.values.astype(np.float64), list(X_train.columns)
+        else:
+            transform = pipeline[:-1]
+            X_model = np.asarray(transform.transform(X_train), dtype=np.float64)
+            model_columns = list(transform.get_feature_names_out(X_train.columns))
+        predict, columns = model.predict, None
+    else:
+        X_model, model_columns = X_train.values.astype(np.float64), list(X_train.columns)
+        predict, columns = pipeline.predict, X_train.columns
+    
+    frames = []
+    for col in features:
+        col_index = model_columns.index(col)
+        low, high = np.nanmin(X_model[:, col_index]), np.nanmax(X_model[:, col_index])
+        if tree_model:
+            thresholds = tree_split_points(model, col_index)
+            thresholds = thresholds[(thresholds >= low) & (thresholds < high)]
+            # one point within each step of the tree predictions
+            values = np.unique(np.concatenate([[low], (thresholds[:-1] + thresholds[1:]) / 2, [high]]))
+            if max_points is not None and len(values) > max_points:
+                values = np.unique(values[np.linspace(0, len(values) - 1, max_points).round().astype(int)])
+        else:
+            values = np.linspace(*np.nanpercentile(X_model[:, col_index], [5, 95]), grid_resolution)
+        
+        if tree_model and kind == 'average':
+            result = partial_dependence(model, X_model, [col_index], custom_values={col_index: values}, 
+                                        method='recursion', kind='average')
+            df_feature = pd.DataFrame({'Value': result['grid_values'][0], 'Prediction': result['average'][0]})
+        elif kind == 'average':
+            predictions = predict_feature_grid(predict, X_model, col_index, values, columns=columns)
+            df_feature = pd.DataFrame({'Value': values, 'Prediction': predictions.mean(axis=1)})
+        else:
+            predictions = predict_feature_grid(predict, X_model, col_index, values, columns=columns)
+            df_feature = pd.DataFrame({'Value': np.repeat(values, sample_length), 
+                                       'Row': np.tile(X_train.index.values, len(values)),
+                                       'Prediction': predictions.ravel()})
+        df_feature.insert(0, 'Feature', col)
+        frames.append(df_feature)
+    
+    return pd.concat(frames, ignore_index=True)
+
+
+def feature_impact_plot(model, X_train, n_features, y_label, pipeline=None, consistent_X=False, share_y = True):
+    '''
+    Takes a trained model and training dataset and synthesises the impacts of the top n features
+    to show their relationship to the response vector (i.e. how a change in the feature changes
+    the prediction). Returns n plots showing the variance for min, max, median, 1Q and 3Q.
+    
+    INPUTS
+    model = Trained model in sklearn with  variable ".feature_importances_". Trained supervised learning model.
+    X_train = Pandas Dataframe object. Feature set the training was completed using.
+    n_features = Int. Top n features you would like to plot.
+    y_label = String. Description of response variable for axis labelling.
+    pipeline = Optional, sklearn pipeline object. If the sklearn model was compiled using a pipeline, 
+                this object needs to be specified separately.
+    consistent_X = Optional Boolean. Input True to specify if the range of simulated feature ranges should be consistent.
+                        this makes the impact charts easier to compare between features where they have consistent 
+                        units of meaure (e.g. share of population).
+    share_y = Optional Boolean. Have a shared y-axis for all sub plots. Very good for comparing impacts of changes to 
+                individual features, but can make distinguishing the impacts of a feature difficult if there is 
+                significant variance in other plots.
+    
+    OUTPUT
+    Plot with n subplots showing the variance for min, max, median, 1Q and 3Q as a result of simulated outcomes.
+    '''
+    df_predictions = feature_sensitivity(model, X_train, n_features, pipeline, consistent_X)
+    columns = df_predictions['Feature'].unique()
     
     # Create a subplot object based on the number of features
     num_cols = 2
@@ -521,7 +759,7 @@ def model_analyse(y_test, y_pred):
     plt.text(y_test.max()/5, y_test.max()*1.1, 'R2 Score: {:.3f}'.format(r2_score(y_test, y_pred)))
     plt.show()
     
-def top_n_features(model, X_train, n_features):
+def top_n_features(model, X_train, n_features, attributions=None, measure='Permutation', pipeline=None):
     '''
     Takes a trained model and training dataset and returns the top n features by feature importance
     
@@ -529,9 +767,227 @@ def top_n_features(model, X_train, n_features):
     model = Trained model in sklearn with  variable ".feature_importances_". Trained supervised learning model.
     X_train = Pandas Dataframe object. Feature set the training was completed using.
     n_features = Int. Top n features you would like to plot.
+    attributions = Optional Pandas Dataframe. A feature attribution summary (see compute_attributions) to rank by
+                    instead of the impurity based importances.
+    measure = String. The attribution summary column to rank by.
+    pipeline = Optional, sklearn pipeline object the model was trained in, to match its importances to X_train's 
+                columns where the pipeline drops features.
     '''
     # Display the n most important features
-    indices = np.argsort(model.feature_importances_)[::-1]
+    indices = np.argsort(model_importances(model, X_train, attributions, measure, pipeline))[::-1]
     columns = X_train.columns.values[indices[:n_features]].tolist()
     
-    return columns
\ No newline at end of file
+    return columns
+
+
+'''Feature attribution functions'''
+
+def model_feature_names(X, pipeline=None):
+    '''
+    Returns the names of the features the final model of a pipeline is trained on. The imputer drops features 
+    with no values, so these can be fewer than the columns of X.
+    '''
+    if pipeline is None or not hasattr(pipeline, 'steps') or len(pipeline.steps) < 2:
+        return X.columns
+    return pd.Index(pipeline[:-1].get_feature_names_out(X.columns))
+
+
+def model_importances(model, X_train, attributions=None, measure='Permutation', pipeline=None):
+    '''
+    Returns an array of feature importances aligned to the columns of X_train, either the model's impurity based
+    ".feature_importances_" or a column of a feature attribution summary (see compute_attributions). Features the
+    pipeline dropped before the model get an importance of 0.
+    '''
+    if attributions is None:
+        importances = pd.Series(model.feature_importances_, index=model_feature_names(X_train, pipeline))
+        return importances.reindex(X_train.columns).fillna(0).values
+    return attributions[measure].reindex(X_train.columns).fillna(0).values
+
+
+def _permuted_score(pipeline, X_values, y_values, columns, col_index, seed):
+    '''Scores a pipeline on a copy of a (possibly memory mapped) test matrix with one feature shuffled'''
+    X_permuted = np.array(X_values)
+    X_permuted[:, col_index] = np.random.RandomState(seed).permutation(X_permuted[:, col_index])
+    return r2_score(y_values, pipeline.predict(pd.DataFrame(X_permuted, columns=columns)))
+
+
+def permutation_importances(pipeline, X_test, y_test, n_repeats=5, n_jobs=-1, random_state=42, features=None):
+    '''
+    Calculates the permutation importance of features: the drop in the R2 score of the test set when the feature's 
+    values are shuffled between regions. Each feature and repeat is scored as a separate parallel task, with the
+    workers sharing one read-only memory map of the test matrix.
+    
+    INPUTS
+    pipeline = Trained sklearn model or pipeline object.
+    X_test = Pandas Dataframe object. The test set of characteristics.
+    y_test = Pandas Series. The test set of responses.
+    n_repeats = Int. Number of times each feature is shuffled.
+    n_jobs = Int. Number of parallel worker processes (-1 for all cores).
+    random_state = Int. Seed for the shuffles.
+    features = Optional list of Strings. The features to score, defaults to all features.
+    
+    OUTPUT
+    Pandas dataframe indexed by feature with the mean and standard deviation of the importance, sorted by the mean
+    '''
+    features = list(X_test.columns) if features is None else list(features)
+    X_values, y_values = np.ascontiguousarray(X_test.values, dtype=np.float64), np.asarray(y_test)
+    base_score = r2_score(y_values, pipeline.predict(X_test))
+    
+    seeds = np.random.RandomState(random_state).randint(np.iinfo(np.int32).max, size=(len(features), n_repeats))
+    scores = Parallel(n_jobs=n_jobs, max_nbytes='1M', mmap_mode='r')(
+        delayed(_permuted_score)(pipeline, X_values, y_values, X_test.columns, X_test.columns.get_loc(col), seed)
+        for col, col_seeds in zip(features, seeds) for seed in col_seeds)
+    importances = base_score - np.array(scores).reshape(len(features), n_repeats)
+    
+    df_importance = pd.DataFrame({'Permutation': importances.mean(axis=1), 
+                                  'Permutation std': importances.std(axis=1)}, index=pd.Index(features, name='Feature'))
+    return df_importance.sort_values('Permutation', ascending=False)
+
+
+def _saabas_contributions(tree, X_values):
+    '''
+    Attributes a decision tree's predictions to features by following each row's path through the tree and 
+    crediting the change in node value at each split to the feature split on (Saabas' method).
+    '''
+    tree_ = tree.tree_
+    values = tree_.value[:, 0, 0]
+    
+    # the parent of each node, and the feature it was split on
+    internal = np.flatnonzero(tree_.children_left >= 0)
+    parents = np.full(tree_.node_count, -1)
+    parents[tree_.children_left[internal]] = internal
+    parents[tree_.children_right[internal]] = internal
+    children = np.flatnonzero(parents >= 0)
+    
+    # node by feature matrix of the change in value from the parent, so a row's path sums to its contributions
+    node_deltas = sparse.csr_matrix((values[children] - values[parents[children]], 
+                                     (children, tree_.feature[parents[children]])), 
+                                    shape=(tree_.node_count, X_values.shape[1]))
+    return np.asarray((tree.decision_path(X_values) @ node_deltas).todense()), values[0]
+
+
+def tree_contributions(model, X, pipeline=None):
+    '''
+    Calculates per-region feature contributions for a tree model (e.g. RandomForestRegressor), such that the bias 
+    plus the sum of a region's contributions is the region's prediction. Uses exact TreeSHAP values where shap is 
+    installed and otherwise the Saabas path contributions, which are fast but not exact Shapley values.
+    
+    INPUTS
+    model = Trained single output sklearn tree model.
+    X = Pandas Dataframe object. The regions to attribute.
+    pipeline = Optional, sklearn pipeline object. If the sklearn model was compiled using a pipeline, 
+                this object needs to be specified separately.
+    
+    OUTPUT
+    contributions - Pandas dataframe with the contributions of each feature (columns) to each region (rows). 
+                    Features the pipeline dropped before the model contribute 0.
+    bias - Float. The expected prediction before any features are considered
+    '''
+    if pipeline is None or pipeline is model:
+        X_model = X.values.astype(np.float64)
+    else:
+        X_model = np.asarray(pipeline[:-1].transform(X), dtype=np.float64)
+    columns = model_feature_names(X, pipeline)
+    
+    if shap is not None:
+        explainer = shap.TreeExplainer(model)
+        contributions, bias = explainer.shap_values(X_model), np.ravel(explainer.expected_value)[0]
+    else:
+        trees = np.ravel(getattr(model, 'estimators_', [model]))
+        X_model = X_model.astype(np.float32)
+        tree_results = [_saabas_contributions(tree, X_model) for tree in trees]
+        contributions = sum(x[0] for x in tree_results) / len(trees)
+        bias = sum(x[1] for x in tree_results) / len(trees)
+    
+    df_contributions = pd.DataFrame(contributions, index=X.index, columns=columns)
+    return df_contributions.reindex(columns=X.columns, fill_value=0.0), float(bias)
+
+
+def attribution_dir(model_name, data_path=cache_funcs.env_path):
+    '''Returns the directory a model's precomputed feature attributions are saved to'''
+    return os.path.join(data_path, 'Data', 'Cache', 'attributions', model_name)
+
+
+def save_attributions(model_name, summary, contributions=None, bias=None, data_path=cache_funcs.env_path):
+    '''Saves a model's feature attribution summary (and optionally per-region contributions) for the dashboard'''
+    save_dir = attribution_dir(model_name, data_path)
+    os.makedirs(save_dir, exist_ok=True)
+    frames = {'summary': summary, 'contributions': contributions}
+    manifest = {'format': cache_funcs.cache_format, 'bias': bias, 
+                'contribution_method': 'shap' if shap is not None else 'saabas', 'files': {}}
+    for name, df in frames.items():
+        if df is None:
+            continue
+        cache_file = '{}.{}'.format(name, cache_funcs.cache_format)
+        df_save = df.reset_index()
+        df_save.columns = [str(x) for x in df_save.columns]
+        cache_funcs.write_frame(df_save, os.path.join(save_dir, cache_file))
+        manifest['files'][name] = {'cache_file': cache_file, 'index_name': df.index.name}
+    with open(os.path.join(save_dir, 'attributions.json'), 'w') as f:
+        json.dump(manifest, f)
+
+
+def load_attributions(model_name, data_path=cache_funcs.env_path):
+    '''
+    Loads a model's precomputed feature attributions saved by compute_attributions.
+    
+    OUTPUT
+    Dictionary with the 'summary' dataframe, the 'contributions' dataframe (if saved), 'bias' and 'contribution_method',
+    or None if no attributions have been saved for the model.
+    '''
+    save_dir = attribution_dir(model_name, data_path)
+    try:
+        with open(os.path.join(save_dir, 'attributions.json')) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    loaded = {'bias': manifest['bias'], 'contribution_method': manifest['contribution_method'], 'contributions': None}
+    for name, details in manifest['files'].items():
+        df = cache_funcs.read_frame(os.path.join(save_dir, details['cache_file']), file_format=manifest['format'])
+        df = df.set_index(df.columns[0])
+        df.index.name = details['index_name']
+        loaded[name] = df
+    return loaded
+
+
+def compute_attributions(model, X_test, y_test, pipeline=None, model_name=None, n_repeats=5, n_jobs=-1, 
+                         contributions=True, data_path=cache_funcs.env_path):
+    '''
+    Computes a feature attribution summary for a trained model, combining the impurity based importances, 
+    permutation importances and the mean absolute per-region contributions, and saves the results to disk so the 
+    dashboard can load them rather than recomputing them.
+    
+    INPUTS
+    model = Trained model in sklearn. Trained supervised learning model.
+    X_test = Pandas Dataframe object. The test set of characteristics.
+    y_test = Pandas Series. The test set of responses.
+    pipeline = Optional, sklearn pipeline object. If the sklearn model was compiled using a pipeline, 
+                this object needs to be specified separately.
+    model_name = String. Optional name to save the attributions under, see load_attributions.
+    n_repeats = Int. Number of times each feature is shuffled for the permutation importances.
+    n_jobs = Int. Number of parallel worker processes for the permutation importances (-1 for all cores).
+    contributions = Boolean. Calculate per-region contributions, for tree models only.
+    data_path = String. The root folder containing the "Data" folder.
+    
+    OUTPUT
+    summary - Pandas dataframe indexed by feature of the 'Impurity', 'Permutation', 'Permutation std' and 
+                (for tree models) 'Mean abs contribution' measures, sorted by the permutation importance
+    df_contributions - Pandas dataframe of per-region contributions, or None
+    '''
+    if pipeline is None:
+        pipeline = model
+    
+    summary = permutation_importances(pipeline, X_test, y_test, n_repeats, n_jobs)
+    if hasattr(model, 'feature_importances_'):
+        summary['Impurity'] = pd.Series(model_importances(model, X_test, pipeline=pipeline), index=X_test.columns)
+    
+    df_contributions, bias = None, None
+    if contributions and is_tree_model(model):
+        df_contributions, bias = tree_contributions(model, X_test, pipeline)
+        summary['Mean abs contribution'] = df_contributions.abs().mean()
+    
+    if model_name is not None:
+        save_attributions(model_name, summary, df_contributions, bias, data_path)
+    
+    return summary, df_contributions
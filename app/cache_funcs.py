@@ -0,0 +1,454 @@
+import numpy as np
+import pandas as pd
+import os
+import json
+import hashlib
+import shutil
+import threading
+import importlib.util
+from collections import OrderedDict
+
+# pandas requires pyarrow to read and write feather files
+cache_format = 'feather' if importlib.util.find_spec('pyarrow') is not None else 'pickle'
+
+# Set a variable for current notebook's path for various loading/saving mechanisms
+td_path = os.path.dirname(os.path.realpath(__file__))
+env_path = os.path.dirname(td_path)
+
+# Statistical area levels which are read from the memory-mapped column store by default rather than the columnar cache
+mmap_area_levels = ['SA1']
+
+# Open memory-mapped columns, in the format {column file path: array}
+_mmap_arrays = {}
+
+
+'''DataPack columnar cache'''
+
+def datapack_csv_path(table, statistical_area_code, data_path=env_path):
+    '''Returns the path to the raw ABS DataPack csv for a table at a given statistical area level'''
+    return '{}\\Data\\{}\\AUST\\2016Census_{}_AUS_{}.csv'.format(data_path, statistical_area_code, table, statistical_area_code)
+
+
+def datapack_cache_dir(statistical_area_code, data_path=env_path):
+    '''Returns the directory holding cached copies of the DataPack files for a statistical area level'''
+    return os.path.join(data_path, 'Data', 'Cache', statistical_area_code)
+
+
+def _file_hash(path, block_size=1 << 20):
+    '''Returns the md5 hash of a file's contents, read in blocks to avoid holding the whole file in memory'''
+    file_hash = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def _read_manifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _temp_path(path):
+    # unique per process and thread, so concurrent writers of the same file don't share a temporary file
+    return '{}.{}-{}.tmp'.format(path, os.getpid(), threading.get_ident())
+
+
+def _write_manifest(manifest_path, manifest):
+    # write to a temporary file first so a reader never sees a partly written file
+    temp_path = _temp_path(manifest_path)
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, manifest_path)
+
+
+def source_is_current(source_path, manifest, manifest_path=None):
+    '''
+    Checks whether a cached file built from source_path is still valid. The source file's modified time and size
+    are checked first, and only if these have changed is the file re-hashed and compared to the hash it was built from.
+    If the contents are unchanged the manifest is updated with the new modified time so the hash isn't recomputed again.
+
+    INPUTS
+    source_path: STRING - path to the raw file the cache was built from
+    manifest: DICTIONARY - the manifest saved alongside the cached file
+    manifest_path: STRING - optional, where to save the manifest if its modified time needs updating
+
+    OUTPUTS
+    BOOLEAN - True if the cached file can be used
+    '''
+    if manifest is None:
+        return False
+    source_stat = os.stat(source_path)
+    if manifest['source_mtime'] == source_stat.st_mtime and manifest['source_size'] == source_stat.st_size:
+        return True
+    if manifest['source_size'] != source_stat.st_size or manifest['source_hash'] != _file_hash(source_path):
+        return False
+    manifest['source_mtime'] = source_stat.st_mtime
+    if manifest_path is not None:
+        _write_manifest(manifest_path, manifest)
+    return True
+
+
+def write_frame(df, path, file_format=None):
+    '''
+    Saves a dataframe in the columnar cache format (feather where pyarrow is available, otherwise pickle). The file
+    is written alongside and then moved into place, so other processes reading the path see the old or the new file
+    but never a partly written one.
+    '''
+    file_format = file_format or cache_format
+    temp_path = _temp_path(path)
+    if file_format == 'feather':
+        df.reset_index(drop=True).to_feather(temp_path)
+    else:
+        df.to_pickle(temp_path, compression=None)
+    os.replace(temp_path, path)
+
+
+def read_frame(path, columns=None, file_format=None):
+    '''Reads a dataframe saved by write_frame, reading only the specified columns where the format allows'''
+    file_format = file_format or cache_format
+    if file_format == 'feather':
+        return pd.read_feather(path, columns=columns)
+    df = pd.read_pickle(path)
+    if columns is not None:
+        df = df[columns]
+    return df
+
+
+def build_datapack_cache(table, statistical_area_code='SA3', data_path=env_path):
+    '''
+    Converts a raw DataPack csv into the columnar cache format, saving a manifest alongside it recording the source
+    file's modified time, size and hash, the format used, the region code column and the list of columns.
+
+    INPUTS
+    table: STRING - the ABS Census Datapack file to convert (e.g. G01, G09A)
+    statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
+    data_path: STRING - the root folder containing the "Data" folder
+
+    OUTPUTS
+    DICTIONARY - the manifest for the cached file
+    '''
+    statistical_area_code = statistical_area_code.upper()
+    source_path = datapack_csv_path(table, statistical_area_code, data_path)
+    cache_dir = datapack_cache_dir(statistical_area_code, data_path)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    df = pd.read_csv(source_path)
+
+    cache_file = '2016Census_{}_AUS_{}.{}'.format(table, statistical_area_code, cache_format)
+    write_frame(df, os.path.join(cache_dir, cache_file))
+
+    source_stat = os.stat(source_path)
+    manifest = {
+        'source_mtime': source_stat.st_mtime,
+        'source_size': source_stat.st_size,
+        'source_hash': _file_hash(source_path),
+        'format': cache_format,
+        'cache_file': cache_file,
+        'index_column': df.columns[0],
+        'columns': df.columns.tolist(),
+        }
+    _write_manifest(os.path.join(cache_dir, '2016Census_{}_AUS_{}.json'.format(table, statistical_area_code)), manifest)
+
+    return manifest
+
+
+def datapack_manifest(table, statistical_area_code='SA3', data_path=env_path):
+    '''Returns the manifest for a cached DataPack file, (re)building the cache if it is missing or out of date'''
+    statistical_area_code = statistical_area_code.upper()
+    manifest_path = os.path.join(datapack_cache_dir(statistical_area_code, data_path),
+                                 '2016Census_{}_AUS_{}.json'.format(table, statistical_area_code))
+    manifest = _read_manifest(manifest_path)
+    if not source_is_current(datapack_csv_path(table, statistical_area_code, data_path), manifest, manifest_path):
+        manifest = build_datapack_cache(table, statistical_area_code, data_path)
+    return manifest
+
+
+def read_datapack(table, statistical_area_code='SA3', columns=None, data_path=env_path, use_mmap=None):
+    '''
+    Reads a DataPack file through the columnar cache, building the cached copy on first use or when the raw csv
+    has changed.
+
+    INPUTS
+    table: STRING - the ABS Census Datapack file to read (e.g. G01, G09A)
+    statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
+    columns: LIST of STRING objects - optional, the measures to read. The region code column is always included
+        as the first column. Measures not in the file are ignored.
+    data_path: STRING - the root folder containing the "Data" folder
+    use_mmap: BOOLEAN - optional, whether to read from the memory-mapped column store instead of the columnar cache.
+        Defaults to True for the levels in mmap_area_levels.
+
+    OUTPUTS
+    A pandas dataframe
+    '''
+    statistical_area_code = statistical_area_code.upper()
+    if use_mmap is None:
+        use_mmap = statistical_area_code in mmap_area_levels
+    if use_mmap:
+        return read_datapack_mmap(table, statistical_area_code, columns, data_path)
+
+    manifest = datapack_manifest(table, statistical_area_code, data_path)
+
+    if columns is not None:
+        file_columns = set(manifest['columns'])
+        columns = [manifest['index_column']] + [x for x in dict.fromkeys(columns)
+                                                 if x in file_columns and x != manifest['index_column']]
+
+    return read_frame(os.path.join(datapack_cache_dir(statistical_area_code, data_path), manifest['cache_file']),
+                      columns=columns, file_format=manifest['format'])
+
+
+'''Memory-mapped column store'''
+
+def mmap_store_dir(table, statistical_area_code='SA3', data_path=env_path):
+    '''Returns the directory holding the memory-mapped columns of a DataPack file'''
+    statistical_area_code = statistical_area_code.upper()
+    return os.path.join(datapack_cache_dir(statistical_area_code, data_path), 'mmap',
+                        '2016Census_{}_AUS_{}'.format(table, statistical_area_code))
+
+
+def build_mmap_store(table, statistical_area_code='SA3', data_path=env_path):
+    '''
+    Lays out a DataPack file as one contiguous .npy array per column, so that reading a few measures only touches
+    the pages for those measures and separate processes reading the same file share the OS page cache.
+    Each build goes in a new version directory, named by the source hash, which is switched to by the manifest once
+    complete. Files already mapped by other processes are never rewritten, so they keep reading the version they
+    opened.
+
+    INPUTS
+    table: STRING - the ABS Census Datapack file to convert (e.g. G01, G09A)
+    statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
+    data_path: STRING - the root folder containing the "Data" folder
+
+    OUTPUTS
+    DICTIONARY - the manifest for the column store, listing the columns in file order and the source hash it was built from
+    '''
+    statistical_area_code = statistical_area_code.upper()
+    datapack = datapack_manifest(table, statistical_area_code, data_path)
+    df = read_frame(os.path.join(datapack_cache_dir(statistical_area_code, data_path), datapack['cache_file']),
+                    file_format=datapack['format'])
+
+    store_dir = mmap_store_dir(table, statistical_area_code, data_path)
+    version = datapack['source_hash']
+    version_dir = os.path.join(store_dir, version)
+    if not os.path.isdir(version_dir):
+        temp_dir = _temp_path(version_dir)
+        os.makedirs(temp_dir)
+        for i, column in enumerate(df.columns):
+            values = df[column].to_numpy()
+            if values.dtype == object:
+                # object arrays can't be memory-mapped, so store text (e.g. alphanumeric region codes) as fixed width strings
+                values = values.astype(str)
+            np.save(os.path.join(temp_dir, '{}.npy'.format(i)), np.ascontiguousarray(values))
+        try:
+            os.replace(temp_dir, version_dir)
+        except OSError:
+            # another process finished building the same version first
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    manifest = {
+        'source_hash': datapack['source_hash'],
+        'version': version,
+        'index_column': df.columns[0],
+        'columns': df.columns.tolist(),
+        'n_rows': len(df),
+        }
+    _write_manifest(os.path.join(store_dir, 'manifest.json'), manifest)
+
+    # remove older versions. Where the OS allows deleting mapped files, processes that still map them keep their
+    # copy until they close it; elsewhere the files are left for the next build to remove.
+    for old_version in os.listdir(store_dir):
+        old_path = os.path.join(store_dir, old_version)
+        if old_version == version or old_version.endswith('.tmp'):
+            continue
+        if os.path.isdir(old_path):
+            shutil.rmtree(old_path, ignore_errors=True)
+        elif old_version.endswith('.npy'):
+            # columns saved directly in the store directory by earlier versions of the store
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+    return manifest
+
+
+def mmap_manifest(table, statistical_area_code='SA3', data_path=env_path):
+    '''Returns the manifest for a memory-mapped column store, (re)building it if missing or built from an older source file'''
+    datapack = datapack_manifest(table, statistical_area_code, data_path)
+    manifest = _read_manifest(os.path.join(mmap_store_dir(table, statistical_area_code, data_path), 'manifest.json'))
+    if manifest is None or manifest.get('version') is None or manifest['source_hash'] != datapack['source_hash']:
+        manifest = build_mmap_store(table, statistical_area_code, data_path)
+    return manifest
+
+
+def read_mmap_columns(table, statistical_area_code='SA3', columns=None, data_path=env_path):
+    '''
+    Returns read-only memory-mapped arrays for columns of a DataPack file. No data is read until the arrays are used.
+
+    INPUTS
+    table: STRING - the ABS Census Datapack file to read (e.g. G01, G09A)
+    statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
+    columns: LIST of STRING objects - optional, the measures to return. The region code column is always included
+        as the first item. Measures not in the file are ignored.
+    data_path: STRING - the root folder containing the "Data" folder
+
+    OUTPUTS
+    DICTIONARY in the format {column name: numpy memmap}, in the order requested
+    '''
+    manifest = mmap_manifest(table, statistical_area_code, data_path)
+    store_dir = os.path.join(mmap_store_dir(table, statistical_area_code, data_path), manifest['version'])
+
+    positions = {column: i for i, column in enumerate(manifest['columns'])}
+    if columns is None:
+        columns = manifest['columns']
+    columns = [manifest['index_column']] + [x for x in dict.fromkeys(columns)
+                                             if x in positions and x != manifest['index_column']]
+
+    arrays = {}
+    for column in columns:
+        column_path = os.path.join(store_dir, '{}.npy'.format(positions[column]))
+        # each version's files are never rewritten, so an array opened once can be reused until the version changes
+        values = _mmap_arrays.get(column_path)
+        if values is None:
+            values = _mmap_arrays[column_path] = np.load(column_path, mmap_mode='r')
+        arrays[column] = values
+
+    return arrays
+
+
+def read_datapack_mmap(table, statistical_area_code='SA3', columns=None, data_path=env_path):
+    '''Reads a DataPack file from the memory-mapped column store, copying only the requested columns into a dataframe'''
+    return pd.DataFrame(read_mmap_columns(table, statistical_area_code, columns, data_path))
+
+
+def build_all_datapack_caches(statistical_area_code='SA3', data_path=env_path):
+    '''Builds (or refreshes) the cache for every DataPack csv available at a statistical area level'''
+    statistical_area_code = statistical_area_code.upper()
+    source_dir = '{}\\Data\\{}\\AUST'.format(data_path, statistical_area_code)
+    prefix, suffix = '2016Census_', '_AUS_{}.csv'.format(statistical_area_code)
+    tables = [x[len(prefix):-len(suffix)] for x in os.listdir(source_dir) if x.startswith(prefix) and x.endswith(suffix)]
+    return {table: datapack_manifest(table, statistical_area_code, data_path) for table in sorted(tables)}
+
+
+'''Refined feature matrix result cache'''
+
+# Maximum size of the in-memory result cache in bytes, least recently used results are evicted beyond this
+result_cache_max_bytes = 1024 ** 3
+
+# In-memory results, in the format {key: (size in bytes, dataframe)}, ordered from least to most recently used
+_result_cache = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+result_cache_stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+
+
+def result_cache_key(table_list, category_list, statistical_area_code, drop_zero_area=True, sources=None,
+                     verify_index=False, dedup_metadata=False):
+    '''
+    Returns a canonical hash for a feature matrix request. Table order is kept as it sets the column order of the
+    result, categories are sorted as their order doesn't change the result. sources is an optional dictionary
+    fingerprinting the files the result is built from (e.g. {DataPack file: source hash}), so that a result built
+    from older files is never matched. verify_index and dedup_metadata are the matching options of
+    table_funcs.load_tables_specify_cats, which change the result (or whether it is returned at all).
+    '''
+    request = {
+        'tables': list(table_list),
+        'categories': sorted(set(category_list)),
+        'statistical_area_code': statistical_area_code.upper(),
+        'drop_zero_area': bool(drop_zero_area),
+        'sources': sources or {},
+        'verify_index': bool(verify_index),
+        'dedup_metadata': bool(dedup_metadata),
+        }
+    return hashlib.sha1(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+
+def result_cache_dir(data_path=env_path):
+    '''Returns the directory results are spilled to on disk'''
+    return os.path.join(data_path, 'Data', 'Cache', 'results')
+
+
+def _store_result(key, df):
+    '''
+    Adds a result to the in-memory cache, evicting the least recently used results to stay within
+    result_cache_max_bytes. Callers hold _result_cache_lock.
+    '''
+    size = int(df.memory_usage(index=True).sum())
+    if size > result_cache_max_bytes:
+        return
+    if key in _result_cache:
+        result_cache_stats['bytes'] -= _result_cache.pop(key)[0]
+    _result_cache[key] = (size, df)
+    result_cache_stats['bytes'] += size
+    while result_cache_stats['bytes'] > result_cache_max_bytes:
+        evicted_size, evicted = _result_cache.popitem(last=False)[1]
+        result_cache_stats['bytes'] -= evicted_size
+        result_cache_stats['evictions'] += 1
+
+
+def get_cached_result(key, data_path=env_path):
+    '''
+    Looks up a result in the in-memory cache, then in the on-disk spill directory.
+
+    INPUTS
+    key: STRING - the request hash from result_cache_key
+    data_path: STRING - the root folder containing the "Data" folder
+
+    OUTPUTS
+    A pandas dataframe, or None if the result isn't cached. The dataframe is a shallow copy of the cached result, so
+    adding or dropping columns won't affect the cache but values shouldn't be modified in place.
+    '''
+    with _result_cache_lock:
+        stored = _result_cache.get(key)
+        if stored is not None:
+            _result_cache.move_to_end(key)
+            result_cache_stats['hits'] += 1
+            return stored[1].copy(deep=False)
+
+    manifest = _read_manifest(os.path.join(result_cache_dir(data_path), '{}.json'.format(key)))
+    if manifest is not None:
+        df = read_frame(os.path.join(result_cache_dir(data_path), manifest['cache_file']), file_format=manifest['format'])
+        df = df.set_index(df.columns[0])
+        df.index.name = manifest['index_name']
+        df.columns.name = manifest['columns_name']
+        with _result_cache_lock:
+            _store_result(key, df)
+            result_cache_stats['disk_hits'] += 1
+        return df.copy(deep=False)
+
+    with _result_cache_lock:
+        result_cache_stats['misses'] += 1
+    return None
+
+
+def put_cached_result(key, df, data_path=env_path):
+    '''Adds a result to the in-memory cache and writes it to the on-disk spill directory so it survives restarts'''
+    with _result_cache_lock:
+        _store_result(key, df)
+
+    spill_dir = result_cache_dir(data_path)
+    os.makedirs(spill_dir, exist_ok=True)
+    cache_file = '{}.{}'.format(key, cache_format)
+    df_spill = df.reset_index()
+    df_spill.columns = [str(x) for x in df_spill.columns]
+    write_frame(df_spill, os.path.join(spill_dir, cache_file))
+    manifest = {
+        'format': cache_format,
+        'cache_file': cache_file,
+        'index_name': df.index.name,
+        'columns_name': df.columns.name,
+        }
+    _write_manifest(os.path.join(spill_dir, '{}.json'.format(key)), manifest)
+
+
+def clear_result_cache(disk=False, data_path=env_path):
+    '''Empties the in-memory result cache, and optionally the on-disk spill directory'''
+    with _result_cache_lock:
+        _result_cache.clear()
+        result_cache_stats['bytes'] = 0
+    if disk and os.path.isdir(result_cache_dir(data_path)):
+        for cache_file in os.listdir(result_cache_dir(data_path)):
+            os.remove(os.path.join(result_cache_dir(data_path), cache_file))
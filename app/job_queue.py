@@ -0,0 +1,359 @@
+import pandas as pd
+import os
+import json
+import time
+import uuid
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from sklearn.metrics import r2_score
+import table_funcs as tbl_func
+import cache_funcs
+import app_data
+import model_registry
+import au_census_analysis_functions as cnss_func
+
+# Number of worker processes training models in the background
+job_workers = 2
+
+# Job states; queued and running jobs are "in flight" and are shared by identical requests
+in_flight_states = ('queued', 'running')
+finished_states = ('done', 'failed', 'cancelled')
+
+# Seconds between the owning server process marking its unfinished jobs as alive, and seconds without a heartbeat
+# after which an unfinished job is treated as lost (e.g. the server was restarted or its pool died)
+job_heartbeat_interval = 10
+job_heartbeat_timeout = 60
+
+# Identifies this server process as the owner of the jobs it queues
+_owner_id = uuid.uuid4().hex
+
+_executor = None
+_futures = {}
+_executor_lock = threading.Lock()
+_heartbeat_thread = None
+
+
+'''Job table'''
+
+def job_db_path(data_path=None):
+    '''Returns the path of the SQLite job table'''
+    return os.path.join(data_path or tbl_func.env_path, 'Data', 'Cache', 'jobs.sqlite')
+
+
+def _connect(db_path):
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    # the web server and the worker processes all write to the table, so wait for locks rather than failing
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                        job_id TEXT PRIMARY KEY,
+                        request_hash TEXT,
+                        request TEXT,
+                        status TEXT,
+                        progress REAL,
+                        message TEXT,
+                        model_name TEXT,
+                        error TEXT,
+                        submitted REAL,
+                        started REAL,
+                        finished REAL,
+                        owner TEXT,
+                        heartbeat REAL)''')
+    # job tables created before jobs recorded their owner
+    existing = [x['name'] for x in conn.execute('PRAGMA table_info(jobs)').fetchall()]
+    for column, column_type in [('owner', 'TEXT'), ('heartbeat', 'REAL')]:
+        if column not in existing:
+            conn.execute('ALTER TABLE jobs ADD COLUMN {} {}'.format(column, column_type))
+    conn.execute('CREATE INDEX IF NOT EXISTS jobs_request_hash ON jobs (request_hash, status)')
+    return conn
+
+
+def _update_job(db_path, job_id, **fields):
+    conn = _connect(db_path)
+    try:
+        conn.execute('UPDATE jobs SET {} WHERE job_id = ?'.format(', '.join('{} = ?'.format(x) for x in fields)),
+                     list(fields.values()) + [job_id])
+    finally:
+        conn.close()
+
+
+def _fail_lost_jobs(conn):
+    '''Marks unfinished jobs whose owning server process has stopped sending heartbeats as failed'''
+    now = time.time()
+    conn.execute("UPDATE jobs SET status = 'failed', message = 'Failed', finished = ?, "
+                 "error = 'Job lost: the server process that queued it stopped' "
+                 "WHERE status IN ('queued', 'running', 'cancelling') AND (heartbeat IS NULL OR heartbeat < ?)",
+                 (now, now - job_heartbeat_timeout))
+
+
+def _send_heartbeats(db_path):
+    '''Marks this process's unfinished jobs as alive, until it exits'''
+    while True:
+        time.sleep(job_heartbeat_interval)
+        try:
+            conn = _connect(db_path)
+            try:
+                conn.execute("UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status IN ('queued', 'running', "
+                             "'cancelling')", (time.time(), _owner_id))
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            # a locked or unavailable table is retried on the next beat
+            pass
+
+
+def job_status(job_id, data_path=None):
+    '''
+    Returns the state of a job.
+
+    INPUTS
+    job_id: STRING - the job id returned by submit_training_job
+    data_path: STRING - the root folder containing the "Data" folder
+
+    OUTPUTS
+    DICTIONARY of the job's status, progress (0-1), message, request, model name, error and submitted, started and
+    finished times, or None if there is no such job
+    '''
+    conn = _connect(job_db_path(data_path))
+    try:
+        _fail_lost_jobs(conn)
+        row = conn.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    status = dict(row)
+    status['request'] = json.loads(status['request'])
+    return status
+
+
+def list_jobs(data_path=None, limit=50):
+    '''Returns a dataframe of the most recently submitted jobs'''
+    conn = _connect(job_db_path(data_path))
+    try:
+        return pd.read_sql_query('SELECT * FROM jobs ORDER BY submitted DESC LIMIT ?', conn, params=(limit,),
+                                 index_col='job_id')
+    finally:
+        conn.close()
+
+
+'''Training jobs'''
+
+def training_request(target_measure, target_table, load_tables, load_features, stat_a_level='SA3',
+                     denominator='persons', search='grid'):
+    '''Builds the normalised description of a training job, so identical selections give identical requests'''
+    return {
+        'target_measure': target_measure,
+        'target_table': target_table,
+        'load_tables': sorted(set(load_tables)),
+        'load_features': sorted(set(load_features)),
+        'stat_a_level': stat_a_level.upper(),
+        'denominator': denominator,
+        'search': search,
+        }
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _checkpoint(db_path, job_id, progress, message):
+    '''Records a job's progress, stopping the job if it has been asked to cancel'''
+    conn = _connect(db_path)
+    try:
+        status = conn.execute('SELECT status FROM jobs WHERE job_id = ?', (job_id,)).fetchone()['status']
+        if status == 'cancelling':
+            raise JobCancelled()
+        conn.execute('UPDATE jobs SET progress = ?, message = ? WHERE job_id = ?', (progress, message, job_id))
+    finally:
+        conn.close()
+
+
+def _start_job(db_path, job_id):
+    '''Marks a queued job as running, returning False if it was cancelled (or lost) before it started'''
+    conn = _connect(db_path)
+    try:
+        started = conn.execute("UPDATE jobs SET status = 'running', started = ? WHERE job_id = ? AND status = 'queued'",
+                               (time.time(), job_id)).rowcount
+    finally:
+        conn.close()
+    return started == 1
+
+
+def job_curve_path(job_id, data_path=None):
+    '''Returns the path of the score by n_estimators curve saved by a 'warm_start' training job'''
+    return os.path.join(model_registry.registry_dir(data_path or cache_funcs.env_path), job_id, 
+                        'n_estimators_curve.csv')
+
+
+def _run_training_job(job_id, request, db_path, data_path, mmap_area_levels):
+    '''Trains and registers a model for a job, in a worker process'''
+    # worker processes start with the default settings, so read the same levels memory-mapped as the server does,
+    # and load the job's level into the shared store so its training data is read from the mapped columns
+    cache_funcs.mmap_area_levels[:] = mmap_area_levels
+
+    try:
+        if not _start_job(db_path, job_id):
+            raise JobCancelled()
+        _checkpoint(db_path, job_id, 0.05, 'Loading census data')
+        app_data.preload([request['stat_a_level']], route_readers=True)
+        target = tbl_func.resolve_measure(request['target_measure'], request['target_table'])
+        X, y = tbl_func.create_Xy(target, request['denominator'], request['load_tables'], request['load_features'],
+                                  request['stat_a_level'])
+
+        _checkpoint(db_path, job_id, 0.3, 'Fitting model to {:,} regions and {:,} features'.format(*X.shape))
+        curve_path = None
+        if request['search'] == 'warm_start':
+            # keep the score by n_estimators curve alongside the registered model
+            curve_path = job_curve_path(job_id, data_path)
+            os.makedirs(os.path.dirname(curve_path), exist_ok=True)
+        start = time.perf_counter()
+        model, X_train, X_test, y_train, y_test = cnss_func.fit_model(X, y, search=request['search'], n_jobs=1,
+                                                                      curve_path=curve_path, verbosity=0)
+        fit_time = time.perf_counter() - start
+
+        _checkpoint(db_path, job_id, 0.9, 'Saving model')
+        model_registry.register_model(job_id, model, X_train, y_train, request['stat_a_level'],
+                                      metrics={'r2': r2_score(y_test, model.predict(X_test))}, fit_time=fit_time,
+                                      tables=request['load_tables'], categories=request['load_features'],
+                                      target=list(target), denominator=request['denominator'], data_path=data_path)
+        _update_job(db_path, job_id, status='done', progress=1.0, message='Done', model_name=job_id,
+                    finished=time.time())
+    except JobCancelled:
+        if _stored_status(db_path, job_id) in ('queued', 'running', 'cancelling'):
+            _update_job(db_path, job_id, status='cancelled', message='Cancelled', finished=time.time())
+    except Exception as e:
+        _update_job(db_path, job_id, status='failed', message='Failed', error=repr(e), finished=time.time())
+
+
+def _get_executor(db_path):
+    global _executor, _heartbeat_thread
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=job_workers)
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(target=_send_heartbeats, args=(db_path,), daemon=True)
+            _heartbeat_thread.start()
+        return _executor
+
+
+def _job_finished(db_path, job_id, future):
+    '''Marks a job as failed if its worker process died without recording a result'''
+    global _executor
+    _futures.pop(job_id, None)
+    if future.cancelled():
+        return
+    error = future.exception()
+    if isinstance(error, BrokenProcessPool):
+        # a worker process died, so the pool can't take more jobs; start a new one for the next submit
+        with _executor_lock:
+            _executor = None
+    if error is not None:
+        status = _stored_status(db_path, job_id)
+        if status is not None and status not in finished_states:
+            _update_job(db_path, job_id, status='failed', message='Failed', error=repr(error), finished=time.time())
+
+
+def _stored_status(db_path, job_id):
+    conn = _connect(db_path)
+    try:
+        row = conn.execute('SELECT status FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return None if row is None else row['status']
+
+
+def submit_training_job(target_measure, target_table, load_tables, load_features, stat_a_level='SA3',
+                        denominator='persons', search='grid', reuse_finished=True, data_path=None):
+    '''
+    Queues a model training job on the background process pool. If an identical request is already queued or
+    running (or has finished successfully, with reuse_finished) its job id is returned instead, so several users
+    asking for the same model trigger one fit.
+
+    INPUTS
+    target_measure: STRING - the measure to predict, as selected in the dashboard's measure dropdown
+    target_table: STRING - the table the measure was selected from
+    load_tables: LIST of STRING objects - ABS census datapack tables to draw features from (G01-59)
+    load_features: LIST of STRING objects - population characteristics to use in analysis (Age, Sex, etc.)
+    stat_a_level: STRING - the statistical area level of information the data should be drawn from (SA1-3)
+    denominator: the denominator to scale the data by, see table_funcs.create_Xy
+    search: STRING - the hyperparameter search to use, see au_census_analysis_functions.fit_model. The curve of a
+        'warm_start' search is saved with the model, see job_curve_path
+    reuse_finished: BOOLEAN - return a successfully finished identical job rather than training again
+    data_path: STRING - the root folder containing the "Data" folder
+
+    OUTPUTS
+    STRING - the job id
+    '''
+    request = training_request(target_measure, target_table, load_tables, load_features, stat_a_level, denominator,
+                               search)
+    request_json = json.dumps(request, sort_keys=True)
+    request_hash = hashlib.sha1(request_json.encode()).hexdigest()
+    shared_states = in_flight_states + (('done',) if reuse_finished else ())
+
+    db_path = job_db_path(data_path)
+    conn = _connect(db_path)
+    try:
+        # check for an identical job and queue a new one in the same transaction, so concurrent submits can't both queue
+        conn.execute('BEGIN IMMEDIATE')
+        # jobs left unfinished by a stopped server will never run, so they mustn't be shared
+        _fail_lost_jobs(conn)
+        existing = conn.execute('SELECT job_id FROM jobs WHERE request_hash = ? AND status IN ({}) '
+                                'ORDER BY submitted DESC LIMIT 1'.format(','.join('?' * len(shared_states))),
+                                [request_hash] + list(shared_states)).fetchone()
+        if existing is not None:
+            conn.execute('COMMIT')
+            return existing['job_id']
+        job_id = uuid.uuid4().hex
+        conn.execute('INSERT INTO jobs (job_id, request_hash, request, status, progress, message, submitted, owner, '
+                     'heartbeat) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (job_id, request_hash, request_json, 'queued', 0.0, 'Queued', time.time(), _owner_id,
+                      time.time()))
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+    future = _get_executor(db_path).submit(_run_training_job, job_id, request, db_path,
+                                           data_path or cache_funcs.env_path, list(cache_funcs.mmap_area_levels))
+    _futures[job_id] = future
+    future.add_done_callback(lambda x: _job_finished(db_path, job_id, x))
+    return job_id
+
+
+def cancel_job(job_id, data_path=None):
+    '''
+    Cancels a job. Queued jobs are removed from the pool straight away; running jobs stop at their next progress
+    checkpoint, as a fit in progress can't be interrupted.
+
+    OUTPUTS
+    BOOLEAN - whether the job was queued or running and has been cancelled or asked to cancel
+    '''
+    db_path = job_db_path(data_path)
+    status = _stored_status(db_path, job_id)
+    if status not in ('queued', 'running'):
+        return False
+    future = _futures.get(job_id)
+    if future is not None and future.cancel():
+        _update_job(db_path, job_id, status='cancelled', message='Cancelled', finished=time.time())
+    else:
+        _update_job(db_path, job_id, status='cancelling', message='Cancelling')
+    return True
+
+
+def job_result(job_id, data_path=None):
+    '''
+    Returns the trained model of a finished job, lazily loaded from the model registry.
+
+    OUTPUTS
+    TUPLE of (fitted SKLearn Pipeline object, model registry entry), or None if the job hasn't finished successfully
+    '''
+    status = job_status(job_id, data_path)
+    if status is None or status['status'] != 'done':
+        return None
+    data_path = data_path or cache_funcs.env_path
+    return (model_registry.load_model(status['model_name'], data_path), 
+            model_registry.model_entry(status['model_name'], data_path))
@@ -0,0 +1,212 @@
+import pandas as pd
+import os
+import json
+import hashlib
+import threading
+import time
+import joblib
+import sklearn
+import cache_funcs
+
+# Fitted pipelines loaded from the registry, in the format {model name: (registered time, pipeline)}
+_loaded_models = {}
+_loaded_models_lock = threading.Lock()
+
+
+'''Model registry'''
+
+def registry_dir(data_path=cache_funcs.env_path):
+    '''Returns the directory the model registry is saved in'''
+    return os.path.join(data_path, 'Data', 'Models')
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, contents):
+    # write to a temporary file first so a reader never sees a partly written file
+    temp_path = cache_funcs._temp_path(path)
+    with open(temp_path, 'w') as f:
+        json.dump(contents, f, indent=1)
+    os.replace(temp_path, path)
+
+
+def training_data_hash(X, y):
+    '''
+    Hashes a training dataset (values, region index and column names) so a registered model can be matched to the
+    data it was trained on.
+
+    INPUTS
+    X - Pandas dataframe. The features trained on.
+    y - Pandas series. The response vector trained on.
+
+    OUTPUTS
+    STRING - the hex digest of the dataset
+    '''
+    data_hash = hashlib.sha1()
+    data_hash.update(json.dumps([str(x) for x in X.columns] + [str(y.name)]).encode())
+    data_hash.update(pd.util.hash_pandas_object(X, index=True).values.tobytes())
+    data_hash.update(pd.util.hash_pandas_object(y, index=True).values.tobytes())
+    return data_hash.hexdigest()
+
+
+def register_model(name, pipeline, X_train, y_train, statistical_area_code, metrics=None, fit_time=None,
+                   tables=None, categories=None, target=None, denominator=None, data_path=cache_funcs.env_path):
+    '''
+    Saves a fitted pipeline to the model registry along with the feature schema it expects and a record of how it
+    was trained. Each model is saved in its own folder, so models can be registered concurrently (from several
+    training jobs) without a shared index to update.
+
+    INPUTS
+    name - String. The name to register the model under, an existing model of the same name is replaced.
+    pipeline - Fitted SKLearn Pipeline object.
+    X_train - Pandas dataframe. The features the model was trained on.
+    y_train - Pandas series. The response vector the model was trained on.
+    statistical_area_code - String. The statistical area level of the training data (SA1-3)
+    metrics - Dictionary. Optional performance metrics, e.g. {'r2': 0.8}
+    fit_time - Float. Optional time taken to fit the model, in seconds
+    tables - List of Strings. Optional ABS census datapack tables the features were drawn from
+    categories - List of Strings. Optional population characteristics the features were aggregated by
+    target - Optional description of the target measure (see table_funcs.create_Xy)
+    denominator - Optional description of the denominator the data was scaled by
+    data_path - String. The root folder containing the "Data" folder
+
+    OUTPUTS
+    DICTIONARY - the model's registry entry
+    '''
+    model_dir = os.path.join(registry_dir(data_path), name)
+    os.makedirs(model_dir, exist_ok=True)
+    # dump to a temporary file and move it into place, as other processes may have the old file memory-mapped
+    pipeline_path = os.path.join(model_dir, 'pipeline.joblib')
+    temp_path = cache_funcs._temp_path(pipeline_path)
+    joblib.dump(pipeline, temp_path)
+    os.replace(temp_path, pipeline_path)
+
+    model = pipeline.steps[-1][1] if hasattr(pipeline, 'steps') else pipeline
+    importances = getattr(model, 'feature_importances_', None)
+    if importances is not None and len(importances) != X_train.shape[1]:
+        # the imputer drops features with no values, leaving importances for fewer features than the schema
+        importances = None
+
+    entry = {
+        'name': name,
+        'registered': time.time(),
+        'statistical_area_code': statistical_area_code.upper(),
+        'feature_schema': [{'name': str(col), 'dtype': str(dtype)} for col, dtype in X_train.dtypes.items()],
+        'index_name': X_train.index.name,
+        'response_name': y_train.name,
+        'n_samples': len(X_train),
+        'training_data_hash': training_data_hash(X_train, y_train),
+        'metrics': metrics or {},
+        'fit_time': fit_time,
+        'tables': tables,
+        'categories': categories,
+        'target': target,
+        'denominator': denominator,
+        'importances': None if importances is None else importances.tolist(),
+        'sklearn_version': sklearn.__version__,
+        }
+    _write_json(os.path.join(model_dir, 'model.json'), entry)
+
+    with _loaded_models_lock:
+        _loaded_models.pop(name, None)
+
+    return entry
+
+
+def list_models(data_path=cache_funcs.env_path):
+    '''Returns a dataframe summarising the registered models, indexed by name'''
+    # built from each model's own entry, so there's no shared index for concurrent registrations to overwrite
+    index = {}
+    if os.path.isdir(registry_dir(data_path)):
+        for name in sorted(os.listdir(registry_dir(data_path))):
+            entry = _read_json(os.path.join(registry_dir(data_path), name, 'model.json'))
+            if entry is not None:
+                index[name] = {x: entry[x] for x in ['registered', 'statistical_area_code', 'response_name',
+                                                     'n_samples', 'training_data_hash', 'metrics', 'fit_time']}
+    df = pd.DataFrame.from_dict(index, orient='index')
+    df.index.name = 'Model'
+    return df
+
+
+def model_entry(name, data_path=cache_funcs.env_path):
+    '''Returns the registry entry for a model, raising a KeyError if it isn't registered'''
+    entry = _read_json(os.path.join(registry_dir(data_path), name, 'model.json'))
+    if entry is None:
+        raise KeyError('Model {} is not registered'.format(name))
+    return entry
+
+
+def load_model(name, data_path=cache_funcs.env_path, mmap_mode=None):
+    '''
+    Lazily loads a registered pipeline: the first call for a model loads it from disk and later calls return the
+    same loaded object, until the model is registered again.
+
+    INPUTS
+    name - String. The registered model name
+    data_path - String. The root folder containing the "Data" folder
+    mmap_mode - String. Optional joblib memory-map mode for the pipeline's numpy arrays. Note the arrays of each tree
+        in a forest are copied into memory regardless, as sklearn's trees copy them when they are unpickled.
+
+    OUTPUTS
+    The fitted SKLearn Pipeline object
+    '''
+    registered = model_entry(name, data_path)['registered']
+    with _loaded_models_lock:
+        loaded = _loaded_models.get(name)
+        if loaded is None or loaded[0] != registered:
+            pipeline = joblib.load(os.path.join(registry_dir(data_path), name, 'pipeline.joblib'), mmap_mode=mmap_mode)
+            loaded = _loaded_models[name] = (registered, pipeline)
+    return loaded[1]
+
+
+def unload_models():
+    '''Releases all loaded pipelines'''
+    with _loaded_models_lock:
+        _loaded_models.clear()
+
+
+def match_schema(name, X, data_path=cache_funcs.env_path):
+    '''
+    Checks a feature set against a registered model's feature schema, returning the features in the order the
+    model expects. Raises a ValueError listing any missing features; extra features are dropped.
+    '''
+    columns = [x['name'] for x in model_entry(name, data_path)['feature_schema']]
+    missing = [x for x in columns if x not in X.columns]
+    if missing:
+        raise ValueError('Features missing for model {}: {}'.format(name, ', '.join(missing)))
+    return X[columns]
+
+
+def predict(name, X, data_path=cache_funcs.env_path):
+    '''
+    Predicts with a registered model, matching the features to its schema first.
+
+    INPUTS
+    name - String. The registered model name
+    X - Pandas dataframe. The features to predict from, indexed by region
+    data_path - String. The root folder containing the "Data" folder
+
+    OUTPUTS
+    Pandas series of predictions indexed by region, named by the model's response
+    '''
+    entry = model_entry(name, data_path)
+    predictions = load_model(name, data_path).predict(match_schema(name, X, data_path))
+    return pd.Series(predictions, index=X.index, name=entry['response_name'])
+
+
+def model_importances(name, data_path=cache_funcs.env_path):
+    '''
+    Returns a registered model's impurity based feature importances as a series indexed by feature, sorted in
+    descending order, from the registry entry (without loading the pipeline). Returns None if not recorded.
+    '''
+    entry = model_entry(name, data_path)
+    if entry['importances'] is None:
+        return None
+    importances = pd.Series(entry['importances'], index=[x['name'] for x in entry['feature_schema']])
+    return importances.sort_values(ascending=False)
@@ -2,6 +2,19 @@ import numpy as np
 import pandas as pd
 import os
 import operator
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import repeat
+from scipy import sparse
+import cache_funcs
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 # Set a variable for current notebook's path for various loading/saving mechanisms
 td_path = os.path.dirname(os.path.realpath(__file__))
@@ -30,6 +43,169 @@ full_tables_list = ["G01", "G02", "G03", "G04", "G05", "G06", "G07", "G08", "G09
 
 cat_import_dtype = {x: str for x in full_category_list}
 
+# Metadata files used by the lookup functions, referenced by a short name
+metadata_files = {
+    'category_values': 'Metadata_2016_w_Category_Values.csv',
+    'category_measure': 'Category_Measure_reference.csv',
+    'table_reference': '2016_table_reference.csv',
+    'refined': 'Metadata_2016_refined.csv',
+    'zero_area': 'Zero_Area_Territories.csv',
+}
+
+# Process-wide store of loaded metadata, in the format {name: (file modified time, dataframe)}
+_metadata_store = {}
+
+
+def _metadata_path(name):
+    return '{}\\Data\\Metadata\\{}'.format(env_path, metadata_files[name])
+
+
+def _read_metadata_file(name):
+    '''Reads a metadata csv from disk and converts the repeated text fields to categoricals to keep the store compact'''
+    if name == 'category_values':
+        df = pd.read_csv(_metadata_path(name), dtype=cat_import_dtype)
+        df['DataPack file'] = df['DataPack file'].astype('category')
+        # precompute the 3 character table reference (e.g. G57 for both G57A and G57B) used when filtering by table
+        df['Table prefix'] = df['DataPack file'].astype(str).str[:3].astype('category')
+    elif name == 'category_measure':
+        df = pd.read_csv(_metadata_path(name), dtype={'2016_Table':str})
+        df['Category'] = df['Category'].astype('category')
+    elif name == 'table_reference':
+        df = pd.read_csv(_metadata_path(name), dtype=str)
+    else:
+        df = pd.read_csv(_metadata_path(name))
+    return df
+
+
+def load_metadata(name, check_modified=True):
+    '''
+    Returns a metadata dataframe from the process-wide metadata store, reading it from disk only on first use
+    or when the file has changed since it was loaded.
+
+    INPUTS:
+    name: STRING - the reference name of the metadata file, one of the keys of metadata_files
+    check_modified: BOOLEAN - whether to compare the file's modified time against the stored copy and reload if it has changed
+
+    OUTPUTS:
+    Pandas dataframe object. This is shared between all callers so should be treated as read only.
+    '''
+    stored = _metadata_store.get(name)
+    if stored is not None and not check_modified:
+        return stored[1]
+
+    modified_time = os.path.getmtime(_metadata_path(name))
+    if stored is None or stored[0] != modified_time:
+        stored = (modified_time, _read_metadata_file(name))
+        _metadata_store[name] = stored
+
+    return stored[1]
+
+
+def preload_metadata(names=None):
+    '''Loads the metadata files into the metadata store, for use at app startup. Defaults to all files in metadata_files.'''
+    if names is None:
+        names = list(metadata_files)
+    for name in names:
+        load_metadata(name)
+
+
+def reload_metadata(names=None):
+    '''Forces the metadata store to re-read the given files from disk. Defaults to all files in metadata_files.'''
+    invalidate_metadata(names)
+    preload_metadata(names)
+
+
+def invalidate_metadata(names=None):
+    '''Removes the given files from the metadata store so they are re-read on next use. Defaults to all files.'''
+    if names is None:
+        _metadata_store.clear()
+    else:
+        for name in names:
+            _metadata_store.pop(name, None)
+
+
+# Inverted index over the category values metadata, rebuilt whenever the underlying metadata is reloaded
+_measure_index = {}
+
+
+def _postings(mask):
+    '''Converts a boolean mask over the metadata rows into a sorted array of row positions (measure IDs)'''
+    return np.flatnonzero(np.asarray(mask))
+
+
+def build_measure_index(df_meta):
+    '''
+    Builds an inverted index from the category values metadata, mapping categories, category values and tables
+    to posting lists of the measures which include them. Measure IDs are row positions in df_meta, so each posting
+    list is a sorted numpy array and unions/intersections can be done with set operations rather than dataframe scans.
+
+    INPUTS:
+    df_meta: Pandas dataframe object - the category values metadata as returned by load_metadata('category_values')
+
+    OUTPUTS:
+    DICTIONARY with keys:
+        'category' - {category: posting list of measures with any value for the category}
+        'category_value' - {category: {category value: posting list of measures with that value}}
+        'table' - {3 character table reference: posting list of measures in that table}
+        'n_measures' - the total number of measures indexed
+    '''
+    index = {'category': {}, 'category_value': {}, 'table': {}, 'n_measures': len(df_meta)}
+
+    for category in dict.fromkeys(full_category_list):
+        if category not in df_meta.columns:
+            index['category'][category] = _postings(np.zeros(len(df_meta), dtype=bool))
+            index['category_value'][category] = {}
+            continue
+        index['category'][category] = _postings(df_meta[category].notna())
+        codes, values = pd.factorize(df_meta[category])
+        order = np.argsort(codes, kind='stable')
+        splits = np.searchsorted(codes[order], np.arange(len(values) + 1))
+        index['category_value'][category] = {value: order[splits[i]:splits[i + 1]] for i, value in enumerate(values)}
+
+    codes, tables = pd.factorize(df_meta['Table prefix'].astype(str))
+    for i, table in enumerate(tables):
+        index['table'][table] = _postings(codes == i)
+
+    return index
+
+
+def load_measure_index():
+    '''Returns the inverted index for the category values metadata, building it on first use or after a metadata reload'''
+    df_meta = load_metadata('category_values')
+    if _measure_index.get('source') is not df_meta:
+        _measure_index['source'] = df_meta
+        _measure_index['index'] = build_measure_index(df_meta)
+    return _measure_index['index']
+
+
+def _union_postings(posting_lists):
+    posting_lists = list(posting_lists)
+    if len(posting_lists) == 0:
+        return np.array([], dtype=np.intp)
+    return np.unique(np.concatenate(posting_lists))
+
+
+def _intersect_postings(posting_lists):
+    result = None
+    for posting in posting_lists:
+        result = posting if result is None else np.intersect1d(result, posting, assume_unique=True)
+    return result
+
+
+def _category_value_postings(index, category, fields):
+    '''
+    Returns the measures where the given category is either not applicable, or has a value containing one of the
+    fields as a substring (matching the behaviour of the original regex filter, e.g. "65_74_years" matches the
+    "65_74_years|25_34_years" value of features with an age for both parents).
+    Matching is done once per distinct category value rather than once per measure.
+    '''
+    value_postings = index['category_value'].get(category, {})
+    matched = _union_postings(postings for value, postings in value_postings.items()
+                              if any(field in value for field in fields))
+    excluded = np.setdiff1d(index['category'].get(category, matched), matched, assume_unique=True)
+    return np.setdiff1d(np.arange(index['n_measures']), excluded, assume_unique=True)
+
+
 def return_categories(category_list = full_category_list):
     return category_list
 
@@ -49,17 +225,15 @@ def return_relevant_categories(tables_list = full_tables_list):
     OUTPUTS:
     LIST of categories available in in the selected tables
     '''
-    df_meta = pd.read_csv('{}\\Data\\Metadata\\Metadata_2016_w_Category_Values.csv'.format(env_path), dtype=cat_import_dtype)
+    index = load_measure_index()
 
-    # filter the dataframe to only include the input tables, using only the first 3 digits to avoid things like G57B 
+    # filter the measures to only include the input tables, using only the first 3 digits to avoid things like G57B 
     # being distinct from G57A, etc.
-    table_rest_df = df_meta[df_meta['DataPack file'].str[:3].isin(tables_list)]
-    
-    # sum the measure columns to determine those with measure counts > 0
-    cats_in_tbls = table_rest_df[full_category_list].count()
-    cats_in_tbls = cats_in_tbls[cats_in_tbls > 0]
+    table_postings = _union_postings(index['table'].get(table, []) for table in tables_list)
     
-    return cats_in_tbls.index.tolist()
+    # keep categories with at least one measure in the selected tables
+    return [category for category in full_category_list 
+            if np.intersect1d(index['category'][category], table_postings, assume_unique=True).size > 0]
 
 def return_relevant_tables(categories_list = full_category_list, category_field_list = [], category_intersection = False):
     '''
@@ -77,7 +251,7 @@ def return_relevant_tables(categories_list = full_category_list, category_field_
     Pandas dataframe object with two columns, one for the Datapack table file reference and one of the table name itself
     '''
 
-    df_cat_measure = pd.read_csv('{}\\Data\\Metadata\\Category_Measure_reference.csv'.format(env_path), dtype={'2016_Table':str})
+    df_cat_measure = load_metadata('category_measure')
     
     # filter for chosen categories + fields
     df_cat_measure = df_cat_measure[df_cat_measure['Category'].isin(categories_list)]
@@ -95,7 +269,7 @@ def return_relevant_tables(categories_list = full_category_list, category_field_
         
     table_list = list(set(table_list))
     
-    df_tbl = pd.read_csv('{}\\Data\\Metadata\\2016_table_reference.csv'.format(env_path), dtype=str)
+    df_tbl = load_metadata('table_reference')
     df_tbl = df_tbl[df_tbl['DataPack file'].isin(table_list)]
     return df_tbl[['DataPack file','Table name']]
 
@@ -118,40 +292,39 @@ def return_relevant_features(categories_list = full_category_list, tables_list =
     Pandas dataframe object with two columns, one for a user friendly measure description and one for the measure as referenced
     in the ABS documentation
     '''
-    df_meta = pd.read_csv('{}\\Data\\Metadata\\Metadata_2016_w_Category_Values.csv'.format(env_path), dtype=cat_import_dtype)
+    df_meta = load_metadata('category_values')
+    index = load_measure_index()
     
-    # sum the measure columns in order to create a quick and dirty "or" filter for multiple categories    
-    df_meta['filter_col'] = (df_meta[categories_list])[categories_list].count(axis=1)
-
-    # filter for category and table
+    # filter for category and table using the posting lists in the measure index: 
+    # a union of the selected categories by default, or an intersection where specified
+    category_postings = [index['category'].get(category, []) for category in categories_list]
     if category_intersection and len(categories_list)>1 and (categories_list != full_category_list):
-        df_meta = df_meta[(df_meta['filter_col']==len(categories_list)) & df_meta['DataPack file'].str[:3].isin(tables_list)]
+        measure_ids = _intersect_postings(category_postings)
     else:
-        df_meta = df_meta[(df_meta['filter_col']>0) & df_meta['DataPack file'].str[:3].isin(tables_list)]
+        measure_ids = _union_postings(category_postings)
+    measure_ids = np.intersect1d(measure_ids, 
+                                 _union_postings(index['table'].get(table, []) for table in tables_list), 
+                                 assume_unique=True)
     
     # filter for category subset
     if len(category_field_subset)>0:
-        # transform the subset list into an iterable dataframe
-        cfs_df = pd.DataFrame()
-        cfs_df['Field'] = [i[0] for i in [x.split("|") for x in category_field_subset]]
-        cfs_df['Cat'] = [i[1] for i in [x.split("|") for x in category_field_subset]]
+        # transform the subset list into a dictionary of {category: [fields]}
+        cfs_dict = {}
+        for field, cfs_category in [x.split("|")[:2] for x in category_field_subset]:
+            cfs_dict.setdefault(cfs_category, [])
+            if field not in cfs_dict[cfs_category]:
+                cfs_dict[cfs_category].append(field)
         
-        # iterate over each category to subset the applicable fields and filter the main df (still leaving nulls in place as well)
-        for cfs_category in cfs_df['Cat'].drop_duplicates().tolist():
-            cfs_fields = cfs_df[cfs_df['Cat']==cfs_category]['Field'].drop_duplicates().tolist()
-            # because of certain features which contain two of the same feature (e.g. parent age for male and female parent)
-            # need to filter for substrings by join the list with an or delimiter and applying a regex search
-            pattern = '|'.join(cfs_fields)
-            df_meta = df_meta[df_meta[cfs_category].str.contains(pattern, na=True)]
-            
-            # if this becomes a performance issue look into aho-corasick
-            # https://stackoverflow.com/questions/48541444/pandas-filtering-for-multiple-substrings-in-series/48600345#48600345
+        # intersect with the measures for each category which match the applicable fields (still leaving nulls in place as well)
+        for cfs_category, cfs_fields in cfs_dict.items():
+            measure_ids = np.intersect1d(measure_ids, _category_value_postings(index, cfs_category, cfs_fields), 
+                                         assume_unique=True)
 
+    df_meta = df_meta.iloc[measure_ids]
 
+    df_meta = df_meta[['Measures']].copy()
     df_meta['Measure Desc'] = df_meta['Measures'].str.replace('_',' ')
-    df_meta['Measure Desc'] = df_meta['Measure Desc'].str.replace('|',' | ')
-
-    df_meta = df_meta[['Measures','Measure Desc']]
+    df_meta['Measure Desc'] = df_meta['Measure Desc'].str.replace('|',' | ', regex=False)
 
     return df_meta
 
@@ -174,10 +347,11 @@ def return_features_subsets(categories_list = full_category_list, tables_list =
     '''
 
     # import Category_Measure_reference.csv as DF
-    df_cat_measure = pd.read_csv('{}\\Data\\Metadata\\Category_Measure_reference.csv'.format(env_path))
+    df_cat_measure = load_metadata('category_measure')
     
     # filter measure column based on isin list
-    df_cat_measure = df_cat_measure[df_cat_measure['Category'].isin(categories_list)]
+    df_cat_measure = df_cat_measure[df_cat_measure['Category'].isin(categories_list)].copy()
+    df_cat_measure['Category'] = df_cat_measure['Category'].astype(str)
     
     # filter tables for partial matches
     pattern = '|'.join(tables_list)
@@ -218,40 +392,80 @@ def return_selected_variables(tables_list, categories_list, category_values_list
 
 
 
-def load_census_csv(table_list, statistical_area_code='SA3'):
+def join_on_region_index(frames, verify_index=False):
+    '''
+    Joins a set of DataPack dataframes which are indexed by region code in a single pass. Each frame is aligned to the
+    output regions once and the aligned columns are concatenated, rather than building a new wide dataframe with each
+    pairwise merge.
+    Matches an inner merge on the region code: regions are kept in the order of the first frame and only where they
+    appear in every frame. Columns keep their own dtypes, and where a column name appears in more than one frame
+    only the first is kept.
+    
+    INPUTS
+    frames: LIST of pandas dataframes - indexed by region code
+    verify_index: BOOLEAN - instead of aligning the frames, check that the region codes are identical (and in the same
+        order) in every frame, raising a ValueError if not
+    
+    OUTPUTS
+    A pandas dataframe
+    '''
+    index = frames[0].index
+    for frame in frames[1:]:
+        if not frame.index.equals(index):
+            if verify_index:
+                raise ValueError('Region codes differ between tables, cannot join without aligning')
+            index = index[index.isin(frame.index)]
+    
+    seen = set()
+    pieces = []
+    for frame in frames:
+        # positions of the columns not already taken from an earlier frame
+        keep = []
+        for i, column in enumerate(frame.columns):
+            if column not in seen:
+                seen.add(column)
+                keep.append(i)
+        if not keep:
+            continue
+        piece = frame.iloc[:, keep]
+        if not frame.index.equals(index):
+            piece = piece.iloc[frame.index.get_indexer(index)]
+        piece.index = index
+        pieces.append(piece)
+    
+    if not pieces:
+        return pd.DataFrame(index=index)
+    # copying consolidates the pieces into one block per dtype, so later column inserts don't fragment the frame
+    return pd.concat(pieces, axis=1).copy()
+
+
+def load_census_csv(table_list, statistical_area_code='SA3', columns=None, verify_index=False):
     '''
-    Navigates the file structure to import the relevant files for specified data tables at a defined statistical area level
+    Navigates the file structure to import the relevant files for specified data tables at a defined statistical area level.
+    Files are read through the columnar DataPack cache (see cache_funcs) rather than parsed from csv on every call.
     
     INPUTS
     table_list: LIST of STRING objects - the ABS Census Datapack table to draw information from (G01-G59)
     statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
+    columns: LIST of STRING objects - optional, the measures to import. Defaults to all measures in each table.
+    verify_index: BOOLEAN - check the region codes are identical across tables rather than aligning them
+        (see join_on_region_index)
     
     OUTPUTS
     A pandas dataframe
     '''
     statistical_area_code = statistical_area_code.upper()
     
-    df_csv_load = pd.DataFrame()
-    for index, table in enumerate(table_list):
-        
-        if index==0:
-            df_csv_load = pd.read_csv('{}\\Data\\{}\\AUST\\2016Census_{}_AUS_{}.csv'.format(env_path,
-                                                                                statistical_area_code,
-                                                                                table,
-                                                                                statistical_area_code
-                                                                               ),
-                                       engine='python')
-        else:
-            temp_df = pd.read_csv('{}\\Data\\{}\\AUST\\2016Census_{}_AUS_{}.csv'.format(env_path,
-                                                                                statistical_area_code,
-                                                                                table,
-                                                                                statistical_area_code
-                                                                               ),
-                                       engine='python')
-            merge_col = df_csv_load.columns[0]
-            df_csv_load = pd.merge(df_csv_load, temp_df, on=merge_col)
+    frames = [cache_funcs.read_datapack(table, statistical_area_code, columns=columns, data_path=env_path) 
+              for table in table_list]
+    
+    if len(frames) == 0:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0]
     
-    return df_csv_load
+    frames = [df_csv_load.set_index(df_csv_load.columns[0]) for df_csv_load in frames]
+    return join_on_region_index(frames, verify_index).reset_index()
 
 
 def refine_measure_name(table_namer, string_item, category_item, category_list):
@@ -263,22 +477,32 @@ def refine_measure_name(table_namer, string_item, category_item, category_list):
     return table_namer + '|' + '_'.join([string_item.split("|")[i] for i in position_list])
 
 
-def load_table_refined(table_ref, category_list, statistical_area_code='SA3', drop_zero_area=True):
-    '''
-    Function for loading ABS census data tables, and refining/aggregating by a set of defined categories
-    (e.g. age, sex, occupation, English proficiency, etc.) where available.
-    
-    INPUTS
-    table_ref: STRING - the ABS Census Datapack table to draw information from (G01-G59)
-    category_list: LIST of STRING objects - Cetegorical informatio to slice/aggregate information from (e.g. Age)
-    statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
-    drop_zero_area: BOOLEAN - an option to remove "non-geographical" area data points such as "no fixed address" or "migratory"
-    '''
-    df_meta = pd.read_csv('{}\\Data\\Metadata\\Metadata_2016_refined.csv'.format(os.getcwd()))
-    index_reference = 'Area_index'
+# Memoised aggregation plans, in the format {(table, sorted categories, statistical area level): plan}
+aggregation_plan_cache_size = 512
+_aggregation_plans = OrderedDict()
+_aggregation_plans_source = {}
+_aggregation_plans_lock = threading.Lock()
+
+
+def _aggregation_plan_key(table_ref, category_list, statistical_area_code):
+    return (table_ref, tuple(sorted(set(category_list))), statistical_area_code.upper())
+
+
+def _check_aggregation_plan_source():
+    '''Clears the plan cache if the refined metadata has been reloaded since the plans were built'''
+    df_meta = load_metadata('refined')
+    with _aggregation_plans_lock:
+        if _aggregation_plans_source.get('refined') is not df_meta:
+            _aggregation_plans.clear()
+            _aggregation_plans_source['refined'] = df_meta
+
+
+def _compute_aggregation_plan(table_ref, category_list, statistical_area_code):
+    '''Slices the refined metadata for a table and category list to work out which measures to load and how to sum them'''
+    df_meta = load_metadata('refined')
     
     # slice meta based on table
-    meta_df_select = df_meta[df_meta['Profile table'].str.contains(table_ref)].copy()
+    meta_df_select = df_meta[df_meta['Profile table'].str.contains(table_ref)]
     
     # for category in filter_cats, slice based on category >0
     for cat in category_list:
@@ -296,51 +520,231 @@ def load_table_refined(table_ref, category_list, statistical_area_code='SA3', dr
     min_fields = meta_df_select['Number of Classes Excl Total'].min()
     meta_df_select = meta_df_select[meta_df_select['Number of Classes Excl Total'] == min_fields]
     
-    # Select the table file(s) to import
-    import_table_list = meta_df_select['DataPack file'].unique()
-    
-    # Import the SA data tables
-    df_data = load_census_csv(import_table_list, statistical_area_code.upper())
-    
-    # Select only columns included in the meta-sliced table above
-    df_data.set_index(df_data.columns[0], inplace=True)
-    refined_columns = meta_df_select.Short.tolist()
-    df_data = df_data[refined_columns]
-    
-    # aggregate data by:
-    # transposing the dataframe
-    df_data_t = df_data.T.reset_index()
-    df_data_t.rename(columns={ df_data_t.columns[0]: 'Short' }, inplace = True)
-    # merging with the refined meta_df to give table name, "Measures" and "Categories" fields
-    meta_merge_ref = meta_df_select[['Short','Table name','Measures','Categories']]
-    df_data_t = df_data_t.merge(meta_merge_ref, on='Short')
-    
     # from the "Categories" field, split an individual entry by the "|" character
     # to give the index of the measure you are interested in grouping by,
-    # create a new column based on splitting the "Measure" field and selecting the value of this index/indices
+    # create a new name based on splitting the "Measure" field and selecting the value of this index/indices
     # Merge above with the table name to form "[Table_Name]|[groupby_value]" to have a good naming convention
     # eg "Method_of_Travel_to_Work_by_Sex|Three_methods_Females"
-    df_data_t[index_reference] = df_data_t.apply(lambda x: refine_measure_name(x['Table name'], 
-                                                                               x['Measures'], 
-                                                                               x['Categories'], 
-                                                                               category_list), axis=1)
+    target_columns = [refine_measure_name(table_namer, string_item, category_item, category_list) 
+                      for table_namer, string_item, category_item in zip(meta_df_select['Table name'], 
+                                                                          meta_df_select['Measures'], 
+                                                                          meta_df_select['Categories'])]
+    group_codes, groups = pd.factorize(pd.Series(target_columns, dtype=object), sort=True)
     
-    # then groupby this new column 
-    # then transpose again and either create the base data_df for future merges or merge with the already existing data_df
-    df_data_t = df_data_t.drop(['Short','Table name','Measures','Categories'], axis=1)
-    df_data_t = df_data_t.groupby([index_reference]).sum()
-    df_data_t = df_data_t.T
+    return {
+        'table': table_ref,
+        'categories': list(category_list),
+        'statistical_area_code': statistical_area_code,
+        'source_files': meta_df_select['DataPack file'].unique().tolist(),
+        'source_columns': meta_df_select['Short'].tolist(),
+        'target_columns': target_columns,
+        'groups': groups.tolist(),
+        'group_codes': group_codes.tolist(),
+        }
+
+
+def build_aggregation_plan(table_ref, category_list, statistical_area_code='SA3'):
+    '''
+    Returns the aggregation plan for loading a table refined by a set of categories: which DataPack files and columns
+    to read, the aggregated column each source column is summed into, and the grouping used to sum them.
+    Plans only depend on the metadata, so are memoised in an LRU cache keyed by table, sorted categories and
+    statistical area level, and are cleared when the refined metadata is reloaded.
+    
+    INPUTS
+    table_ref: STRING - the ABS Census Datapack table to draw information from (G01-G59)
+    category_list: LIST of STRING objects - Categorical information to slice/aggregate information from (e.g. Age)
+    statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
+    
+    OUTPUTS
+    DICTIONARY with keys:
+        'table', 'categories', 'statistical_area_code' - the inputs the plan was built for
+        'source_files' - LIST of DataPack files to read (e.g. G09A, G09B)
+        'source_columns' - LIST of measures to read from the source files
+        'target_columns' - LIST of the aggregated column each source column is summed into
+        'groups' - LIST of the distinct aggregated columns, sorted
+        'group_codes' - LIST giving the position in groups of each source column
+    Plans are plain lists and strings so can be saved with save_aggregation_plans. The returned plan is shared by
+    all callers so should be treated as read only.
+    '''
+    _check_aggregation_plan_source()
+    
+    key = _aggregation_plan_key(table_ref, category_list, statistical_area_code)
+    with _aggregation_plans_lock:
+        plan = _aggregation_plans.get(key)
+        if plan is not None:
+            _aggregation_plans.move_to_end(key)
+            return plan
+    
+    plan = _compute_aggregation_plan(*key)
+    with _aggregation_plans_lock:
+        _aggregation_plans[key] = plan
+        while len(_aggregation_plans) > aggregation_plan_cache_size:
+            _aggregation_plans.popitem(last=False)
+    
+    return plan
+
+
+def prewarm_aggregation_plans(plan_specs):
+    '''Builds the aggregation plans for a list of (table, category_list, statistical_area_code) tuples, e.g. at app startup'''
+    return [build_aggregation_plan(*spec) for spec in plan_specs]
+
+
+def save_aggregation_plans(path, plans=None):
+    '''
+    Saves aggregation plans (defaulting to all plans currently in the cache) to a json file, along with the modified
+    time of the refined metadata they were built from
+    '''
+    if plans is None:
+        # drop any cached plans built from an older copy of the metadata first
+        _check_aggregation_plan_source()
+        plans = list(_aggregation_plans.values())
+    with open(path, 'w') as f:
+        json.dump({'refined_mtime': os.path.getmtime(_metadata_path('refined')), 'plans': plans}, f)
+
+
+def load_aggregation_plans(path):
+    '''
+    Loads aggregation plans saved by save_aggregation_plans into the plan cache, returning the list of plans. The
+    plans are skipped (and an empty list returned) if the refined metadata has changed since they were saved.
+    '''
+    with open(path) as f:
+        saved = json.load(f)
+    
+    # files saved before the metadata modified time was recorded are plain lists, and can't be checked
+    if not isinstance(saved, dict) or saved['refined_mtime'] != os.path.getmtime(_metadata_path('refined')):
+        return []
+    plans = saved['plans']
+    
+    _check_aggregation_plan_source()
+    with _aggregation_plans_lock:
+        for plan in plans:
+            _aggregation_plans[_aggregation_plan_key(plan['table'], plan['categories'], plan['statistical_area_code'])] = plan
+        while len(_aggregation_plans) > aggregation_plan_cache_size:
+            _aggregation_plans.popitem(last=False)
+    
+    return plans
+
+
+def sum_measure_groups(values, group_codes, n_groups):
+    '''
+    Sums the columns of a (regions x measures) array into aggregated columns as a single sparse matrix product.
+    
+    INPUTS
+    values: numpy array - one row per region and one column per measure
+    group_codes: numpy array - the position of each measure's aggregated column
+    n_groups: INTEGER - the number of aggregated columns
+    
+    OUTPUTS
+    numpy array with one row per region and one column per aggregated column
+    '''
+    if np.issubdtype(values.dtype, np.floating):
+        # match the groupby sum behaviour of treating missing values as zero
+        values = np.where(np.isnan(values), 0, values)
+    
+    # sparse (measures x groups) matrix with a 1 where a measure is summed into a group
+    aggregation_matrix = sparse.csr_matrix((np.ones(len(group_codes), dtype=values.dtype), 
+                                            (np.arange(len(group_codes)), group_codes)), 
+                                           shape=(len(group_codes), n_groups))
+    return np.asarray(aggregation_matrix.T @ values.T).T
+
+
+def aggregate_measures(df_data, groups, group_codes):
+    '''
+    Sums the columns of a region by measure dataframe into aggregated columns, as a single sparse matrix product
+    on the underlying array rather than transposing and grouping the dataframe.
+    
+    INPUTS
+    df_data: Pandas dataframe object - indexed by region code with one column per measure
+    groups: LIST of STRING objects - the aggregated column names
+    group_codes: numpy array - the position in groups of each column of df_data
+    
+    OUTPUTS
+    A pandas dataframe indexed by region code with one column per group
+    '''
+    aggregated = sum_measure_groups(df_data.to_numpy(), group_codes, len(groups))
+    
+    return pd.DataFrame(aggregated, index=df_data.index, columns=pd.Index(groups, name='Area_index'))
+
+
+def zero_area_codes():
+    '''Returns the set of region codes for "non-geographical" areas such as "no fixed address" or "migratory"'''
+    return set(load_metadata('zero_area')['AGSS_Code_2016'].tolist())
+
+
+def apply_aggregation_plan(plan, df_data, drop_zero_area=True):
+    '''
+    Sums already loaded DataPack columns into an aggregation plan's aggregated columns.
+    
+    INPUTS
+    plan: DICTIONARY - an aggregation plan as returned by build_aggregation_plan
+    df_data: Pandas dataframe object - indexed by region code, including at least the plan's source columns
+    drop_zero_area: BOOLEAN - an option to remove "non-geographical" area data points such as "no fixed address" or "migratory"
+    
+    OUTPUTS
+    A pandas dataframe indexed by region code with one column per aggregated measure
+    '''
+    df_data = df_data[plan['source_columns']]
+    
+    # sum the measures into the aggregated columns directly on the region by measure array
+    df_data_t = aggregate_measures(df_data, plan['groups'], np.asarray(plan['group_codes'], dtype=np.intp))
     
     if drop_zero_area:
-        df_zero_area = pd.read_csv('{}\\Data\\Metadata\\Zero_Area_Territories.csv'.format(os.getcwd()))
-        zero_indicies = set(df_zero_area['AGSS_Code_2016'].tolist())
-        zero_indicies_drop = set(df_data_t.index.values).intersection(zero_indicies)
+        zero_indicies_drop = set(df_data_t.index.values).intersection(zero_area_codes())
         df_data_t = df_data_t.drop(zero_indicies_drop, axis=0)
     
     return df_data_t
 
 
-def load_tables_specify_cats(table_list, category_list, statistical_area_code='SA3'):
+def execute_aggregation_plan(plan, drop_zero_area=True):
+    '''
+    Loads the DataPack columns listed in an aggregation plan and sums them into the plan's aggregated columns.
+    
+    INPUTS
+    plan: DICTIONARY - an aggregation plan as returned by build_aggregation_plan
+    drop_zero_area: BOOLEAN - an option to remove "non-geographical" area data points such as "no fixed address" or "migratory"
+    
+    OUTPUTS
+    A pandas dataframe indexed by region code with one column per aggregated measure
+    '''
+    # Import the SA data tables, reading only the columns included in the plan
+    df_data = load_census_csv(plan['source_files'], plan['statistical_area_code'], columns=plan['source_columns'])
+    df_data.set_index(df_data.columns[0], inplace=True)
+    
+    return apply_aggregation_plan(plan, df_data, drop_zero_area)
+
+
+def load_table_refined(table_ref, category_list, statistical_area_code='SA3', drop_zero_area=True):
+    '''
+    Function for loading ABS census data tables, and refining/aggregating by a set of defined categories
+    (e.g. age, sex, occupation, English proficiency, etc.) where available.
+    
+    INPUTS
+    table_ref: STRING - the ABS Census Datapack table to draw information from (G01-G59)
+    category_list: LIST of STRING objects - Cetegorical informatio to slice/aggregate information from (e.g. Age)
+    statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
+    drop_zero_area: BOOLEAN - an option to remove "non-geographical" area data points such as "no fixed address" or "migratory"
+    '''
+    plan = build_aggregation_plan(table_ref, category_list, statistical_area_code)
+    return execute_aggregation_plan(plan, drop_zero_area)
+
+
+def result_sources(plans, statistical_area_code='SA3', drop_zero_area=True):
+    '''
+    Fingerprints the files a feature matrix is built from: the source hash of each DataPack file read by the plans
+    and the modified time of the metadata used to build them. Used in the result cache key, so a cached result is
+    rebuilt when any of these files change.
+    '''
+    sources = {'metadata|refined': os.path.getmtime(_metadata_path('refined'))}
+    if drop_zero_area:
+        sources['metadata|zero_area'] = os.path.getmtime(_metadata_path('zero_area'))
+    for datapack_file in dict.fromkeys(x for plan in plans for x in plan['source_files']):
+        sources[datapack_file] = cache_funcs.datapack_manifest(datapack_file, statistical_area_code, 
+                                                               env_path)['source_hash']
+    return sources
+
+
+def load_tables_specify_cats(table_list, category_list, statistical_area_code='SA3', verify_index=False, 
+                             drop_zero_area=True, use_cache=True, n_jobs=1, backend='thread', dedup_metadata=False):
     '''
     Function for loading ABS census data tables, and refining/aggregating by a set of defined categories
     (e.g. age, sex, occupation, English proficiency, etc.) where available.
@@ -349,112 +753,613 @@ def load_tables_specify_cats(table_list, category_list, statistical_area_code='S
     table_list: LIST of STRING objects - list of the ABS Census Datapack tables to draw information from (G01-G59)
     category_list: LIST of STRING objects - Cetegorical information to slice/aggregate information from (e.g. Age)
     statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
+    verify_index: BOOLEAN - check the region codes are identical across tables rather than aligning them
+        (see join_on_region_index)
+    drop_zero_area: BOOLEAN - an option to remove "non-geographical" area data points such as "no fixed address" or "migratory"
+    use_cache: BOOLEAN - return a previously loaded result for the same tables, categories and statistical area from the 
+        result cache (see cache_funcs), and add new results to it
+    n_jobs: INTEGER - the number of tables to load and aggregate concurrently, -1 to use all cores
+    backend: STRING - 'thread' or 'process', the type of worker pool to use when n_jobs is not 1
+    dedup_metadata: BOOLEAN - skip loading aggregated columns which the metadata shows duplicate a column of an 
+        earlier table (see metadata_duplicate_groups)
     
     OUTPUTS
     A pandas dataframe
     '''
-    for index, table in enumerate(table_list):
-        if index==0:
-            df = load_table_refined(table, category_list, statistical_area_code)
-            df.reset_index(inplace=True)
+    plans = [build_aggregation_plan(table, category_list, statistical_area_code) for table in table_list]
+    
+    if use_cache:
+        cache_key = cache_funcs.result_cache_key(table_list, category_list, statistical_area_code, drop_zero_area,
+                                                 sources=result_sources(plans, statistical_area_code, drop_zero_area),
+                                                 verify_index=verify_index, dedup_metadata=dedup_metadata)
+        df = cache_funcs.get_cached_result(cache_key, data_path=env_path)
+        if df is not None:
+            return df
+    
+    if dedup_metadata:
+        # plans left with no columns still read their region codes, so dropping columns never changes the regions
+        plans = [drop_plan_groups(plan, drop_groups) for plan, drop_groups in zip(plans, metadata_duplicate_groups(plans))]
+    
+    if n_jobs == 1 or len(plans) < 2:
+        frames = [execute_aggregation_plan(plan, drop_zero_area) for plan in plans]
+    else:
+        if backend == 'thread':
+            executor_class = ThreadPoolExecutor
+        elif backend == 'process':
+            executor_class = ProcessPoolExecutor
         else:
-            temp_df = load_table_refined(table, category_list, statistical_area_code)
-            temp_df.reset_index(inplace=True)
-            merge_col = df.columns[0]
-            df = pd.merge(df, temp_df, on=merge_col)
+            raise ValueError("backend must be 'thread' or 'process', not {}".format(backend))
+        n_workers = min(len(plans), os.cpu_count() if n_jobs == -1 else n_jobs)
+        
+        # tables are independent until they are joined, executor.map keeps the results in table_list order
+        with executor_class(max_workers=n_workers) as executor:
+            frames = list(executor.map(execute_aggregation_plan, plans, repeat(drop_zero_area)))
     
-    df.set_index(df.columns[0], inplace=True)
+    if len(frames) == 1:
+        df = frames[0]
+    else:
+        df = join_on_region_index(frames, verify_index)
+    
+    if use_cache:
+        cache_funcs.put_cached_result(cache_key, df, data_path=env_path)
+        # return a shallow copy, as a cache hit would, so the caller adding or dropping columns can't change the cache
+        df = df.copy(deep=False)
     
     return df
 
 
-def sort_series_abs(S):
-    '''Takes a pandas Series object and returns the series sorted by absolute value'''
-    temp_df = pd.DataFrame(S)
-    temp_df['abs'] = temp_df.iloc[:,0].abs()
-    temp_df.sort_values('abs', ascending = False, inplace = True)
-    return temp_df.iloc[:,0]
+def _stream_layout(table_list, category_list, statistical_area_code, denominator, drop_zero_area):
+    '''
+    Works out everything needed to stream a set of refined tables in chunks: the memory-mapped source columns for each
+    aggregation plan, the row positions of each DataPack file relative to the first file's regions, the regions to keep
+    and the output columns.
+    '''
+    statistical_area_code = statistical_area_code.upper()
+    plans = [build_aggregation_plan(table, category_list, statistical_area_code) for table in table_list]
+    
+    # every plan reading a source file needs its columns opened, so gather the columns of all plans for each file
+    file_columns = {}
+    for plan in plans:
+        for datapack_file in plan['source_files']:
+            file_columns.setdefault(datapack_file, []).extend(plan['source_columns'])
+    
+    # open the memory-mapped columns for each source file, keeping the region codes of the first file as the master index
+    sources = {}
+    master_codes = None
+    for datapack_file, file_source_columns in file_columns.items():
+        arrays = cache_funcs.read_mmap_columns(datapack_file, statistical_area_code, file_source_columns, env_path)
+        index_column = next(iter(arrays))
+        if master_codes is None:
+            master_codes, master_name = np.asarray(arrays[index_column]), index_column
+        sources[datapack_file] = {'arrays': arrays, 'codes': np.asarray(arrays[index_column])}
+    
+    if denominator is not None:
+        arrays = cache_funcs.read_mmap_columns(denominator[0], statistical_area_code, [denominator[1]], env_path)
+        sources['denominator'] = {'arrays': {'denominator': arrays[denominator[1]]}, 
+                                  'codes': np.asarray(arrays[next(iter(arrays))])}
+    
+    # keep the regions which appear in every file, matching the inner join of load_tables_specify_cats
+    keep = np.ones(len(master_codes), dtype=bool)
+    for source in sources.values():
+        if np.array_equal(source['codes'], master_codes):
+            source['positions'] = None
+        else:
+            source['positions'] = pd.Index(source['codes']).get_indexer(master_codes)
+            keep &= source['positions'] >= 0
+    
+    if drop_zero_area:
+        keep &= ~np.isin(master_codes, list(zero_area_codes()))
+    
+    if denominator is not None:
+        denominator_values = _gather_stream_column(sources['denominator'], 'denominator', np.flatnonzero(keep))
+        denominator_keep = np.zeros(len(keep), dtype=bool)
+        denominator_keep[np.flatnonzero(keep)] = ~np.isnan(denominator_values) & (denominator_values > 0)
+        keep &= denominator_keep
+    
+    # map each plan's aggregated columns to output positions, keeping only the first of any duplicated column names
+    columns = []
+    plan_targets = []
+    for plan in plans:
+        column_sources = []
+        for column in plan['source_columns']:
+            datapack_file = next((x for x in plan['source_files'] if column in sources[x]['arrays']), None)
+            if datapack_file is None:
+                raise KeyError('Measure {} not found in DataPack files {}'.format(column, ', '.join(plan['source_files'])))
+            column_sources.append((datapack_file, column))
+        targets = []
+        for group in plan['groups']:
+            if group in columns:
+                targets.append(-1)
+            else:
+                targets.append(len(columns))
+                columns.append(group)
+        plan_targets.append((plan, column_sources, np.asarray(targets)))
+    
+    rows = np.flatnonzero(keep)
+    return {
+        'sources': sources,
+        'plan_targets': plan_targets,
+        'rows': rows,
+        'index': pd.Index(master_codes[rows], name=master_name),
+        'columns': columns,
+        'denominator': denominator is not None,
+        }
+
+
+def _gather_stream_column(source, column, rows):
+    '''Reads the given master index rows of a memory-mapped column, mapping them to the file's own row order if needed'''
+    file_rows = rows if source['positions'] is None else source['positions'][rows]
+    return np.asarray(source['arrays'][column][file_rows], dtype=np.float64)
+
+
+def _stream_chunk(layout, rows, dtype):
+    '''Aggregates (and optionally scales) one chunk of regions, only reading those rows of the memory-mapped columns'''
+    chunk = np.empty((len(rows), len(layout['columns'])), dtype=dtype)
+    
+    for plan, column_sources, targets in layout['plan_targets']:
+        block = np.empty((len(rows), len(column_sources)), dtype=np.float64)
+        for i, (datapack_file, column) in enumerate(column_sources):
+            block[:, i] = _gather_stream_column(layout['sources'][datapack_file], column, rows)
+        summed = sum_measure_groups(block, np.asarray(plan['group_codes'], dtype=np.intp), len(plan['groups']))
+        chunk[:, targets[targets >= 0]] = summed[:, targets >= 0]
+    
+    if layout['denominator']:
+        chunk /= _gather_stream_column(layout['sources']['denominator'], 'denominator', rows).astype(dtype)[:, None]
+    
+    return chunk
 
 
-def WFH_create_Xy(stat_a_level, load_tables, load_features):
+def stream_tables_specify_cats(table_list, category_list, statistical_area_code='SA3', chunk_size=10000, 
+                               denominator=None, drop_zero_area=True, dtype=np.float32):
     '''
-    A function which compiles a set of background information from defined ABS census tables and 
-    creates input and output vectors to allow model training for the  "Work from home participation 
-    rate" in a given region. Cleans the data for outliers (defined as >3 standard deviations from the mean) in the
-    WFH participation rate, and scales all data by dividing by the "Total Population" feature for each region.
+    Generator version of load_tables_specify_cats for SA1 scale data. Reads the memory-mapped DataPack columns
+    (see cache_funcs) in chunks of regions aligned on region code, and applies the column selection, category
+    aggregation, zero area drop and optional scaling to each chunk, so peak memory depends on chunk_size rather than
+    the number of regions.
     
     INPUTS
-    stat_a_level - String. The statistical area level of information the data should be drawn from (SA1-3)
-    load_tables - List of Strings. A list of ABS census datapack tables to draw data from (G01-59)
-    load_features - List of Strings. A list of population characteristics to use in analysis (Age, Sex, labor force status, etc.)
+    table_list: LIST of STRING objects - list of the ABS Census Datapack tables to draw information from (G01-G59)
+    category_list: LIST of STRING objects - Categorical information to slice/aggregate information from (e.g. Age)
+    statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
+    chunk_size: INTEGER - the number of regions in each chunk
+    denominator: TUPLE of STRING objects - optional, the (DataPack file, measure) to divide every feature by,
+        e.g. ('G01', 'Tot_P_P') to scale by the total population of each region. Regions where this is zero or
+        missing are dropped.
+    drop_zero_area: BOOLEAN - an option to remove "non-geographical" area data points such as "no fixed address" or "migratory"
+    dtype: numpy dtype of the output values
+    
+    YIELDS
+    Pandas dataframes of up to chunk_size regions, indexed by region code
+    '''
+    layout = _stream_layout(table_list, category_list, statistical_area_code, denominator, drop_zero_area)
+    for start in range(0, len(layout['rows']), chunk_size):
+        chunk = _stream_chunk(layout, layout['rows'][start:start + chunk_size], dtype)
+        yield pd.DataFrame(chunk, index=layout['index'][start:start + chunk_size], columns=layout['columns'])
+
+
+def load_tables_streamed(table_list, category_list, statistical_area_code='SA3', chunk_size=10000, 
+                         denominator=None, drop_zero_area=True, dtype=np.float32, as_frame=True):
+    '''
+    Loads refined tables chunk by chunk into a single preallocated array, see stream_tables_specify_cats for inputs.
     
     OUTPUTS
-    X - pandas DataFrame - a dataframe of features from the census datapacks tables, normalised by dividing each feature by 
-                            the population attributable to the region
-    y - pandas series - the Work from Home Participation Rate by region
+    A pandas dataframe if as_frame is True, otherwise a tuple of (numpy array, region code index, list of columns)
+    '''
+    layout = _stream_layout(table_list, category_list, statistical_area_code, denominator, drop_zero_area)
+    
+    values = np.empty((len(layout['rows']), len(layout['columns'])), dtype=dtype)
+    for start in range(0, len(layout['rows']), chunk_size):
+        values[start:start + chunk_size] = _stream_chunk(layout, layout['rows'][start:start + chunk_size], dtype)
+    
+    if as_frame:
+        return pd.DataFrame(values, index=layout['index'], columns=layout['columns'])
+    return values, layout['index'], layout['columns']
+
+
+def _column_digest(values):
+    '''Hashes a column's values, normalising numeric columns to float64 so that e.g. 5 and 5.0 hash the same'''
+    if np.issubdtype(values.dtype, np.number) or np.issubdtype(values.dtype, np.bool_):
+        # adding 0.0 maps -0.0 to 0.0 so values which compare equal have the same bytes
+        buffer = np.ascontiguousarray(values, dtype=np.float64) + 0.0
+    else:
+        buffer = pd.util.hash_array(np.asarray(values, dtype=object))
+    if xxhash is not None:
+        return xxhash.xxh3_128_digest(memoryview(buffer))
+    return hashlib.blake2b(memoryview(buffer), digest_size=16).digest()
+
+
+def _columns_equal(left, right):
+    if left.dtype != object and right.dtype != object:
+        return np.array_equal(left.astype(np.float64), right.astype(np.float64), equal_nan=True)
+    return pd.Series(left).equals(pd.Series(right))
+
+
+def drop_duplicate_columns(df):
+    '''
+    Removes columns whose values duplicate an earlier column, without transposing the dataframe. Each column's
+    buffer is hashed and exact equality is only checked between columns with the same hash, so dtypes are
+    kept and memory stays at roughly one column at a time.
     
+    INPUTS
+    df: Pandas dataframe object
+    
+    OUTPUTS
+    A pandas dataframe with the first of each set of duplicated columns kept
     '''
-    # Load table 59 (the one with commute mechanism) and have a quick look at the distribution of WFH by sex
-    response_vector = 'WFH_Participation'
-    df_travel = load_table_refined('G59', ['Number of Commuting Methods'], statistical_area_code=stat_a_level)
-    cols_to_delete = [x for x in df_travel.columns if 'Worked_at_home' not in x]
-    df_travel.drop(cols_to_delete,axis=1, inplace=True)
+    buckets = {}
+    keep = []
+    for i in range(df.shape[1]):
+        values = df.iloc[:, i].to_numpy()
+        bucket = buckets.setdefault(_column_digest(values), [])
+        if any(_columns_equal(values, df.iloc[:, j].to_numpy()) for j in bucket):
+            continue
+        bucket.append(i)
+        keep.append(i)
+    
+    return df.iloc[:, keep]
+
 
-    df_pop = load_census_csv(['G01'], statistical_area_code=stat_a_level)
-    df_pop.set_index(df_pop.columns[0], inplace=True)
-    df_pop = df_pop.drop([x for x in df_pop.columns if 'Tot_P_P' not in x], axis=1)
-    df_travel = df_travel.merge(df_pop, left_index=True, right_index=True)
+def metadata_duplicate_groups(plans):
+    '''
+    Finds aggregated columns which count the same thing in different tables, based on the metadata rather than
+    the data (where the ABS random adjustments to small counts stop exact matches). Two columns are treated as
+    the same if their tables cover the same population (the "Table population" field of 2016_table_reference.csv)
+    and they are aggregated to the same category values, e.g. "Age by Sex|Males" and 
+    "Country of Birth of Person by Age by Sex|Males". Tables refined to no category values, and the "Selected ..." 
+    summary tables (e.g. G01) which don't partition their population, are never treated as duplicates.
     
-    # Create new "Work From Home Participation Rate" vector to ensure consistency across regions
-    # Base this off population who worked from home divided by total population in the region
-    df_travel[response_vector] = (df_travel['Method of Travel to Work by Sex|Worked_at_home']/
-                                  df_travel['Tot_P_P'])
-    # Drop the original absolute values column
-    df_travel = df_travel.drop(['Method of Travel to Work by Sex|Worked_at_home'], axis=1)
+    INPUTS
+    plans: LIST of aggregation plans, as returned by build_aggregation_plan
     
-    # load input vectors
-    input_vectors = load_tables_specify_cats(load_tables, load_features, statistical_area_code=stat_a_level)
+    OUTPUTS
+    LIST with, for each plan, the set of its aggregated columns which duplicate a column of an earlier plan
+    '''
+    df_tbl = load_metadata('table_reference')
+    table_populations = dict(zip(df_tbl['DataPack file'].str.strip(), df_tbl['Table population']))
+    table_names = dict(zip(df_tbl['DataPack file'].str.strip(), df_tbl['Table name'].str.strip()))
     
-    # Remove duplicate column values
-    input_vectors = input_vectors.T.drop_duplicates().T
+    seen = set()
+    duplicates = []
+    for plan in plans:
+        plan_duplicates = set()
+        source_file = plan['source_files'][0] if len(plan['source_files']) > 0 else None
+        population = table_populations.get(source_file)
+        if population is not None and not table_names.get(source_file, '').startswith('Selected'):
+            for group in plan['groups']:
+                category_values = group.split('|', 1)[1]
+                if category_values == '':
+                    continue
+                if (population, category_values) in seen:
+                    plan_duplicates.add(group)
+                seen.add((population, category_values))
+        duplicates.append(plan_duplicates)
+    
+    return duplicates
 
-    # Bring in total population field and scale all the values by this item
-    input_vectors = input_vectors.merge(df_pop, left_index=True, right_index=True)
 
-    # convert input features to numeric
-    cols = input_vectors.columns
-    input_vectors[cols] = input_vectors[cols].apply(pd.to_numeric, errors='coerce')
+def drop_plan_groups(plan, drop_groups):
+    '''Returns a copy of an aggregation plan without the given aggregated columns, or the plan itself if there are none to drop'''
+    if len(drop_groups) == 0:
+        return plan
+    
+    keep_columns = [i for i, target in enumerate(plan['target_columns']) if target not in drop_groups]
+    target_columns = [plan['target_columns'][i] for i in keep_columns]
+    group_codes, groups = pd.factorize(pd.Series(target_columns, dtype=object), sort=True)
+    
+    pruned_plan = dict(plan)
+    pruned_plan.update({
+        'source_columns': [plan['source_columns'][i] for i in keep_columns],
+        'target_columns': target_columns,
+        'groups': groups.tolist(),
+        'group_codes': group_codes.tolist(),
+        })
+    return pruned_plan
+
 
-    # Drop rows with zero population
-    input_vectors = input_vectors.dropna(subset=['Tot_P_P'])
-    input_vectors = input_vectors[input_vectors['Tot_P_P'] > 0]
+# Commonly used denominators for scaling features, as (DataPack file, measure)
+denominators = {
+    'persons': ('G01', 'Tot_P_P'),
+}
+
+
+def load_denominator(denominator, statistical_area_code='SA3'):
+    '''
+    Loads a single measure to scale features by, e.g. the total population of each region.
+    
+    INPUTS
+    denominator: TUPLE of STRING objects, or STRING - the (DataPack file, measure) to load, e.g. ('G01', 'Tot_P_P'),
+        or a key of the denominators dictionary
+    statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
+    
+    OUTPUTS
+    A pandas series indexed by region code, named after the measure
+    '''
+    if isinstance(denominator, str):
+        denominator = denominators[denominator]
+    datapack_file, measure = denominator
+    df_denominator = load_census_csv([datapack_file], statistical_area_code, columns=[measure])
+    return df_denominator.set_index(df_denominator.columns[0])[measure]
+
+
+def normalise_features(df, denominator, dtype=np.float64, drop_invalid=True):
+    '''
+    Scales every feature by a per region denominator (e.g. population, households or dwellings) as a single
+    broadcast division on one numeric block, rather than converting and dividing column by column.
+    
+    INPUTS
+    df: Pandas dataframe object - features indexed by region code
+    denominator: Pandas series indexed by region code, or STRING naming a column of df. A named column is
+        used as the denominator and not included in the output.
+    dtype: numpy dtype of the output block, float64 or float32
+    drop_invalid: BOOLEAN - drop regions where the denominator is zero or missing, otherwise their features are
+        set to NaN
+    
+    OUTPUTS
+    A pandas dataframe of the scaled features
+    '''
+    if isinstance(denominator, str):
+        df, denominator = df.drop(denominator, axis=1), df[denominator]
+    
+    # only columns which aren't already numeric need converting, anything unparseable becomes NaN
+    non_numeric = [x for x in df.columns if not pd.api.types.is_numeric_dtype(df[x])]
+    if len(non_numeric) > 0:
+        df = df.copy()
+        df[non_numeric] = df[non_numeric].apply(pd.to_numeric, errors='coerce')
+    
+    values = df.to_numpy(dtype=dtype)
+    denominator_values = pd.to_numeric(denominator.reindex(df.index), errors='coerce').to_numpy(dtype=dtype)
+    valid = np.isfinite(denominator_values) & (denominator_values > 0)
+    
+    if drop_invalid:
+        values = values[valid] / denominator_values[valid][:, None]
+        index = df.index[valid]
+    else:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = values / denominator_values[:, None]
+        values[~valid] = np.nan
+        index = df.index
+    
+    return pd.DataFrame(values, index=index, columns=df.columns)
 
-    # Scale all factors by total region population
-    for cols in input_vectors.columns:
-        if 'Tot_P_P' not in cols:
-            input_vectors[cols] = input_vectors[cols]/input_vectors['Tot_P_P']
 
-    # merge and drop na values from the response vector
-    df_travel = df_travel.merge(input_vectors, how='left', left_index=True, right_index=True)
-    df_travel = df_travel.dropna(subset=[response_vector])
+def resolve_measure(measure, table_ref=None):
+    '''
+    Finds the DataPack file holding a measure, e.g. one selected in the dashboard's measure dropdown.
+    
+    INPUTS
+    measure: STRING - the measure's "Short" column name or its "Measures" description in the refined metadata
+    table_ref: STRING - optional, the table to look in where the same description is used in several tables
+    
+    OUTPUTS
+    TUPLE of (DataPack file, Short column name)
+    '''
+    df_meta = load_metadata('refined')
+    match = df_meta[(df_meta['Short'] == measure) | (df_meta['Measures'] == measure)]
+    if table_ref is not None:
+        match = match[match['DataPack file'].str.startswith(table_ref)]
+    if len(match) == 0:
+        raise ValueError('Measure {} not found in the refined metadata'.format(measure))
+    return match['DataPack file'].iloc[0], match['Short'].iloc[0]
+
+
+def _resolve_target(target_measure, statistical_area_code):
+    '''Converts a target measure specification (see create_Xy) into a dictionary describing how to load it'''
+    if isinstance(target_measure, str):
+        datapack_file, measure = resolve_measure(target_measure)
+        return {'datapack_file': datapack_file, 'measure': measure, 'label': measure}
+    if len(target_measure) == 2:
+        return {'datapack_file': target_measure[0], 'measure': target_measure[1], 'label': target_measure[1]}
+    table_ref, category_list, column = target_measure
+    plan = build_aggregation_plan(table_ref, category_list, statistical_area_code)
+    return {'plan': plan, 'measure': column, 'label': column}
+
+
+def load_Xy_sources(target_measures, denominator, table_list, category_list, statistical_area_code='SA3', 
+                    drop_zero_area=True):
+    '''
+    Loads the features, target measures and denominator for modelling in a single pass over the cached DataPack
+    files: the columns needed from each file (by the feature aggregation plans, the targets and the denominator) are
+    gathered first so that every file is read once and shared between X and y.
+    
+    INPUTS
+    target_measures: LIST of target measure specifications, see create_Xy
+    denominator: see create_Xy
+    table_list: LIST of STRING objects - list of the ABS Census Datapack tables to draw features from (G01-G59)
+    category_list: LIST of STRING objects - Categorical information to slice/aggregate features by (e.g. Age)
+    statistical_area_code: STRING - the ABS statistical area level of detail required (SA1-SA3)
+    drop_zero_area: BOOLEAN - an option to remove "non-geographical" area data points such as "no fixed address" or "migratory"
+    
+    OUTPUTS
+    features - pandas dataframe of the (unscaled) refined features
+    targets - pandas dataframe with one (unscaled) column per target measure, named by the target's label
+    denominator - pandas series of the denominator measure
+    '''
+    statistical_area_code = statistical_area_code.upper()
+    if isinstance(denominator, str):
+        denominator = denominators[denominator]
+    feature_plans = [build_aggregation_plan(table, category_list, statistical_area_code) for table in table_list]
+    targets = [_resolve_target(x, statistical_area_code) for x in target_measures]
+    
+    # work out the columns needed from each DataPack file so each one is only read once
+    file_columns = OrderedDict()
+    for plan in feature_plans + [x['plan'] for x in targets if 'plan' in x]:
+        for datapack_file in plan['source_files']:
+            file_columns.setdefault(datapack_file, []).extend(plan['source_columns'])
+    for target in targets:
+        if 'plan' not in target:
+            file_columns.setdefault(target['datapack_file'], []).append(target['measure'])
+    file_columns.setdefault(denominator[0], []).append(denominator[1])
+    
+    loaded = {}
+    for datapack_file, columns in file_columns.items():
+        df_data = load_census_csv([datapack_file], statistical_area_code, columns=columns)
+        loaded[datapack_file] = df_data.set_index(df_data.columns[0])
+    
+    def plan_data(plan):
+        frames = [loaded[x] for x in plan['source_files']]
+        return frames[0] if len(frames) == 1 else join_on_region_index(frames)
+    
+    zero_areas = zero_area_codes() if drop_zero_area else set()
+    def raw_measure(datapack_file, measure):
+        if measure not in loaded[datapack_file].columns:
+            raise ValueError('Measure {} not found in DataPack file {}'.format(measure, datapack_file))
+        series = loaded[datapack_file][measure]
+        return series[~series.index.isin(zero_areas)]
+    
+    frames = [apply_aggregation_plan(plan, plan_data(plan), drop_zero_area) for plan in feature_plans]
+    features = frames[0] if len(frames) == 1 else join_on_region_index(frames)
+    
+    target_series = []
+    for target in targets:
+        if 'plan' in target:
+            series = apply_aggregation_plan(target['plan'], plan_data(target['plan']), drop_zero_area)[target['measure']]
+        else:
+            series = raw_measure(target['datapack_file'], target['measure'])
+        target_series.append(series.rename(target['label']))
+    
+    return features, pd.concat(target_series, axis=1), raw_measure(*denominator)
 
-    df_travel = df_travel.drop([x for x in df_travel.columns if 'Tot_P_P' in x], axis=1)
 
-    # drop outliers based on the WFHPR column
+def target_row_mask(y, outlier_sigma=3):
+    '''
+    Returns a boolean mask of the regions to keep when modelling a response vector: regions with a response that are
+    not upper outliers.
+    
+    INPUTS
+    y - pandas Series - response indexed by region code
+    outlier_sigma - Float. Responses more than this many standard deviations above the mean are dropped, None to keep all
+    
+    OUTPUTS
+    pandas Series of booleans aligned to y
+    '''
+    mask = y.notna()
     # only use an upper bound for outlier detection in this case, based on 3-sigma variation 
     # had previously chosen to remove columns based on IQR formula, but given the skew in the data this was not effective
-    #drop_cutoff = (((df_travel[response_vector].quantile(0.75)-df_travel[response_vector].quantile(0.25))*1.5)
-    #               +df_travel[response_vector].quantile(0.75))
-    drop_cutoff = df_travel[response_vector].mean() + (3* df_travel[response_vector].std())
-    df_travel = df_travel[df_travel[response_vector] <= drop_cutoff]
+    if outlier_sigma is not None:
+        drop_cutoff = y[mask].mean() + (outlier_sigma * y[mask].std())
+        mask &= y <= drop_cutoff
+    return mask
+
+
+def clean_Xy(X, y, outlier_sigma=3):
+    '''
+    Shared final stage of the modelling pipelines: matches the features to the response, drops regions with no
+    response, drops upper outliers in the response and removes duplicated columns.
+    
+    INPUTS
+    X - pandas DataFrame - features indexed by region code
+    y - pandas Series - named response indexed by region code
+    outlier_sigma - Float. Responses more than this many standard deviations above the mean are dropped, None to keep all
+    
+    OUTPUTS
+    X, y - the cleaned features and response
+    '''
+    response_vector = y.name
+    
+    # merge and drop na values and outliers from the response vector
+    df_travel = y.to_frame().merge(X, how='left', left_index=True, right_index=True)
+    df_travel = df_travel[target_row_mask(df_travel[response_vector], outlier_sigma)]
     
     # Remove duplicate column values
-    df_travel = df_travel.T.drop_duplicates().T
+    df_travel = drop_duplicate_columns(df_travel)
 
-    # Create X & y
-    X = df_travel.drop(response_vector, axis=1)
-    y = df_travel[response_vector]
+    return df_travel.drop(response_vector, axis=1), df_travel[response_vector]
 
-    # Get the estimator
-    return X, y
+
+def create_Xy(target_measure, denominator, table_list, category_list, statistical_area_code='SA3', 
+              response_name=None, outlier_sigma=3, drop_zero_area=True, dtype=np.float64):
+    '''
+    Creates input and output vectors to allow model training for any census measure. The target and every feature
+    are scaled by the same denominator (e.g. total population), and the data is cleaned for regions with no
+    denominator, outliers in the response and duplicated features.
+    
+    INPUTS
+    target_measure - the measure to predict, as either:
+                        String. A "Short" column name or "Measures" description from the refined metadata
+                        Tuple of (DataPack file, Short column name), e.g. ('G59', 'Worked_home_P')
+                        Tuple of (table, category list, refined column), e.g. 
+                            ('G59', ['Number of Commuting Methods'], 'Method of Travel to Work by Sex|Worked_at_home')
+    denominator - Tuple of (DataPack file, Short column name) to scale the target and features by, 
+                    or a key of the denominators dictionary (e.g. 'persons')
+    table_list - List of Strings. A list of ABS census datapack tables to draw features from (G01-59)
+    category_list - List of Strings. A list of population characteristics to use in analysis (Age, Sex, etc.)
+    statistical_area_code - String. The statistical area level of information the data should be drawn from (SA1-3)
+    response_name - String. Optional name for the response vector, defaults to "[target] per [denominator]"
+    outlier_sigma - Float. Responses more than this many standard deviations above the mean are dropped, None to keep all
+    drop_zero_area - Boolean. An option to remove "non-geographical" areas such as "no fixed address" or "migratory"
+    dtype - numpy dtype of the scaled features, float64 or float32
+    
+    OUTPUTS
+    X - pandas DataFrame - a dataframe of features from the census datapacks tables, normalised by the denominator
+    y - pandas series - the target measure normalised by the denominator
+    '''
+    features, targets, df_denominator = load_Xy_sources([target_measure], denominator, table_list, category_list, 
+                                                        statistical_area_code, drop_zero_area)
+    
+    # Remove duplicate column values, then scale all features and the target by the denominator
+    X = normalise_features(drop_duplicate_columns(features), df_denominator, dtype)
+    y = normalise_features(targets, df_denominator).iloc[:, 0]
+    y = y.rename(response_name or '{} per {}'.format(targets.columns[0], df_denominator.name))
+    
+    return clean_Xy(X, y, outlier_sigma)
+
+
+def sort_series_abs(S):
+    '''Takes a pandas Series object and returns the series sorted by absolute value'''
+    temp_df = pd.DataFrame(S)
+    temp_df['abs'] = temp_df.iloc[:,0].abs()
+    temp_df.sort_values('abs', ascending = False, inplace = True)
+    return temp_df.iloc[:,0]
+
+
+def create_multi_Xy(target_measures, denominator, table_list, category_list, statistical_area_code='SA3', 
+                    drop_zero_area=True, dtype=np.float64):
+    '''
+    Creates a single feature set shared by several target measures, loading the DataPack files once. The features
+    and all targets are scaled by the same denominator. Unlike create_Xy no regions are dropped for missing or
+    outlying responses, as these differ by target; use target_row_mask to select the regions for each target.
+    
+    INPUTS
+    target_measures - List of target measures, each in any of the forms accepted by create_Xy
+    denominator - see create_Xy
+    table_list - List of Strings. A list of ABS census datapack tables to draw features from (G01-59)
+    category_list - List of Strings. A list of population characteristics to use in analysis (Age, Sex, etc.)
+    statistical_area_code - String. The statistical area level of information the data should be drawn from (SA1-3)
+    drop_zero_area - Boolean. An option to remove "non-geographical" areas such as "no fixed address" or "migratory"
+    dtype - numpy dtype of the scaled features, float64 or float32
+    
+    OUTPUTS
+    X - pandas DataFrame - the scaled features, indexed to match Y
+    Y - pandas DataFrame - one scaled column per target measure
+    '''
+    features, targets, df_denominator = load_Xy_sources(target_measures, denominator, table_list, category_list, 
+                                                        statistical_area_code, drop_zero_area)
+    X = normalise_features(drop_duplicate_columns(features), df_denominator, dtype)
+    Y = normalise_features(targets, df_denominator)
+    return X.reindex(Y.index), Y
+
+
+def WFH_create_Xy(stat_a_level, load_tables, load_features):
+    '''
+    A function which compiles a set of background information from defined ABS census tables and 
+    creates input and output vectors to allow model training for the  "Work from home participation 
+    rate" in a given region. Cleans the data for outliers (defined as >3 standard deviations from the mean) in the
+    WFH participation rate, and scales all data by dividing by the "Total Population" feature for each region.
+    
+    INPUTS
+    stat_a_level - String. The statistical area level of information the data should be drawn from (SA1-3)
+    load_tables - List of Strings. A list of ABS census datapack tables to draw data from (G01-59)
+    load_features - List of Strings. A list of population characteristics to use in analysis (Age, Sex, labor force status, etc.)
+    
+    OUTPUTS
+    X - pandas DataFrame - a dataframe of features from the census datapacks tables, normalised by dividing each feature by 
+                            the population attributable to the region
+    y - pandas series - the Work from Home Participation Rate by region
+    
+    '''
+    # Table 59 has the commute mechanism, base the "Work From Home Participation Rate" off the population who worked 
+    # from home divided by total population in the region
+    return create_Xy(('G59', ['Number of Commuting Methods'], 'Method of Travel to Work by Sex|Worked_at_home'), 
+                     'persons', load_tables, load_features, statistical_area_code=stat_a_level, 
+                     response_name='WFH_Participation')
 
@@ -0,0 +1,130 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+import table_funcs as tbl_func
+import cache_funcs
+
+
+'''Small DataPack fixture'''
+
+# SA3 region codes, 99797 is a zero area territory and 10105 has no population (or workers)
+regions = [10101, 10102, 10103, 10104, 10105, 99797]
+sexes = {'M': 'Males', 'F': 'Females', 'P': 'Persons'}
+
+
+def _meta_rows(datapack_file, table_name, measure_categories, measures, flags):
+    '''Builds the refined metadata rows for a table whose measures are split by sex, e.g. Age_yr_0_M/F/P'''
+    rows = []
+    for measure in measures:
+        for suffix, sex in sexes.items():
+            row = {
+                'Short': '{}_{}'.format(measure, suffix),
+                'Profile table': '{} - {}'.format(datapack_file[:3], table_name),
+                'DataPack file': datapack_file,
+                'Table name': table_name,
+                'Measures': '{}|{}'.format(measure, sex),
+                'Categories': '{}|Sex'.format(measure_categories),
+                'Sex': int(suffix != 'P'),
+                'Number of Classes Excl Total': 2 if suffix != 'P' else 1,
+                }
+            row.update(flags)
+            rows.append(row)
+    return rows
+
+
+def _sex_columns(males, females):
+    '''Returns the male, female and person columns of a measure'''
+    return males, females, males + females
+
+
+def _write_csv(df, path):
+    # the DataPack paths are built as Windows paths, which are plain file names elsewhere
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    df.to_csv(path, index=False)
+
+
+@pytest.fixture
+def census_env(tmp_path, monkeypatch):
+    '''
+    Writes a few small DataPack files and their refined metadata to a temporary "Data" folder and points the loaders
+    at it. G04 is split across two files, and G09A lists its regions in a different order and is missing one. G09A's
+    columns count the same people by sex as G04's, so they are duplicates in both the data and the metadata.
+    '''
+    env = str(tmp_path / 'env')
+    os.makedirs(env)
+    monkeypatch.setattr(tbl_func, 'env_path', env)
+    tbl_func.invalidate_metadata()
+    cache_funcs.clear_result_cache()
+
+    rs = np.random.RandomState(0)
+    n = len(regions)
+    files = {}
+
+    ages = {x: {sex: rs.randint(50, 500, n) for sex in 'MF'} for x in ['0', '1', '2']}
+    for datapack_file, file_ages in [('G04A', ['0', '1']), ('G04B', ['2'])]:
+        df = pd.DataFrame({'SA3_CODE_2016': regions})
+        for age in file_ages:
+            for suffix, values in zip(sexes, _sex_columns(ages[age]['M'], ages[age]['F'])):
+                df['Age_yr_{}_{}'.format(age, suffix)] = values
+        files[datapack_file] = df
+
+    totals = {sex: sum(x[sex] for x in ages.values()) for sex in 'MF'}
+    df = pd.DataFrame({'SA3_CODE_2016': regions})
+    for measure, extra in [('Tot_P', 1000), ('Age_0_4_yr', 0), ('Age_5_14_yr', 200)]:
+        males = totals['M'] + extra + rs.randint(0, 100, n)
+        females = totals['F'] + extra + rs.randint(0, 100, n)
+        for suffix, values in zip(sexes, _sex_columns(males, females)):
+            df['{}_{}'.format(measure, suffix)] = values
+    df.iloc[regions.index(10105), 1:] = 0
+    files['G01'] = df
+
+    df = pd.DataFrame({'SA3_CODE_2016': regions})
+    australia = {sex: rs.randint(0, totals[sex]) for sex in 'MF'}
+    for measure, counts in [('Australia', australia),
+                            ('Elsewhere', {sex: totals[sex] - australia[sex] for sex in 'MF'})]:
+        for suffix, values in zip(sexes, _sex_columns(counts['M'], counts['F'])):
+            df['{}_{}'.format(measure, suffix)] = values
+    files['G09A'] = df[df['SA3_CODE_2016'] != 10104].iloc[::-1]
+
+    df = pd.DataFrame({'SA3_CODE_2016': regions})
+    for measure in ['Worked_at_home', 'One_method_Train']:
+        for suffix, values in zip(sexes, _sex_columns(rs.randint(0, 300, n), rs.randint(0, 300, n))):
+            df['{}_{}'.format(measure, suffix)] = values
+    df['Tot_M'], df['Tot_F'], df['Tot_P'] = (df[['Worked_at_home_M', 'One_method_Train_M']].sum(axis=1),
+                                             df[['Worked_at_home_F', 'One_method_Train_F']].sum(axis=1),
+                                             df[['Worked_at_home_P', 'One_method_Train_P']].sum(axis=1))
+    df.iloc[regions.index(10105), 1:] = 0
+    files['G59'] = df
+
+    for datapack_file, df in files.items():
+        _write_csv(df, cache_funcs.datapack_csv_path(datapack_file, 'SA3', env))
+
+    df_meta = pd.DataFrame(
+        _meta_rows('G01', 'Selected Person Characteristics by Sex', 'Age', ['Tot_P', 'Age_0_4_yr', 'Age_5_14_yr'],
+                   {'Age': 1, 'Number of Commuting Methods': 0})
+        + _meta_rows('G04A', 'Age by Sex', 'Age', ['Age_yr_0', 'Age_yr_1'],
+                     {'Age': 1, 'Number of Commuting Methods': 0})
+        + _meta_rows('G04B', 'Age by Sex', 'Age', ['Age_yr_2'], {'Age': 1, 'Number of Commuting Methods': 0})
+        + _meta_rows('G09A', 'Country of Birth of Person by Sex', 'Country of Birth of Person',
+                     ['Australia', 'Elsewhere'], {'Age': 0, 'Number of Commuting Methods': 0})
+        + _meta_rows('G59', 'Method of Travel to Work by Sex', 'Number of Commuting Methods',
+                     ['Worked_at_home', 'One_method_Train', 'Tot'], {'Age': 0, 'Number of Commuting Methods': 1}))
+    _write_csv(df_meta, tbl_func._metadata_path('refined'))
+
+    _write_csv(pd.DataFrame({
+        'DataPack file': ['G01', 'G04A', 'G04B', 'G09A', 'G59'],
+        'Table name': ['Selected Person Characteristics by Sex', 'Age by Sex', 'Age by Sex',
+                       'Country of Birth of Person by Sex', 'Method of Travel to Work by Sex'],
+        'Table population': ['Persons', 'Persons', 'Persons', 'Persons', 'Employed persons'],
+        }), tbl_func._metadata_path('table_reference'))
+    _write_csv(pd.DataFrame({'AGSS_Code_2016': [99797]}), tbl_func._metadata_path('zero_area'))
+
+    yield env
+
+    tbl_func.invalidate_metadata()
+    cache_funcs.clear_result_cache()
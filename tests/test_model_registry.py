@@ -0,0 +1,50 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from sklearn.pipeline import Pipeline
+from sklearn.impute import SimpleImputer
+from sklearn.linear_model import LinearRegression
+
+import model_registry
+
+
+def _fitted_pipeline():
+    rs = np.random.RandomState(0)
+    X = pd.DataFrame(rs.rand(50, 3), columns=['a', 'b', 'c'])
+    y = pd.Series(X['a'] * 2 + X['c'], name='response')
+    pipeline = Pipeline([('imputer', SimpleImputer()), ('clf', LinearRegression())]).fit(X, y)
+    return pipeline, X, y
+
+
+def test_register_model_round_trip(tmp_path):
+    data_path = str(tmp_path)
+    pipeline, X, y = _fitted_pipeline()
+    entry = model_registry.register_model('model', pipeline, X, y, 'sa3', metrics={'r2': 1.0}, data_path=data_path)
+
+    assert entry['statistical_area_code'] == 'SA3'
+    assert [x['name'] for x in entry['feature_schema']] == ['a', 'b', 'c']
+    assert model_registry.model_entry('model', data_path)['training_data_hash'] == \
+        model_registry.training_data_hash(X, y)
+    # features are matched to the schema by name
+    predictions = model_registry.predict('model', X[['c', 'a', 'b']], data_path)
+    np.testing.assert_allclose(predictions, pipeline.predict(X))
+    assert predictions.name == 'response'
+
+
+def test_concurrent_register_model(tmp_path):
+    data_path = str(tmp_path)
+    pipeline, X, y = _fitted_pipeline()
+    names = ['model_{}'.format(i % 16) for i in range(64)]
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(lambda name: model_registry.register_model(name, pipeline, X, y, 'SA3', data_path=data_path),
+                          names))
+
+    df = model_registry.list_models(data_path)
+    assert sorted(df.index) == sorted(set(names))
+    for name in set(names):
+        np.testing.assert_allclose(model_registry.predict(name, X, data_path), pipeline.predict(X))
+    # every temporary file was moved into place
+    assert not [x for _, _, files in os.walk(data_path) for x in files if x.endswith('.tmp')]
+    model_registry.unload_models()
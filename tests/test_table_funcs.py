@@ -0,0 +1,234 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import table_funcs as tbl_func
+import cache_funcs
+
+
+'''Reference implementation'''
+
+def baseline_table_refined(table_ref, category_list):
+    '''The original load_table_refined: slices the metadata, then sums the transposed DataPack columns by group'''
+    df_meta = pd.read_csv(tbl_func._metadata_path('refined'))
+    meta_df_select = df_meta[df_meta['Profile table'].str.contains(table_ref)]
+    for cat in category_list:
+        if cat in meta_df_select.columns and meta_df_select[cat].sum() > 0:
+            meta_df_select = meta_df_select[meta_df_select[cat] > 0]
+    min_fields = meta_df_select['Number of Classes Excl Total'].min()
+    meta_df_select = meta_df_select[meta_df_select['Number of Classes Excl Total'] == min_fields]
+
+    df_data = None
+    for datapack_file in meta_df_select['DataPack file'].unique():
+        df_file = pd.read_csv(cache_funcs.datapack_csv_path(datapack_file, 'SA3', tbl_func.env_path))
+        df_data = df_file if df_data is None else pd.merge(df_data, df_file, on=df_data.columns[0])
+    df_data = df_data.set_index(df_data.columns[0])[meta_df_select['Short'].tolist()]
+
+    names = [tbl_func.refine_measure_name(table_name, measures, categories, category_list)
+             for table_name, measures, categories in zip(meta_df_select['Table name'], meta_df_select['Measures'],
+                                                          meta_df_select['Categories'])]
+    df_data_t = df_data.T.groupby(names).sum().T
+
+    zero_area = set(pd.read_csv(tbl_func._metadata_path('zero_area'))['AGSS_Code_2016'])
+    return df_data_t.drop([x for x in df_data_t.index if x in zero_area])
+
+
+def baseline_tables_specify_cats(table_list, category_list):
+    '''The original load_tables_specify_cats: an inner merge of each refined table on the region code'''
+    df = None
+    for table in table_list:
+        temp_df = baseline_table_refined(table, category_list).reset_index()
+        df = temp_df if df is None else pd.merge(df, temp_df, on=df.columns[0])
+    return df.set_index(df.columns[0])
+
+
+def assert_same_frame(df, expected):
+    pd.testing.assert_frame_equal(df, expected, check_dtype=False, check_names=False, check_index_type=False)
+
+
+tables_and_categories = [
+    (['G04'], ['Age']),
+    (['G04'], ['Sex']),
+    (['G01', 'G04', 'G09'], ['Age']),
+    (['G01', 'G04', 'G09'], ['Age', 'Sex']),
+    (['G09', 'G04'], ['Sex']),
+    ]
+
+
+'''Loaders'''
+
+@pytest.mark.parametrize('table_list, category_list', tables_and_categories)
+def test_load_tables_specify_cats_matches_baseline(census_env, table_list, category_list):
+    df = tbl_func.load_tables_specify_cats(table_list, category_list, use_cache=False)
+    assert_same_frame(df, baseline_tables_specify_cats(table_list, category_list))
+
+
+@pytest.mark.parametrize('table_list, category_list', tables_and_categories)
+def test_parallel_load_matches_baseline(census_env, table_list, category_list):
+    df = tbl_func.load_tables_specify_cats(table_list, category_list, use_cache=False, n_jobs=2, backend='thread')
+    assert_same_frame(df, baseline_tables_specify_cats(table_list, category_list))
+
+
+def test_cached_load_matches_baseline(census_env):
+    expected = baseline_tables_specify_cats(['G01', 'G04', 'G09'], ['Age'])
+    hits = cache_funcs.result_cache_stats['hits']
+
+    df = tbl_func.load_tables_specify_cats(['G01', 'G04', 'G09'], ['Age'])
+    assert_same_frame(df, expected)
+    # changing the returned frame mustn't change the cached result
+    df['extra'] = 1
+
+    df = tbl_func.load_tables_specify_cats(['G01', 'G04', 'G09'], ['Age'])
+    assert cache_funcs.result_cache_stats['hits'] == hits + 1
+    assert_same_frame(df, expected)
+
+
+def test_cached_load_keeps_options_apart(census_env):
+    tbl_func.load_tables_specify_cats(['G04', 'G09'], ['Sex'])
+    # the region codes of G09A differ from G04's, which only verify_index rejects
+    with pytest.raises(ValueError):
+        tbl_func.load_tables_specify_cats(['G04', 'G09'], ['Sex'], verify_index=True)
+
+    df = tbl_func.load_tables_specify_cats(['G04', 'G09'], ['Sex'], dedup_metadata=True)
+    assert list(df.columns) == ['Age by Sex|Females', 'Age by Sex|Males']
+
+
+@pytest.mark.parametrize('table_list, category_list', tables_and_categories)
+def test_streamed_load_matches_baseline(census_env, table_list, category_list):
+    df = tbl_func.load_tables_streamed(table_list, category_list, chunk_size=2, dtype=np.float64)
+    assert_same_frame(df, baseline_tables_specify_cats(table_list, category_list))
+
+    chunks = list(tbl_func.stream_tables_specify_cats(table_list, category_list, chunk_size=2, dtype=np.float64))
+    assert_same_frame(pd.concat(chunks), df)
+
+
+'''De-duplication'''
+
+def test_drop_duplicate_columns_matches_transpose(census_env):
+    df = tbl_func.load_tables_specify_cats(['G04', 'G09'], ['Sex'], use_cache=False)
+    expected = df.T.drop_duplicates().T
+    assert list(expected.columns) == ['Age by Sex|Females', 'Age by Sex|Males']
+    assert_same_frame(tbl_func.drop_duplicate_columns(df), expected)
+
+
+def test_drop_duplicate_columns_keeps_dtypes():
+    df = pd.DataFrame({'a': [1, 2, 3], 'b': [1.5, 2.5, 3.5], 'c': [1, 2, 3], 'd': [1.0, 2.0, 3.0], 'e': [3, 2, 1]})
+    result = tbl_func.drop_duplicate_columns(df)
+    assert list(result.columns) == ['a', 'b', 'e']
+    pd.testing.assert_series_equal(result.dtypes, df[['a', 'b', 'e']].dtypes)
+
+
+def test_dedup_metadata_drops_duplicated_groups(census_env):
+    table_list = ['G01', 'G04', 'G09']
+    df = tbl_func.load_tables_specify_cats(table_list, ['Sex'], use_cache=False, dedup_metadata=True)
+    expected = baseline_tables_specify_cats(table_list, ['Sex'])
+    # G01 is a summary table so it is never a duplicate, G09's counts by sex repeat G04's
+    expected = expected.drop(['Country of Birth of Person by Sex|Females', 'Country of Birth of Person by Sex|Males'],
+                             axis=1)
+    assert_same_frame(df, expected)
+
+
+'''Normalisation'''
+
+def baseline_normalise(df, df_pop):
+    '''The original scaling in WFH_create_Xy: merge in the population and divide one column at a time'''
+    input_vectors = df.merge(df_pop, left_index=True, right_index=True)
+    cols = input_vectors.columns
+    input_vectors[cols] = input_vectors[cols].apply(pd.to_numeric, errors='coerce')
+    input_vectors = input_vectors.dropna(subset=['Tot_P_P'])
+    input_vectors = input_vectors[input_vectors['Tot_P_P'] > 0]
+    for col in input_vectors.columns:
+        if col != 'Tot_P_P':
+            input_vectors[col] = input_vectors[col] / input_vectors['Tot_P_P']
+    return input_vectors.drop('Tot_P_P', axis=1)
+
+
+def test_normalise_features_matches_baseline(census_env):
+    df = tbl_func.load_tables_specify_cats(['G01', 'G04', 'G09'], ['Age'], use_cache=False)
+    denominator = tbl_func.load_denominator('persons')
+    expected = baseline_normalise(df, denominator.to_frame())
+    # the zero population region is dropped
+    assert 10105 not in expected.index
+    assert_same_frame(tbl_func.normalise_features(df, denominator), expected)
+
+
+def test_normalise_features_options():
+    df = pd.DataFrame({'a': [1, 2, 3, 4], 'b': ['2', '4', 'x', '8'], 'pop': [2, 0, np.nan, 4]}, index=[1, 2, 3, 4])
+
+    result = tbl_func.normalise_features(df, 'pop')
+    assert_same_frame(result, pd.DataFrame({'a': [0.5, 1.0], 'b': [1.0, 2.0]}, index=[1, 4]))
+
+    result = tbl_func.normalise_features(df, 'pop', dtype=np.float32, drop_invalid=False)
+    assert list(result.index) == [1, 2, 3, 4]
+    assert (result.dtypes == np.float32).all()
+    assert result.loc[[2, 3]].isna().all().all()
+
+
+def test_streamed_load_with_denominator_matches_baseline(census_env):
+    df = tbl_func.load_tables_streamed(['G04', 'G09'], ['Sex'], chunk_size=2, denominator=('G01', 'Tot_P_P'),
+                                       dtype=np.float64)
+    df_pop = pd.read_csv(cache_funcs.datapack_csv_path('G01', 'SA3', tbl_func.env_path)).set_index('SA3_CODE_2016')
+    expected = baseline_normalise(baseline_tables_specify_cats(['G04', 'G09'], ['Sex']), df_pop[['Tot_P_P']])
+    assert_same_frame(df, expected)
+
+
+'''Response variables'''
+
+def baseline_create_Xy(df_target, load_tables, load_features):
+    '''
+    The original WFH_create_Xy, for any unscaled target column: scales the target and features by the population,
+    then drops regions with no response, outliers and duplicated columns
+    '''
+    response_vector = df_target.columns[0]
+    df_pop = pd.read_csv(cache_funcs.datapack_csv_path('G01', 'SA3', tbl_func.env_path)).set_index('SA3_CODE_2016')
+    df_pop = df_pop[['Tot_P_P']]
+    df_travel = df_target.merge(df_pop, left_index=True, right_index=True)
+    df_travel[response_vector] = df_travel[response_vector] / df_travel['Tot_P_P']
+
+    input_vectors = baseline_tables_specify_cats(load_tables, load_features)
+    input_vectors = baseline_normalise(input_vectors.T.drop_duplicates().T, df_pop)
+
+    df_travel = df_travel.merge(input_vectors, how='left', left_index=True, right_index=True)
+    df_travel = df_travel.dropna(subset=[response_vector]).drop('Tot_P_P', axis=1)
+    drop_cutoff = df_travel[response_vector].mean() + (3 * df_travel[response_vector].std())
+    df_travel = df_travel[df_travel[response_vector] <= drop_cutoff]
+    df_travel = df_travel.T.drop_duplicates().T
+    return df_travel.drop(response_vector, axis=1), df_travel[response_vector]
+
+
+@pytest.mark.parametrize('table_list, category_list', [(['G01', 'G04'], ['Age']), (['G04', 'G09'], ['Sex'])])
+def test_WFH_create_Xy_matches_baseline(census_env, table_list, category_list):
+    df_target = baseline_table_refined('G59', ['Number of Commuting Methods'])
+    df_target = df_target[['Method of Travel to Work by Sex|Worked_at_home']]
+    expected_X, expected_y = baseline_create_Xy(df_target, table_list, category_list)
+
+    X, y = tbl_func.WFH_create_Xy('SA3', table_list, category_list)
+    assert_same_frame(X, expected_X)
+    pd.testing.assert_series_equal(y, expected_y, check_dtype=False, check_names=False, check_index_type=False)
+    assert y.name == 'WFH_Participation'
+
+
+@pytest.mark.parametrize('target_measure', ['Worked_at_home_P', ('G59', 'Worked_at_home_P')])
+def test_create_Xy_matches_baseline(census_env, target_measure):
+    df_target = pd.read_csv(cache_funcs.datapack_csv_path('G59', 'SA3', tbl_func.env_path)).set_index('SA3_CODE_2016')
+    expected_X, expected_y = baseline_create_Xy(df_target[['Worked_at_home_P']].drop(99797), ['G04', 'G09'], ['Sex'])
+
+    X, y = tbl_func.create_Xy(target_measure, 'persons', ['G04', 'G09'], ['Sex'])
+    assert_same_frame(X, expected_X)
+    pd.testing.assert_series_equal(y, expected_y, check_dtype=False, check_names=False, check_index_type=False)
+    assert y.name == 'Worked_at_home_P per Tot_P_P'
+
+
+def test_create_multi_Xy_matches_create_Xy(census_env):
+    targets = [('G59', 'Worked_at_home_P'), ('G59', 'One_method_Train_P')]
+    X, Y = tbl_func.create_multi_Xy(targets, 'persons', ['G01', 'G04', 'G09'], ['Sex'])
+    assert list(Y.columns) == ['Worked_at_home_P', 'One_method_Train_P']
+    assert X.index.equals(Y.index)
+
+    for target in targets:
+        X_single, y = tbl_func.create_Xy(target, 'persons', ['G01', 'G04', 'G09'], ['Sex'])
+        # the shared matrix keeps every region, target_row_mask selects the ones create_Xy keeps for the target
+        mask = tbl_func.target_row_mask(Y[target[1]])
+        assert list(Y.index[mask]) == list(y.index)
+        pd.testing.assert_series_equal(Y.loc[mask, target[1]], y, check_names=False)
+        assert_same_frame(X.loc[mask, X_single.columns], X_single)